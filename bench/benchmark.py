@@ -0,0 +1,354 @@
+"""
+FILE: benchmark.py
+
+DESCRIPTION: End-to-end benchmark of the WebSocket and HTTP applications with a simulated device fleet.
+
+NOTES:
+- Starts a local `redis-server` (unless `--redis` points to a running one), the WebSocket app and the Flask app,
+  connects the simulated fleet (see `simulator.py`) and drives `/admin/push` from `--concurrency` threads.
+- With `--insert`, records go through the disk spool. By default the database is an unreachable host, so only spooling
+  is measured (acknowledgements never wait for the database) and insert throughput is NOT measured: nothing is inserted.
+  With `--mssql`, the WebSocket app inserts into the database of the `MSSQL_*` environment variables (e.g., a disposable
+  SQL Server container), and the rows the table gained during the measurement are reported.
+- Reports push throughput and round-trip latency, `sendlog` acknowledgement latency, and CPU and memory of the servers.
+- `--scale 1,2,4` repeats the run with that many WebSocket worker processes and reports each run (with the devices per
+  worker), to check that the devices a host can serve grow with its cores. The simulated fleet runs in one asyncio thread,
+  which saturates a core long before several workers do: use `--fleet-processes` to split it across simulator processes
+  (see `simulator.py`), or run the fleet on another host.
+- Usage: `python benchmark.py --devices 500 --duration 60 --concurrency 32`
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import signal
+import socket
+import asyncio
+import tempfile
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+from argparse import ArgumentParser
+
+from simulator import FleetStats, run_fleet, device_sn, summarize
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+AUTHORIZATION_KEY = "benchmark"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception(f"Nothing is listening on port {port}.")
+
+# pid and all descendants (the Flask debug server runs the app in a child process)
+def process_tree(pid):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat", 'r') as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    tree, todo = [], [pid]
+    while len(todo) > 0:
+        current = todo.pop()
+        tree.append(current)
+        todo.extend(children.get(current, []))
+    return tree
+
+# (CPU seconds, resident memory in bytes) of a process and its descendants
+def usage(pid):
+    cpu, rss = 0.0, 0
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/stat", 'r') as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            rss += int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError, ValueError):
+            pass
+    return cpu, rss
+
+class ProcessMonitor:
+    def __init__(self, processes, interval=0.5):
+        self.processes = processes
+        self.interval = interval
+        self.start_cpu = {}
+        self.peak_rss = {name : 0 for name in processes}
+        self.stopping = threading.Event()
+        self.start_time = 0.0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.start_time = time.time()
+        self.start_cpu = {name : usage(process.pid)[0] for name, process in self.processes.items()}
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            for name, process in self.processes.items():
+                self.peak_rss[name] = max(self.peak_rss[name], usage(process.pid)[1])
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        elapsed = time.time() - self.start_time
+        return {name : {
+            "cpu_percent" : round(100 * (usage(process.pid)[0] - self.start_cpu[name]) / elapsed, 1),
+            "peak_rss_mb" : round(self.peak_rss[name] / 1024 / 1024, 1)
+        } for name, process in self.processes.items()}
+
+def push(url, command, timeout):
+    request = urllib.request.Request(
+        url, data=json.dumps(command).encode(), method="POST",
+        headers={"Content-Type" : "application/json", "Authorization" : f"Bearer {AUTHORIZATION_KEY}"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return None
+
+def drive_pushes(url, sns, cmd, concurrency, duration, timeout):
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        while time.perf_counter() < deadline:
+            start_time = time.perf_counter()
+            status = push(url, {"sn" : random.choice(sns), "cmd" : cmd, "cache" : False}, timeout)
+            latency = time.perf_counter() - start_time
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(latency)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses
+
+def milliseconds(summary):
+    return {k : (round(v * 1000, 2) if isinstance(v, float) else v) for k, v in summary.items()}
+
+# the database of `--mssql` (from the environment), or an unreachable host standing in for it
+def database_env(args):
+    if args.mssql:
+        return {name : os.environ[name] for name in ("MSSQL_HOST", "MSSQL_USER", "MSSQL_PASS", "MSSQL_DATA", "MSSQL_TABL")}
+    return {"MSSQL_HOST" : "127.0.0.1:1", "MSSQL_USER" : "sa", "MSSQL_PASS" : "", "MSSQL_DATA" : "bench", "MSSQL_TABL" : "bench"}
+
+# rows in the table of `--mssql`, or None if it cannot be read (e.g., not created yet)
+def count_rows(database):
+    import pymssql # only needed with `--mssql`
+    try:
+        with pymssql.connect(database['MSSQL_HOST'], database['MSSQL_USER'], database['MSSQL_PASS'], database['MSSQL_DATA']) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT COUNT_BIG(*) FROM {database['MSSQL_TABL']}")
+            return cursor.fetchone()[0]
+    except pymssql.Error:
+        return None
+
+def start_servers(args, workdir, redis_host, redis_port, ws_port, http_port):
+    env = dict(os.environ)
+    env.update(database_env(args))
+    env.update({
+        "WEBSOCKET_IP" : "127.0.0.1", "WEBSOCKET_PORT" : str(ws_port),
+        "REDIS_IP" : redis_host, "REDIS_PORT" : str(redis_port),
+        "REDIS_DB_PREFIX" : f"BENCH{os.getpid()}", "REDIS_OUT_KEY" : "OUT", "REDIS_IN_KEY" : "IN",
+        "FLASK_IP" : "127.0.0.1", "FLASK_PORT" : str(http_port), "FLASK_AUTHORIZATION_KEY" : AUTHORIZATION_KEY,
+        "TIMEOUT_WS_NEW_MESSAGE" : "1", "TIMEOUT_WS_MAX_WAIT" : "300", "TIMEOUT_HTTP_WAIT_RESPONSE" : str(int(args.timeout)),
+        "LOG_SERVER_PREFIX" : "SERVER", "LOG_CLIENT_PREFIX" : "CLIENT", "LOG_CONSOLE" : "0", "LOG_LEVEL" : args.log_level,
+        "PATH_WS_LOG" : os.path.join(workdir, "logs"), "PATH_WS_SPOOL" : os.path.join(workdir, "spool"),
+        "PATH_WS_ARCHIVE" : os.path.join(workdir, "archive"), "ARCHIVE_MODE" : "off"
+    })
+    output = open(os.path.join(workdir, "servers.log"), 'w')
+    ws_args = [sys.executable, "-u", "app_ws.py", "--receive", "--workers", str(args.ws_workers)] + (["--insert"] if args.insert else [])
+    processes = {
+        "ws" : subprocess.Popen(ws_args, cwd=os.path.join(ROOT, "ws"), env=env, stdout=output, stderr=subprocess.STDOUT),
+        "http" : subprocess.Popen([sys.executable, "-u", args.http_app], cwd=os.path.join(ROOT, "flask"), env=env, stdout=output, stderr=subprocess.STDOUT)
+    }
+    wait_for_port(ws_port)
+    wait_for_port(http_port)
+    return processes
+
+# `simulator.py` processes sharing the fleet, each with a contiguous range of device indices
+def start_fleet(args, ws_port):
+    processes = []
+    for i in range(args.fleet_processes):
+        first, last = i * args.devices // args.fleet_processes, (i + 1) * args.devices // args.fleet_processes
+        processes.append(subprocess.Popen([
+            sys.executable, "-u", "simulator.py", "--url", f"ws://127.0.0.1:{ws_port}", "--devices", str(last - first), "--first", str(first),
+            "--interval", str(args.interval), "--records", str(args.records), "--duration", str(args.warmup + args.duration),
+            "--warmup", str(args.warmup), "--raw"
+        ], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE))
+    return processes
+
+# wait for the simulators and merge their results
+def join_fleet(processes):
+    stats = FleetStats()
+    for process in processes:
+        output, _ = process.communicate()
+        try:
+            result = json.loads(output)
+        except ValueError:
+            stats.errors += 1
+            continue
+        stats.registered += result['registered']
+        stats.errors += result['errors']
+        stats.records_sent += result['records_sent']
+        stats.ack_latency.extend(result['ack_latency'])
+    return stats
+
+def stop_processes(processes):
+    for process in processes.values():
+        for pid in reversed(process_tree(process.pid)):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    for process in processes.values():
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="face-bench-")
+    processes = {}
+    fleet_processes = []
+    try:
+        if args.redis is not None:
+            redis_host, redis_port = args.redis.split(":")
+        else:
+            redis_host, redis_port = "127.0.0.1", free_port()
+            processes['redis'] = subprocess.Popen(
+                [args.redis_server, "--port", str(redis_port), "--save", "", "--appendonly", "no"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            wait_for_port(redis_port)
+        ws_port, http_port = free_port(), free_port()
+        processes.update(start_servers(args, workdir, redis_host, int(redis_port), ws_port, http_port))
+
+        # connect the fleet in the background for warm-up + measurement
+        stats = FleetStats()
+        if args.fleet_processes > 1:
+            fleet_processes = start_fleet(args, ws_port)
+        else:
+            fleet = threading.Thread(target=lambda: asyncio.run(run_fleet(
+                f"ws://127.0.0.1:{ws_port}", args.devices, args.warmup + args.duration, args.interval, args.records, stats=stats
+            )), daemon=True)
+            fleet.start()
+            stats.measure_from = time.perf_counter() + args.warmup
+        time.sleep(args.warmup)
+
+        monitor = ProcessMonitor({name : process for name, process in processes.items() if name != "redis"})
+        monitor.start()
+        measure_rows = args.insert and args.mssql
+        rows_before = count_rows(database_env(args)) if measure_rows else None
+        latencies, statuses = [], {}
+        if args.concurrency > 0:
+            sns = [device_sn("SIM", i) for i in range(args.devices)]
+            latencies, statuses = drive_pushes(
+                f"http://127.0.0.1:{http_port}/admin/push", sns, args.cmd, args.concurrency, args.duration, args.timeout + 5
+            )
+        else:
+            time.sleep(args.duration)
+        resources = monitor.stop()
+        rows_after = count_rows(database_env(args)) if measure_rows else None
+        if not args.insert:
+            insert = None
+        elif not measure_rows:
+            insert = "Not measured: records are spooled for an unreachable database (use --mssql)."
+        elif rows_before is None or rows_after is None:
+            insert = "Not measured: the table could not be read."
+        else: # net of the records the unique index skipped
+            insert = {"rows_inserted" : rows_after - rows_before, "throughput" : round((rows_after - rows_before) / args.duration, 1)}
+        if args.fleet_processes > 1:
+            stats = join_fleet(fleet_processes)
+        else:
+            fleet.join()
+
+        return {
+            "devices" : args.devices,
+            "ws_workers" : args.ws_workers,
+            "devices_per_worker" : round(args.devices / args.ws_workers, 1),
+            "fleet_processes" : args.fleet_processes,
+            "registered" : stats.registered,
+            "device_errors" : stats.errors,
+            "push" : {
+                "cmd" : args.cmd,
+                "concurrency" : args.concurrency,
+                "throughput" : round(len(latencies) / args.duration, 1),
+                "statuses" : {str(k) : v for k, v in statuses.items()},
+                "latency_ms" : milliseconds(summarize(latencies))
+            },
+            "sendlog" : {
+                "records_sent" : stats.records_sent,
+                "ack_latency_ms" : milliseconds(summarize(stats.ack_latency))
+            },
+            "insert" : insert,
+            "servers" : resources
+        }
+    finally:
+        for process in fleet_processes:
+            if process.poll() is None:
+                process.kill()
+        stop_processes(processes)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Kept benchmark files in {workdir}.", file=sys.stderr)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='End-to-end benchmark of the AiFace server.')
+    parser.add_argument("--devices", type=int, default=100, help="Number of simulated devices.")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between `sendlog` batches of a device.")
+    parser.add_argument("--records", type=int, default=10, help="Records per `sendlog` batch.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent `/admin/push` callers (0 = none).")
+    parser.add_argument("--cmd", type=str, default="getdevinfo", help="Command pushed to the devices.")
+    parser.add_argument("--timeout", type=float, default=10.0, help="TIMEOUT_HTTP_WAIT_RESPONSE of the HTTP app.")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Seconds to let the fleet connect before measuring.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to measure.")
+    parser.add_argument("--ws-workers", type=int, default=1, help="WebSocket server processes (`--workers` of the WebSocket app).")
+    parser.add_argument("--fleet-processes", type=int, default=1, help="Simulator processes sharing the fleet (1 = a thread of the benchmark).")
+    parser.add_argument("--scale", type=str, default=None, help="Comma-separated WebSocket worker counts to run one after another.")
+    parser.add_argument("--http-app", type=str, default="gateway.py", choices=["gateway.py", "app_http.py"], help="HTTP server to run (asynchronous gateway or Flask development server).")
+    parser.add_argument("--insert", action="store_true", help="Run the WebSocket app with `--insert` (spooled; no database unless `--mssql`).")
+    parser.add_argument("--mssql", action="store_true", help="Insert into the database of the `MSSQL_*` environment variables and measure insert throughput.")
+    parser.add_argument("--redis", type=str, default=None, help="host:port of a running Redis server (default: start one).")
+    parser.add_argument("--redis-server", type=str, default="redis-server", help="Redis server binary to start.")
+    parser.add_argument("--log-level", type=str, default="INFO", help="LOG_LEVEL of the WebSocket app.")
+    parser.add_argument("--keep", action="store_true", help="Keep logs and spool of the run.")
+    parser.set_defaults(insert=False, mssql=False, keep=False)
+    args = parser.parse_args()
+
+    if args.scale is not None:
+        results = []
+        for workers in [int(n) for n in args.scale.split(",")]:
+            args.ws_workers = workers
+            results.append(run(args))
+        print(json.dumps(results, indent=4))
+    else:
+        print(json.dumps(run(args), indent=4))
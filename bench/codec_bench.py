@@ -0,0 +1,195 @@
+"""
+FILE: codec_bench.py
+
+DESCRIPTION: Microbenchmark of the cost per device frame on the WebSocket server, before and after `ws/codec.py`.
+
+NOTES:
+- Each iteration handles a `reg` or `sendlog` frame (built from `responses/`) up to its encoded acknowledgement.
+- `legacy` repeats what the server did for each frame before the codec (`handle`, `get_response` and `send_response` of
+  the first version of `app_ws.py`): `json.loads`, `save_file` (the message written to `<PATH_WS_RESPONSES>/<cmd>.json`),
+  `in message.keys()` checks, a `deepcopy` of the acknowledgement template, then for a `sendlog` one `show_dict` line
+  per record and for a `reg` two lines, each `print`ed and written with `LogRecord.write`, and `json.dumps`.
+  Printing goes to `os.devnull`, which is cheaper than a terminal, so the legacy cost is a lower bound.
+- `codec` is the current path (`codec.decode`, the INFO lines of the command handler through `EventLog`, the cached
+  acknowledgement), with the standard library backend (`json`) and `orjson` side by side; a backend that is not installed
+  is reported as such.
+- Usage: `python codec_bench.py --records 100 --iterations 20000`
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import contextlib
+from copy import deepcopy
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ws"))
+import codec
+from logger import EventLog
+
+RESPONSES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "responses")
+CLIENT_LOG_PREFIX = "CLIENT"
+SERVER_LOG_PREFIX = "SERVER"
+REGISTER_LOG_KEYS = ['modelname', 'netinuse', 'fpalgo', 'firmware', 'time', 'mac']
+RECORD_LOG_KEYS = ['enrollid', 'aliasid', 'name', 'time', 'mode', 'inout', 'event']
+
+def load_frames(records):
+    with open(os.path.join(RESPONSES_PATH, "reg.json"), 'r') as f:
+        reg = json.load(f)
+    with open(os.path.join(RESPONSES_PATH, "sendlog.json"), 'r') as f:
+        sendlog = json.load(f)
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    sendlog = dict(sendlog, count=records, record=[dict(sendlog['record'][i % len(sendlog['record'])], enrollid=i, time=now) for i in range(records)])
+    return {"reg" : json.dumps(reg), "sendlog" : json.dumps(sendlog)}
+
+# the first version of `app_ws.py`, as it handled a device frame
+
+def dtnow():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+REGISTER_SUCCESS_RESPONSE = {"ret" : "reg", "result" : True, "cloudtime" : dtnow(), "nosenduser" : True}
+SENDLOG_SUCCESS_RESPONSE = {"ret" : "sendlog", "result" : True, "count" : 999, "logindex" : 999, "cloudtime" : dtnow(), "access" : 1}
+
+class LogRecord:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def open(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.file = open(os.path.join(self.path, 'log.txt'), 'a')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def write(self, message):
+        if self.file is not None:
+            self.file.write(f"{message}\n")
+
+def show_dict(d, keys):
+    return ', '.join(f'{k}={d[k]}' for k in keys)
+
+def save_file(message, path):
+    filename = None
+    if "cmd" in message.keys():
+        filename = message['cmd']
+    elif "ret" in message.keys():
+        filename = message['ret']
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    if filename is not None:
+        with open(os.path.join(path, filename + '.json'), 'w') as f:
+            json.dump(message, f, indent=4)
+
+def get_response(message):
+    result = None
+    if message['cmd'] == 'reg':
+        result = deepcopy(REGISTER_SUCCESS_RESPONSE)
+        result['cloudtime'] = dtnow()
+
+        print(f"[{dtnow()}] [{CLIENT_LOG_PREFIX}] Register request received by {message['sn']}. Device info: {show_dict(message['devinfo'], REGISTER_LOG_KEYS)}.")
+        LOG_FILE.write(f"[{dtnow()}] [{CLIENT_LOG_PREFIX}] Register request received by {message['sn']}. Device info: {show_dict(message['devinfo'], REGISTER_LOG_KEYS)}.")
+    elif message['cmd'] == 'sendlog':
+        result = deepcopy(SENDLOG_SUCCESS_RESPONSE)
+        result['cloudtime'] = dtnow()
+        result['count'] = message['count']
+        result['logindex'] = message['logindex']
+
+        for i in range(message['count']):
+            print(f"[{dtnow()}] [{CLIENT_LOG_PREFIX}] Record from {message['sn']}: {show_dict(message['record'][i], RECORD_LOG_KEYS)}.")
+            LOG_FILE.write(f"[{dtnow()}] [{CLIENT_LOG_PREFIX}] Record from {message['sn']}: {show_dict(message['record'][i], RECORD_LOG_KEYS)}.")
+
+    return result
+
+# returns the frame `websocket.send` was given
+def send_response(message):
+    if message is not None:
+        if "ret" in message.keys():
+            if message['ret'] == 'reg':
+                print(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Register success on {message['cloudtime']}.")
+                LOG_FILE.write(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Register success on {message['cloudtime']}.")
+        return json.dumps(message)
+    else:
+        raise Exception("Undefined message received.")
+
+def legacy(raw):
+    message = json.loads(raw)
+    save_file(message, LEGACY_RESPONSES_PATH)
+    if "cmd" in message.keys():
+        return send_response(get_response(message))
+
+# the current path (see `reg_command` and `sendlog_command` in `app_ws.py`)
+
+ACKS = codec.AckFrames()
+
+def pick(d, keys):
+    return {k : d[k] for k in keys if k in d}
+
+def reg_ack(message):
+    CLIENT_LOG.info("Register request received.", sn=message['sn'], devinfo=pick(message['devinfo'], REGISTER_LOG_KEYS))
+    frame = ACKS.reg()
+    SERVER_LOG.info("Register success.", cloudtime=ACKS.cloudtime)
+    return frame
+
+def sendlog_ack(message):
+    CLIENT_LOG.info("Records received.", sn=message['sn'], count=message['count'], logindex=message['logindex'])
+    return ACKS.sendlog(message['count'], message['logindex'])
+
+RESPONSES = {"reg" : reg_ack, "sendlog" : sendlog_ack}
+
+def current(raw):
+    message = codec.decode(raw)
+    return RESPONSES[message['cmd']](message)
+
+# microseconds per call
+def measure(function, raw, iterations):
+    for _ in range(min(iterations, 1000)): # warm up
+        function(raw)
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        function(raw)
+    return (time.perf_counter() - start_time) / iterations * 1e6
+
+def run(records, iterations):
+    frames = load_frames(records)
+    results = {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for name, raw in frames.items():
+            results[name] = {"bytes" : len(raw), "legacy_us" : round(measure(legacy, raw, iterations), 2)}
+            for backend in ("json", "orjson"):
+                if backend not in codec.BACKENDS:
+                    results[name][f"codec_{backend}_us"] = f"{backend} is not installed"
+                    continue
+                codec.use_backend(backend)
+                results[name][f"codec_{backend}_us"] = round(measure(current, raw, iterations), 2)
+                results[name][f"speedup_{backend}"] = round(results[name]['legacy_us'] / results[name][f"codec_{backend}_us"], 2)
+            codec.use_backend()
+    return results
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Per-frame cost of decoding and acknowledging device messages.')
+    parser.add_argument("--records", type=int, default=100, help="Records in the `sendlog` frame.")
+    parser.add_argument("--iterations", type=int, default=20000, help="Frames processed per measurement.")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="face-codec-bench-")
+    LEGACY_RESPONSES_PATH = os.path.join(workdir, "responses")
+    LOG_FILE = LogRecord(os.path.join(workdir, "legacy"))
+    LOG_FILE.open()
+    EVENT_LOG = EventLog(os.path.join(workdir, "logs"), console=False)
+    EVENT_LOG.open()
+    SERVER_LOG = EVENT_LOG.bind(SERVER_LOG_PREFIX)
+    CLIENT_LOG = EVENT_LOG.bind(CLIENT_LOG_PREFIX)
+    try:
+        print(json.dumps(run(args.records, args.iterations), indent=4))
+    finally:
+        LOG_FILE.close()
+        EVENT_LOG.close()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,158 @@
+"""
+FILE: simulator.py
+
+DESCRIPTION: Fleet of simulated AiFace devices for load testing the WebSocket server.
+
+NOTES:
+- Each device registers with `reg`, then sends `sendlog` batches every `interval` seconds and measures how long
+  the server takes to acknowledge them.
+- Commands from the server are answered with the sample replies in `responses/` (with the device's serial number).
+- A fleet runs in a single asyncio thread; start several simulators with different `--first` indices to load a server
+  with more devices than one core can simulate (see `--fleet-processes` in `benchmark.py`).
+- Usage: `python simulator.py --url ws://localhost:7788 --devices 100 --interval 5 --records 10 --duration 60`
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import datetime
+from argparse import ArgumentParser
+
+import websockets
+
+RESPONSES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "responses")
+
+def load_responses(path=RESPONSES_PATH):
+    responses = {}
+    for name in os.listdir(path):
+        if name.endswith(".json"):
+            with open(os.path.join(path, name), 'r') as f:
+                responses[name[:-len(".json")]] = json.load(f)
+    return responses
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def summarize(values):
+    return {
+        "count" : len(values),
+        "p50" : percentile(values, 50),
+        "p95" : percentile(values, 95),
+        "p99" : percentile(values, 99),
+        "max" : max(values) if len(values) > 0 else None
+    }
+
+class FleetStats:
+    def __init__(self):
+        self.registered = 0
+        self.register_latency = []
+        self.ack_latency = []
+        self.records_sent = 0
+        self.commands_answered = 0
+        self.errors = 0
+        self.measure_from = 0.0 # `perf_counter` time before which acknowledgements are not measured (warm-up)
+
+class FakeDevice:
+    def __init__(self, url, sn, responses, stats, interval=5.0, records=10):
+        self.url = url
+        self.sn = sn
+        self.responses = responses
+        self.stats = stats
+        self.interval = interval
+        self.records = records
+        self.logindex = 0
+        self.sent = {} # logindex -> send time
+
+    def reply(self, command):
+        reply = dict(self.responses.get(command['cmd'], {"result" : True}))
+        reply.pop("cmd", None)
+        reply['ret'] = command['cmd']
+        reply['sn'] = self.sn
+        return reply
+
+    def sendlog(self):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        record = self.responses['sendlog']['record'][0]
+        message = {
+            "cmd" : "sendlog",
+            "sn" : self.sn,
+            "count" : self.records,
+            "logindex" : self.logindex,
+            "record" : [dict(record, enrollid=random.randint(1, 5000), time=now) for _ in range(self.records)]
+        }
+        self.sent[self.logindex] = time.perf_counter()
+        self.logindex += 1
+        return message
+
+    async def receive(self, websocket):
+        async for frame in websocket:
+            message = json.loads(frame)
+            if message.get("ret") == "sendlog":
+                sent = self.sent.pop(message.get("logindex"), None)
+                if sent is not None and sent >= self.stats.measure_from:
+                    self.stats.ack_latency.append(time.perf_counter() - sent)
+            elif "cmd" in message:
+                await websocket.send(json.dumps(self.reply(message)))
+                self.stats.commands_answered += 1
+
+    async def run(self, duration):
+        deadline = time.perf_counter() + duration
+        try:
+            async with websockets.connect(self.url, ping_interval=None, max_size=None) as websocket:
+                start_time = time.perf_counter()
+                await websocket.send(json.dumps(dict(self.responses['reg'], sn=self.sn)))
+                await websocket.recv()
+                self.stats.register_latency.append(time.perf_counter() - start_time)
+                self.stats.registered += 1
+
+                receiver = asyncio.create_task(self.receive(websocket))
+                await asyncio.sleep(random.uniform(0, self.interval)) # spread the fleet's uploads
+                while time.perf_counter() < deadline and not receiver.done():
+                    if self.records > 0:
+                        await websocket.send(json.dumps(self.sendlog()))
+                        self.stats.records_sent += self.records
+                    await asyncio.sleep(self.interval)
+                receiver.cancel()
+        except Exception:
+            self.stats.errors += 1
+
+def device_sn(prefix, index):
+    return f"{prefix}{index:06d}"
+
+async def run_fleet(url, devices, duration, interval=5.0, records=10, prefix="SIM", stats=None, first=0):
+    stats = stats if stats is not None else FleetStats()
+    responses = load_responses()
+    fleet = [FakeDevice(url, device_sn(prefix, i), responses, stats, interval, records) for i in range(first, first + devices)]
+    await asyncio.gather(*[device.run(duration) for device in fleet])
+    return stats
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Simulated AiFace devices.')
+    parser.add_argument("--url", type=str, default="ws://localhost:7788", help="WebSocket server URL.")
+    parser.add_argument("--devices", type=int, default=10, help="Number of simulated devices.")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between `sendlog` batches of a device.")
+    parser.add_argument("--records", type=int, default=10, help="Records per `sendlog` batch (0 = no uploads).")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to run.")
+    parser.add_argument("--prefix", type=str, default="SIM", help="Serial number prefix of the simulated devices.")
+    parser.add_argument("--first", type=int, default=0, help="Index of the first device (serial numbers `<prefix><index>`).")
+    parser.add_argument("--warmup", type=float, default=0.0, help="Seconds before acknowledgement latencies are measured.")
+    parser.add_argument("--raw", action="store_true", help="Also print every acknowledgement latency (`ack_latency`).")
+    parser.set_defaults(raw=False)
+    args = parser.parse_args()
+
+    stats = FleetStats()
+    stats.measure_from = time.perf_counter() + args.warmup
+    asyncio.run(run_fleet(args.url, args.devices, args.duration, args.interval, args.records, args.prefix, stats, args.first))
+    print(json.dumps(dict({
+        "registered" : stats.registered,
+        "errors" : stats.errors,
+        "records_sent" : stats.records_sent,
+        "commands_answered" : stats.commands_answered,
+        "register_latency" : summarize(stats.register_latency),
+        "sendlog_ack_latency" : summarize(stats.ack_latency)
+    }, **({"ack_latency" : stats.ack_latency} if args.raw else {})), indent=4))
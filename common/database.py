@@ -0,0 +1,231 @@
+"""
+FILE: database.py
+
+DESCRIPTION: MSSQL connection pool, versioned schema of the `sendlog` records table, and the log query used by `/admin/logs`.
+
+NOTES:
+- `migrate()` applies the migrations newer than the version recorded in `<table>_schema`, in one transaction and
+  under an application lock, so several servers starting at once migrate the table only once.
+- Version 1 is the original table (all `VARCHAR(255)`/`INT`, `time` as text). Version 2 rebuilds it with narrow types,
+  `time` as `DATETIME2(0)` and a clustered primary key on (sn, time, id); rows are copied and the old table is kept
+  as `<table>_legacy` (rows whose time cannot be parsed stay there only).
+- Version 3 removes duplicate records (a batch the device sent again) and adds a unique index on
+  (sn, enrollid, time, mode, inout, event) with `IGNORE_DUP_KEY`, so inserting a record that is already stored is a no-op.
+- With `partition_months` > 0 when version 2 is applied, the table is partitioned by month on `time`; partitions for the
+  next `partition_months` months are added at every start.
+- Queries page by key (`after` is the opaque cursor of the last row returned), so every page is an index seek.
+"""
+
+import base64
+import datetime
+import json
+import queue
+
+import pymssql
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+LOG_COLUMNS = ["id", "sn", "enrollid", "aliasid", "name", "time", "mode", "inout", "event"]
+
+class ConnectionPool:
+    def __init__(self, host, user, password, database):
+        self.args = (host, user, password, database)
+        self.idle = queue.LifoQueue()
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return pymssql.connect(*self.args)
+
+    def put(self, conn):
+        self.idle.put(conn)
+
+    # drop a connection that failed
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        while not self.idle.empty():
+            self.discard(self.idle.get_nowait())
+
+# SQL Server errors caused by the values inserted rather than by the connection or the server: conversion (245, 8114),
+# arithmetic overflow (220, 232, 8115), date out of range (241, 242), truncation (2628, 8152), NULL (515), constraint (547)
+DATA_ERRORS = {220, 232, 241, 242, 245, 515, 547, 2628, 8114, 8115, 8152}
+
+# SQL Server error number of a pymssql exception (pymssql wraps `(number, message)`), None if it has none
+def error_number(e):
+    args = e.args[0] if len(e.args) == 1 and isinstance(e.args[0], tuple) else e.args
+    return args[0] if len(args) > 0 and isinstance(args[0], int) else None
+
+# True if retrying the same rows cannot succeed (the rows themselves are rejected)
+def data_error(e):
+    return isinstance(e, (ValueError, TypeError, pymssql.DataError, pymssql.IntegrityError)) or error_number(e) in DATA_ERRORS
+
+def create_legacy_table(cursor, table, partition_months):
+    cursor.execute(f"""
+    IF OBJECT_ID('{table}', 'U') IS NULL
+        CREATE TABLE {table} (
+            cmd VARCHAR(255),
+            sn VARCHAR(255),
+            enrollid INT,
+            aliasid INT,
+            name VARCHAR(255),
+            time VARCHAR(255),
+            mode INT,
+            inout INT,
+            event INT
+        )
+    """)
+
+def month_start(date, months=0):
+    index = date.year * 12 + date.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+def create_partitions(cursor, table, partition_months):
+    today = datetime.date.today()
+    boundaries = ", ".join(f"'{month_start(today, i)}'" for i in range(-36, partition_months + 1))
+    cursor.execute(f"CREATE PARTITION FUNCTION PF_{table} (DATETIME2(0)) AS RANGE RIGHT FOR VALUES ({boundaries})")
+    cursor.execute(f"CREATE PARTITION SCHEME PS_{table} AS PARTITION PF_{table} ALL TO ([PRIMARY])")
+
+def rebuild_indexed_table(cursor, table, partition_months):
+    storage = ""
+    if partition_months > 0:
+        create_partitions(cursor, table, partition_months)
+        storage = f"ON PS_{table} (time)"
+    cursor.execute(f"""
+    CREATE TABLE {table}_v2 (
+        id BIGINT IDENTITY(1, 1) NOT NULL,
+        sn VARCHAR(32) NOT NULL,
+        enrollid INT NOT NULL,
+        aliasid INT NULL,
+        name NVARCHAR(64) NULL,
+        time DATETIME2(0) NOT NULL,
+        mode TINYINT NULL,
+        inout TINYINT NULL,
+        event SMALLINT NULL,
+        CONSTRAINT PK_{table} PRIMARY KEY CLUSTERED (sn, time, id)
+    ) {storage}
+    """)
+    cursor.execute(f"""
+    INSERT INTO {table}_v2 WITH (TABLOCK) (sn, enrollid, aliasid, name, time, mode, inout, event)
+    SELECT sn, enrollid, aliasid, name, TRY_CONVERT(DATETIME2(0), time, 120), mode, inout, event
+    FROM {table}
+    WHERE TRY_CONVERT(DATETIME2(0), time, 120) IS NOT NULL AND sn IS NOT NULL AND enrollid IS NOT NULL
+    ORDER BY sn, TRY_CONVERT(DATETIME2(0), time, 120)
+    """)
+    cursor.execute(f"EXEC sp_rename '{table}', '{table}_legacy'")
+    cursor.execute(f"EXEC sp_rename '{table}_v2', '{table}'")
+    # site-wide time ranges and per-person lookups
+    cursor.execute(f"CREATE INDEX IX_{table}_time ON {table} (time) INCLUDE (enrollid, mode, event)")
+    cursor.execute(f"CREATE INDEX IX_{table}_enrollid ON {table} (enrollid, time)")
+
+def add_unique_index(cursor, table, partition_months):
+    cursor.execute(f"""
+    WITH ranked AS (
+        SELECT ROW_NUMBER() OVER (PARTITION BY sn, enrollid, time, mode, inout, event ORDER BY id) AS n FROM {table}
+    )
+    DELETE FROM ranked WHERE n > 1
+    """)
+    # duplicate rows in an insert are skipped with a warning instead of failing the statement
+    cursor.execute(f"""
+    CREATE UNIQUE INDEX UX_{table}_record ON {table} (sn, enrollid, time, mode, inout, event)
+    WITH (IGNORE_DUP_KEY = ON)
+    """)
+
+# (version, description, function(cursor, table, partition_months))
+MIGRATIONS = [
+    (1, "Original table", create_legacy_table),
+    (2, "Typed columns and clustered index on (sn, time, id)", rebuild_indexed_table),
+    (3, "Unique index on records ignoring duplicates", add_unique_index)
+]
+
+# keep `months` months of empty partitions ahead of today
+def extend_partitions(cursor, table, months):
+    cursor.execute(f"""
+    SELECT MAX(CAST(v.value AS DATETIME2(0))) FROM sys.partition_range_values v
+    JOIN sys.partition_functions f ON v.function_id = f.function_id WHERE f.name = %s
+    """, (f"PF_{table}",))
+    last = cursor.fetchone()[0]
+    if last is None:
+        return
+    boundary = month_start(last.date(), 1)
+    while boundary <= month_start(datetime.date.today(), months):
+        cursor.execute(f"ALTER PARTITION SCHEME PS_{table} NEXT USED [PRIMARY]")
+        cursor.execute(f"ALTER PARTITION FUNCTION PF_{table}() SPLIT RANGE ('{boundary}')")
+        boundary = month_start(boundary, 1)
+
+# returns the schema version of the table after applying the pending migrations
+def migrate(conn, table, partition_months=0):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "EXEC sp_getapplock @Resource = %s, @LockMode = 'Exclusive', @LockOwner = 'Transaction', @LockTimeout = 600000",
+            (f"schema_{table}",)
+        )
+        cursor.execute(f"""
+        IF OBJECT_ID('{table}_schema', 'U') IS NULL
+            CREATE TABLE {table}_schema (
+                version INT NOT NULL PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied DATETIME2(0) NOT NULL DEFAULT SYSUTCDATETIME()
+            )
+        """)
+        cursor.execute(f"SELECT ISNULL(MAX(version), 0) FROM {table}_schema")
+        version = cursor.fetchone()[0]
+        for migration, description, apply in MIGRATIONS:
+            if migration > version:
+                apply(cursor, table, partition_months)
+                cursor.execute(f"INSERT INTO {table}_schema (version, description) VALUES (%d, %s)", (migration, description))
+                version = migration
+        if partition_months > 0:
+            extend_partitions(cursor, table, partition_months)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return version
+
+def encode_cursor(row):
+    position = [row['sn'], row['time'], row['id']]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+# returns (sql, params) of one page of records in (sn, time, id) order
+def log_query(table, sns=None, enrollid=None, start=None, end=None, event=None, mode=None, after=None, limit=1000):
+    conditions, params = [], []
+    if sns:
+        conditions.append(f"sn IN ({', '.join(['%s'] * len(sns))})")
+        params.extend(sns)
+    if enrollid is not None:
+        conditions.append("enrollid = %d")
+        params.append(int(enrollid))
+    if start is not None:
+        conditions.append("time >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("time < %s")
+        params.append(end)
+    if event is not None:
+        conditions.append("event = %d")
+        params.append(int(event))
+    if mode is not None:
+        conditions.append("mode = %d")
+        params.append(int(mode))
+    if after is not None:
+        sn, time, row_id = decode_cursor(after)
+        conditions.append("(sn > %s OR (sn = %s AND (time > %s OR (time = %s AND id > %d))))")
+        params.extend([sn, sn, time, time, int(row_id)])
+    where = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+    sql = f"SELECT TOP {int(limit)} {', '.join(LOG_COLUMNS)} FROM {table} {where} ORDER BY sn, time, id"
+    return sql, tuple(params)
+
+def log_row(row):
+    record = dict(zip(LOG_COLUMNS, row))
+    if isinstance(record['time'], datetime.datetime):
+        record['time'] = record['time'].strftime(TIME_FORMAT)
+    return record
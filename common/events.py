@@ -0,0 +1,145 @@
+"""
+FILE: events.py
+
+DESCRIPTION: Device events (`reg` and `sendlog` records) in a capped Redis Stream per site, and a consumer for downstream services.
+
+NOTES:
+- The WebSocket app appends one entry per `sendlog` record and one per `reg` to `<prefix>_EVENTS_<site>`,
+  all entries of a message in one round trip. The stream is trimmed to about `EVENTS_MAXLEN` entries.
+- Entries have the fields `type` (`reg` or `sendlog`), `sn`, `time` (UNIX time received) and `data` (JSON: the record, or the device info).
+- Consumers in a group share the events; each event is delivered to one consumer of the group and stays pending until acknowledged.
+  A consumer that restarts first receives its unacknowledged events again.
+- Usage: `python events.py --group dashboard --consumer host1` prints events as JSON lines and acknowledges them;
+  `--replay <id>` prints the events after that ID instead.
+"""
+
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+# fields of the stream entries for one message from a device (none if it carries no events)
+def message_events(message, received=None):
+    received = round(received if received is not None else time.time(), 3)
+    if message.get('cmd') == 'reg':
+        return [{"type" : "reg", "sn" : message['sn'], "time" : received, "data" : json.dumps(message.get('devinfo', {}))}]
+    if message.get('cmd') == 'sendlog':
+        return [
+            {"type" : "sendlog", "sn" : message['sn'], "time" : received, "data" : json.dumps(record)}
+            for record in message.get('record', [])[:message.get('count', 0)]
+        ]
+    return []
+
+# append the events of a message in one round trip (`r_db` is a `redis.asyncio` client)
+async def publish_events(r_db, stream, message, maxlen):
+    events = message_events(message)
+    if len(events) == 0:
+        return
+    async with r_db.pipeline(transaction=False) as pipe:
+        for event in events:
+            pipe.xadd(stream, event, maxlen=maxlen, approximate=True)
+        await pipe.execute()
+
+# (id, event) of a stream entry as returned by redis-py
+def decode_event(entry_id, fields):
+    fields = {k.decode() if isinstance(k, bytes) else k : v.decode() if isinstance(v, bytes) else v for k, v in fields.items()}
+    return (entry_id.decode() if isinstance(entry_id, bytes) else entry_id), {
+        "type" : fields.get('type'),
+        "sn" : fields.get('sn'),
+        "time" : float(fields.get('time', 0)),
+        "data" : json.loads(fields.get('data', "null"))
+    }
+
+# one Server-Sent Events frame; clients resume with the `id` of the last frame they received (`Last-Event-ID`)
+def format_sse(entry_id, event):
+    return f"id: {entry_id}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+# (position, text) for the result of an `XREAD` of one stream: the frames of the events of `sns` (all devices if empty),
+# or a comment line if the read timed out, which keeps idle connections open through proxies
+def stream_frames(entries, position, sns):
+    if not entries:
+        return position, ": keep-alive\n\n"
+    frames = []
+    for entry_id, fields in entries[0][1]:
+        position, event = decode_event(entry_id, fields)
+        if len(sns) == 0 or event['sn'] in sns:
+            frames.append(format_sse(position, event))
+    return position, "".join(frames)
+
+class EventConsumer:
+    def __init__(self, r, keys, site, group, consumer, count=100, block=5000):
+        self.r = r
+        self.stream = keys.events(site)
+        self.group = group
+        self.consumer = consumer
+        self.count = count
+        self.block = block
+        self.backlog = True # deliver the events left unacknowledged by a previous run first
+
+    # `start` is the first ID delivered to a new group: "$" for new events only, "0" for the whole stream
+    def create_group(self, start="$"):
+        try:
+            self.r.xgroup_create(self.stream, self.group, id=start, mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    # returns [(id, event)]; waits up to `block` milliseconds for new events
+    def read(self):
+        entries = self.r.xreadgroup(
+            self.group, self.consumer, {self.stream : "0" if self.backlog else ">"},
+            count=self.count, block=None if self.backlog else self.block
+        )
+        entries = [entry for _, stream in entries for entry in stream]
+        self.ack([entry_id for entry_id, fields in entries if not fields]) # trimmed from the stream before they were acknowledged
+        if self.backlog and len(entries) == 0:
+            self.backlog = False
+        return [decode_event(entry_id, fields) for entry_id, fields in entries if fields]
+
+    def ack(self, ids):
+        if len(ids) > 0:
+            self.r.xack(self.stream, self.group, *ids)
+
+    # take over events another consumer of the group received but did not acknowledge within `idle` milliseconds
+    def claim(self, idle=60000):
+        _, entries, _ = self.r.xautoclaim(self.stream, self.group, self.consumer, idle, start_id="0-0", count=self.count)
+        return [decode_event(entry_id, fields) for entry_id, fields in entries if fields]
+
+    # events after `start` (exclusive), independent of the group
+    def replay(self, start, count=1000):
+        while True:
+            entries = self.r.xrange(self.stream, min=f"({start}", count=count)
+            if len(entries) == 0:
+                return
+            for entry_id, fields in entries:
+                start, event = decode_event(entry_id, fields)
+                yield start, event
+
+if __name__ == "__main__":
+    import redis
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from common.protocol import RedisKeys
+
+    parser = ArgumentParser(description='Consume device events from the Redis stream.')
+    parser.add_argument("--site", type=str, default=os.getenv("SITE_ID", "default"), help="Site of the stream.")
+    parser.add_argument("--group", type=str, default="cli", help="Consumer group.")
+    parser.add_argument("--consumer", type=str, default="cli", help="Consumer name within the group.")
+    parser.add_argument("--start", type=str, default="$", help="First ID delivered to a new group ($ = new events only).")
+    parser.add_argument("--replay", type=str, default=None, help="Print the events after this ID and exit.")
+    args = parser.parse_args()
+
+    r = redis.Redis(host=os.getenv("REDIS_IP"), port=int(os.getenv("REDIS_PORT")), db=0)
+    keys = RedisKeys(os.getenv("REDIS_DB_PREFIX"), os.getenv("REDIS_OUT_KEY"), os.getenv("REDIS_IN_KEY"))
+    consumer = EventConsumer(r, keys, args.site, args.group, args.consumer)
+    if args.replay is not None:
+        for entry_id, event in consumer.replay(args.replay):
+            print(json.dumps(dict(event, id=entry_id)))
+    else:
+        consumer.create_group(args.start)
+        while True:
+            events = consumer.read()
+            for entry_id, event in events:
+                print(json.dumps(dict(event, id=entry_id)), flush=True)
+            consumer.ack([entry_id for entry_id, _ in events])
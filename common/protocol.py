@@ -0,0 +1,113 @@
+"""
+FILE: protocol.py
+
+DESCRIPTION: Redis key names shared by the WebSocket and HTTP applications.
+
+NOTES:
+- Both applications must be started with the same `REDIS_DB_PREFIX`, `REDIS_OUT_KEY` and `REDIS_IN_KEY`.
+- Commands in the `OUT` list are wrapped in an envelope carrying a correlation ID and the key the device's reply is pushed to.
+  Bare commands (without an envelope) are still accepted; their replies go to the device's `IN` list.
+- Each WebSocket server process (instance) listens on its own inbox channel. Pushers publish the serial number of a
+  device on the inbox of the instance that owns it (the `instance` field of its presence hash), or on the shared notify
+  channel if no instance owns it (see `common/queues.py`).
+- Commands sent by the asynchronous HTTP gateway also carry the gateway's reply channel; the device's reply is then
+  published on that channel (`pack_reply`) instead of being pushed to the reply key.
+"""
+
+import json
+import uuid
+
+# commands known to AiFace devices (sent by the device, or sent to it and answered with the same `ret`)
+COMMANDS = (
+    "reg", "sendlog", "senduser", "getuserlist", "getalluser", "getuserinfo", "setuserinfo", "deleteuser",
+    "getusername", "setusername", "enableuser", "cleanuser", "cleanadmin", "getnewlog", "getalllog", "cleanlog",
+    "initsys", "reboot", "settime", "opendoor", "getdevinfo", "setdevinfo", "getdevlock", "setdevlock",
+    "getuserlock", "setuserlock", "deleteuserlock", "cleanuserlock"
+)
+
+class RedisKeys:
+    def __init__(self, prefix, out_key, in_key):
+        self.prefix = prefix
+        self.out_key = out_key
+        self.in_key = in_key
+
+    # list of commands waiting to be sent to the device (its interactive lane, see common/queues.py)
+    def outgoing(self, sn):
+        return f"{self.prefix}_{sn}_{self.out_key}"
+
+    # list of responses received from the device
+    def incoming(self, sn):
+        return f"{self.prefix}_{sn}_{self.in_key}"
+
+    # channel on which pushers publish the serial number of a device with new outgoing commands
+    def notify(self):
+        return f"{self.prefix}_{self.out_key}"
+
+    # channel of the WebSocket server instance owning a device, on which pushers publish its serial number
+    def inbox(self, instance):
+        return f"{self.prefix}_{self.out_key}_{instance}"
+
+    # channel on which an instance is told that one of its devices has reconnected to another instance
+    def takeover(self, instance):
+        return f"{self.prefix}_TAKEOVER_{instance}"
+
+    # hash describing a connected device (see ws/presence.py)
+    def presence(self, sn):
+        return f"{self.prefix}_DEVICE_{sn}"
+
+    # sorted set of connected devices, scored by their last heartbeat
+    def devices(self):
+        return f"{self.prefix}_DEVICES"
+
+    # hash of cached replies to read-only commands sent to a device (see flask/cache.py)
+    def cache(self, sn):
+        return f"{self.prefix}_CACHE_{sn}"
+
+    # hash of the users every device should have, by `enrollid` (see flask/roster.py)
+    def roster(self):
+        return f"{self.prefix}_ROSTER"
+
+    # hash of the digests of the users last written to a device, by `enrollid`
+    def roster_device(self, sn):
+        return f"{self.prefix}_ROSTER_{sn}"
+
+    # hash of the highest `logindex` received from each device (see ws/logindex.py)
+    def logindex(self):
+        return f"{self.prefix}_LOGINDEX"
+
+    # capped stream of the `reg` and `sendlog` events of a site (see common/events.py)
+    def events(self, site):
+        return f"{self.prefix}_EVENTS_{site}"
+
+    # list holding the reply to a single command
+    def reply(self, command_id):
+        return f"{self.prefix}_{self.in_key}_{command_id}"
+
+    # channel on which replies to the commands sent by an HTTP gateway process are published (see flask/gateway.py)
+    def gateway(self, instance):
+        return f"{self.prefix}_{self.in_key}_GATEWAY_{instance}"
+
+def new_command_id():
+    return uuid.uuid4().hex
+
+# `expires` (UNIX time) drops the command if it has not been sent to the device by then
+def pack_command(data, command_id=None, reply=None, timeout=None, expires=None, channel=None):
+    if command_id is None:
+        return json.dumps(data)
+    return json.dumps({"id" : command_id, "reply" : reply, "timeout" : timeout, "expires" : expires, "channel" : channel, "data" : data})
+
+# returns (envelope, command); the envelope is None for bare commands
+def unpack_command(raw):
+    message = json.loads(raw)
+    if "data" in message.keys() and "cmd" not in message.keys():
+        return message, message['data']
+    return None, message
+
+# a reply published on a gateway channel: the reply key of the command, then the device's message
+def pack_reply(reply, raw):
+    return f"{reply}\n{raw.decode() if isinstance(raw, bytes) else raw}"
+
+# returns (reply key, message)
+def unpack_reply(data):
+    reply, raw = (data.decode() if isinstance(data, bytes) else data).split("\n", 1)
+    return reply, json.loads(raw)
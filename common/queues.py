@@ -0,0 +1,80 @@
+"""
+FILE: queues.py
+
+DESCRIPTION: Outgoing command queues of the devices in Redis, with two priority lanes, expiry and a maximum depth.
+
+NOTES:
+- Each device has an interactive lane (`<prefix>_<sn>_<OUT>`, which also takes bare commands pushed by hand) and a bulk
+  lane (`<prefix>_<sn>_<OUT>_BULK`, e.g., roster synchronisation). A command in the bulk lane is only sent when the
+  interactive lane is empty, so a large backlog never delays an `opendoor`.
+- Commands are queued with `ENQUEUE_SCRIPT`, which rejects them once the lane holds `max_depth` commands (0 = no limit)
+  and tells the WebSocket server instance owning the device (see `common/protocol.py`), in one round trip.
+- The WebSocket server takes the next command with `DEQUEUE_SCRIPT`, which pops from the interactive lane first and
+  drops the commands whose envelope has expired (`expires`, UNIX time) on the way, in one round trip.
+- Callers that stop waiting withdraw their command with `withdraw_command`, which removes that command only.
+"""
+
+LANES = ("interactive", "bulk")
+
+# queue a command unless its lane is full and notify the instance owning the device (or every instance if the device
+# is not connected); returns 1 if the command was queued, 0 if the lane is full
+ENQUEUE_SCRIPT = """
+local depth = tonumber(ARGV[5])
+if depth > 0 and redis.call('LLEN', KEYS[1]) >= depth then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+local owner = redis.call('HGET', KEYS[2], 'instance')
+if owner then
+    redis.call('PUBLISH', ARGV[3] .. owner, ARGV[2])
+else
+    redis.call('PUBLISH', ARGV[4], ARGV[2])
+end
+return 1
+"""
+
+# pop the first command that has not expired, interactive lane first; returns {expired commands dropped, command}
+DEQUEUE_SCRIPT = """
+local dropped = 0
+for _, lane in ipairs(KEYS) do
+    while true do
+        local item = redis.call('LPOP', lane)
+        if not item then
+            break
+        end
+        local ok, command = pcall(cjson.decode, item)
+        local expires = ok and type(command) == 'table' and command['expires']
+        if type(expires) ~= 'number' or expires >= tonumber(ARGV[1]) then
+            return {dropped, item}
+        end
+        dropped = dropped + 1
+    end
+end
+return {dropped}
+"""
+
+class QueueFull(Exception):
+    pass
+
+# key of one lane of a device's queue
+def lane_key(keys, sn, bulk=False):
+    return f"{keys.outgoing(sn)}_BULK" if bulk else keys.outgoing(sn)
+
+def lane_keys(keys, sn):
+    return [lane_key(keys, sn), lane_key(keys, sn, True)]
+
+# arguments of `ENQUEUE_SCRIPT` for a command to a device
+def enqueue_command(keys, sn, payload, bulk=False, max_depth=0):
+    return {
+        "keys" : [lane_key(keys, sn, bulk), keys.presence(sn)],
+        "args" : [payload, sn, keys.inbox(""), keys.notify(), int(max_depth)]
+    }
+
+# arguments of `DEQUEUE_SCRIPT` for the next command to a device
+def dequeue_command(keys, sn, now):
+    return {"keys" : lane_keys(keys, sn), "args" : [now]}
+
+# remove a command that was not sent yet from whichever lane holds it (`r` may be a pipeline)
+def withdraw_command(r, keys, sn, payload):
+    for key in lane_keys(keys, sn):
+        r.lrem(key, 1, payload)
@@ -4,74 +4,360 @@ FILE: app_http.py
 DESCRIPTION: HTTP server for sending commands to and receiving responses from AiFace device.
 
 NOTES:
-- This app only interacts with the Redis database.
+- This app only interacts with the Redis database, except `/admin/logs`, which reads the `sendlog` records from the
+  MSSQL database (see `common/database.py`).
 - Redis database should contain two keys for `OUT` (sending to device) and `IN` (receiving from device) (WIP).
-
-KNOWN ISSUES:
-- Multiple HTTP calls to the same endpoint, to the same device (i.e., same Redis key), and at the same time may result in incorrect return responses.
-    - Possible solution: Use a queue to ensure that only one HTTP call is processed at a time.
+- Each pushed command carries a correlation ID; the WebSocket app pushes the device's reply to a key owned by that HTTP call only.
+  Calls are therefore processed in parallel, including calls to the same device.
+- Commands are announced to the WebSocket server process that owns the device only (see `common/protocol.py`).
+- Commands are queued in the device's interactive lane, or in its bulk lane with `"bulk" : true`; a command is rejected
+  with status 429 when its lane is full, and dropped unsent once the caller stopped waiting (see `common/queues.py`).
+- Replies to read-only commands are cached in Redis (see `cache.py`); add `"cache" : false` to a command to bypass the cache.
+- `/admin/events` streams the site's device events (see `common/events.py`) as Server-Sent Events.
+- The rules of `/admin/push` are shared with the gateway (see `push.py`).
+- `/admin/push` latencies and device timeouts are served in the Prometheus text format at `GET /metrics`.
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 import redis
 import json
-from threading import Lock
 import time
 from argparse import ArgumentParser
 import os
+import sys
+import datetime
+import binascii
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.protocol import RedisKeys, new_command_id, pack_command
+from common.queues import enqueue_command, withdraw_command, ENQUEUE_SCRIPT, QueueFull
+from common.metrics import REGISTRY, Counter
+from common.events import stream_frames
+from common.database import ConnectionPool, log_query, log_row, encode_cursor, TIME_FORMAT
+from cache import ResponseCache
+from push import run_push
 
 app = Flask(__name__)
-lock = Lock()
+
+# commands whose replies are split into pages (`stn` = true for the first page, false for the next ones)
+PAGED_COMMANDS = {"getuserlist", "getalluser", "getalllog", "getnewlog"}
+
+DEVICE_TIMEOUTS = Counter("face_http_device_timeouts_total", "Commands a device did not answer in time.", ["sn"])
 
 @app.route("/", methods=["GET"])
 def index():
     return "wassup"
 
+def authorized():
+    header = request.headers.get("Authorization", "").split()
+    return len(header) == 2 and header[1] == AUTHORIZATION_KEY
+
+# serial numbers of the given devices that are connected to a WebSocket server
+def online(r, sns):
+    pipe = r.pipeline(transaction=False)
+    for sn in sns:
+        pipe.exists(KEYS.presence(sn))
+    return {sn for sn, exists in zip(sns, pipe.execute()) if exists}
+
+# queue commands (each with its own `sn`) in one round trip; returns (sn, reply key, payload) per queued command and
+# the serial numbers of the devices whose lane was full. Commands expire when the caller stops waiting, unless `expires` is given
+def dispatch(r, commands, timeout, expires=None, bulk=False):
+    sent = []
+    pipe = r.pipeline(transaction=False)
+    for data in commands:
+        command_id = new_command_id()
+        reply_key = KEYS.reply(command_id)
+        payload = pack_command(data, command_id, reply_key, timeout, expires if expires is not None else time.time() + timeout)
+        ENQUEUE(**enqueue_command(KEYS, data['sn'], payload, bulk, OUTGOING_MAX_BULK_DEPTH if bulk else OUTGOING_MAX_DEPTH), client=pipe)
+        sent.append((data['sn'], reply_key, payload))
+    queued = pipe.execute()
+
+    return [command for command, ok in zip(sent, queued) if ok == 1], [command[0] for command, ok in zip(sent, queued) if ok != 1]
+
+# queue a single command; raises `QueueFull` if its lane is full
+def dispatch_one(r, data, timeout, expires=None, bulk=False):
+    sent, full = dispatch(r, [data], timeout, expires, bulk)
+    if len(full) > 0:
+        raise QueueFull("Device queue full.")
+    return sent
+
+# yields (sn, response, latency) as replies arrive; devices that do not reply in time are yielded last with `None`
+def wait_replies(r, sent, timeout):
+    start_time = time.monotonic()
+    waiting = {reply_key : (sn, payload) for sn, reply_key, payload in sent}
+    try:
+        while len(waiting) > 0:
+            remaining = timeout - (time.monotonic() - start_time)
+            if remaining <= 0:
+                break
+            popped = r.blpop(list(waiting.keys()), timeout=remaining)
+            if popped is None:
+                break
+            sn, _ = waiting.pop(popped[0].decode())
+            yield sn, json.loads(popped[1]), time.monotonic() - start_time
+    finally:
+        # withdraw the commands that were never sent
+        if len(waiting) > 0:
+            pipe = r.pipeline(transaction=False)
+            for sn, payload in waiting.values():
+                withdraw_command(pipe, KEYS, sn, payload)
+            pipe.execute()
+    for sn, _ in waiting.values():
+        DEVICE_TIMEOUTS.labels(sn).inc()
+        yield sn, None, time.monotonic() - start_time
+
+# wait for the reply to a single dispatched command (None on timeout)
+def wait_reply(r, sent):
+    for _, response, _ in wait_replies(r, sent, WAIT_RESPONSE_TIMEOUT):
+        return response
+
+# send one command and wait for its reply (None on timeout)
+def request_device(r, data, bulk=False):
+    return wait_reply(r, dispatch_one(r, data, WAIT_RESPONSE_TIMEOUT, bulk=bulk))
+
+# yields the pages of a paged transfer in order; the next page is requested as soon as the previous one arrives
+def request_pages(r, data):
+    sent = dispatch_one(r, dict(data, stn=True), WAIT_RESPONSE_TIMEOUT)
+    while True:
+        page = wait_reply(r, sent)
+        if page is None:
+            raise Exception("No response.")
+        last = page.get("result", False) is not True or len(page.get("record", [])) == 0 or page.get("to", 0) >= page.get("count", 0)
+        if not last:
+            sent = dispatch_one(r, dict(data, stn=False), WAIT_RESPONSE_TIMEOUT)
+        yield page
+        if last:
+            return
+
+# returns (response, cache status); identical reads in flight share a single device round trip
+def request_cached(r, data):
+    response = CACHE.get(r, data)
+    if response is not None:
+        return response, "HIT"
+
+    reply_key = KEYS.reply(new_command_id())
+    leader, generation = CACHE.lead(r, data, reply_key, WAIT_RESPONSE_TIMEOUT)
+    if not leader:
+        response = CACHE.get(r, data) # the leader may have finished before this call was registered
+        if response is not None:
+            return response, "HIT"
+        popped = r.blpop(reply_key, timeout=WAIT_RESPONSE_TIMEOUT)
+        return (json.loads(popped[1]) if popped is not None else None), "COALESCED"
+
+    response = None
+    try:
+        response = request_device(r, data)
+    finally:
+        CACHE.release(r, data, generation, response, WAIT_RESPONSE_TIMEOUT)
+    return response, "MISS"
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/admin/push", methods=["POST"])
 def push():
-    if request.headers.get("Authorization").split()[1] != AUTHORIZATION_KEY:
+    if not authorized():
+        return jsonify({"status" : "Incorrect authorization."}), 401
+
+    r = redis.Redis(connection_pool=REDIS_POOL)
+    status, body, headers = run_push(request.get_json(), CACHE, PRESENCE_QUEUE_TTL, {
+        "online" : lambda sn: len(online(r, [sn])) > 0,
+        "invalidate" : lambda sn: CACHE.invalidate(r, [sn]),
+        "dispatch" : lambda data, expires, bulk: dispatch_one(r, data, WAIT_RESPONSE_TIMEOUT, expires, bulk),
+        "request" : lambda data, bulk: request_device(r, data, bulk),
+        "request_cached" : lambda data: request_cached(r, data)
+    })
+    return jsonify(body), status, headers or {}
+
+@app.route("/admin/push/batch", methods=["POST"])
+def push_batch():
+    if not authorized():
         return jsonify({"status" : "Incorrect authorization."}), 401
 
     data = request.get_json()
-    if data is None or data == {} or not "sn" in data.keys() or not "cmd" in data.keys():
+    if data is None or not "sn" in data.keys() or not "cmd" in data.keys() or not (data['sn'] == "all" or isinstance(data['sn'], list)):
         return jsonify({"status" : "Incomplete or incorrect data."}), 400
+
+    r = redis.Redis(connection_pool=REDIS_POOL)
+    if data['sn'] == "all":
+        sns = sorted(sn.decode() for sn in r.zrangebyscore(KEYS.devices(), time.time() - PRESENCE_TTL, "+inf"))
     else:
-        # Lock to ensure that only one HTTP call is processed at a time.
-        while lock.locked():
-            time.sleep(LOCK_TIMEOUT)
-        lock.acquire()
+        sns = list(dict.fromkeys(str(sn) for sn in data['sn']))
+    timeout = float(data.get("timeout", WAIT_RESPONSE_TIMEOUT))
+    command = {k : v for k, v in data.items() if k not in ("sn", "timeout", "stream", "bulk")}
+
+    def results():
+        connected = online(r, sns)
+        for sn in sns:
+            if sn not in connected:
+                yield {"sn" : sn, "status" : "Device offline."}
+        mutates = CACHE.mutates(command) and len(connected) > 0
+        if mutates:
+            CACHE.invalidate(r, connected)
+        sent, full = dispatch(r, [dict(command, sn=sn) for sn in sns if sn in connected], timeout, bulk=data.get("bulk", False))
+        for sn in full:
+            yield {"sn" : sn, "status" : "Device queue full."}
+        if command['cmd'] == 'reboot':
+            for sn, _, _ in sent:
+                yield {"sn" : sn, "status" : "No response."}
+            return
+        try:
+            for sn, response, latency in wait_replies(r, sent, timeout):
+                if response is not None:
+                    yield {"sn" : sn, "status" : "ok", "latency" : round(latency * 1000, 1), "response" : response}
+                else:
+                    yield {"sn" : sn, "status" : "No response.", "latency" : round(latency * 1000, 1)}
+        finally:
+            if mutates:
+                CACHE.invalidate(r, connected)
+
+    # stream one JSON line per device as soon as it replies
+    if data.get("stream", False):
+        return Response(stream_with_context(json.dumps(result) + "\n" for result in results()), mimetype="application/x-ndjson")
+
+    try:
+        collected = list(results())
+    except Exception as e:
+        return jsonify({"status" : f"{str(e)}"}), 500
+    return jsonify({
+        "count" : len(collected),
+        "ok" : sum(1 for result in collected if result['status'] == "ok"),
+        "results" : collected
+    }), 200
+
+@app.route("/admin/export", methods=["POST"])
+def export():
+    if not authorized():
+        return jsonify({"status" : "Incorrect authorization."}), 401
+
+    data = request.get_json()
+    if data is None or not "sn" in data.keys() or not "cmd" in data.keys() or data['cmd'] not in PAGED_COMMANDS:
+        return jsonify({"status" : "Incomplete or incorrect data."}), 400
 
-        outgoing_key = f"{REDIS_DB_PREFIX}_{data['sn']}_{REDIS_OUTGOING_KEY}"
+    r = redis.Redis(connection_pool=REDIS_POOL)
+    if len(online(r, [data['sn']])) == 0:
+        return jsonify({"status" : "Device offline."}), 404
+    command = {k : v for k, v in data.items() if k != "stn"}
+
+    # one record per line; a final line with a `status` key reports a transfer that did not complete
+    def records():
+        received = 0
         try:
-            # dump data to Redis
-            r = redis.Redis(host=REDIS_IP, port=REDIS_PORT, db=0)
-            r.rpush(outgoing_key, json.dumps(data))
-
-            # wait for response
-            start_time = time.time()
-            while True:
-                response = r.lpop(f"{REDIS_DB_PREFIX}_{data['sn']}_{REDIS_INCOMING_KEY}")
-                if data['cmd'] == 'reboot':
-                    response = '{"status" : "No response."}'
-                if response is not None or time.time() - start_time >= WAIT_RESPONSE_TIMEOUT:
-                    break
-
-            if response is not None:
-                return jsonify(json.loads(response)), 200
-            else:
-                raise Exception("No response.")
+            for page in request_pages(r, command):
+                if page.get("result", False) is not True:
+                    yield json.dumps({"status" : "Device error.", "received" : received, "response" : page}) + "\n"
+                    return
+                for record in page.get("record", []):
+                    yield json.dumps(record) + "\n"
+                received += len(page.get("record", []))
         except Exception as e:
-            status_str = f"{str(e)}"
-            r.delete(outgoing_key)
+            yield json.dumps({"status" : f"{str(e)}", "received" : received}) + "\n"
+
+    return Response(stream_with_context(records()), mimetype="application/x-ndjson")
+
+# ID of the newest event in a stream ("0-0" if it is empty); new events are the ones after it
+def last_event_id(r, stream):
+    entries = r.xrevrange(stream, count=1)
+    return entries[0][0].decode() if len(entries) > 0 else "0-0"
+
+@app.route("/admin/events", methods=["GET"])
+def events():
+    if not authorized():
+        return jsonify({"status" : "Incorrect authorization."}), 401
+
+    r = redis.Redis(connection_pool=REDIS_POOL)
+    stream = KEYS.events(request.args.get("site", SITE_ID))
+    sns = set(request.args.getlist("sn"))
+    start = request.headers.get("Last-Event-ID") or request.args.get("last_id") or last_event_id(r, stream)
+
+    def frames():
+        position = start
+        while True:
+            position, text = stream_frames(r.xread({stream : position}, count=100, block=EVENTS_KEEPALIVE * 1000), position, sns)
+            if text:
+                yield text
+
+    return Response(stream_with_context(frames()), mimetype="text/event-stream", headers={"Cache-Control" : "no-cache", "X-Accel-Buffering" : "no"})
 
-            return jsonify({"status" : status_str}), 500
+# "YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS" (None if absent); raises ValueError otherwise
+def query_time(value):
+    if value is None:
+        return None
+    return datetime.datetime.fromisoformat(value).strftime(TIME_FORMAT)
+
+@app.route("/admin/logs", methods=["GET"])
+def logs():
+    if not authorized():
+        return jsonify({"status" : "Incorrect authorization."}), 401
+    if LOG_POOL is None:
+        return jsonify({"status" : "No database configured."}), 503
+
+    args = request.args
+    try:
+        limit = max(1, min(int(args.get("limit", LOGS_PAGE_SIZE)), LOGS_MAX_PAGE_SIZE))
+        sql, params = log_query(
+            MSSQL_TABLE, sns=args.getlist("sn"), enrollid=args.get("enrollid"), start=query_time(args.get("start")),
+            end=query_time(args.get("end")), event=args.get("event"), mode=args.get("mode"), after=args.get("after"), limit=limit
+        )
+    except (ValueError, TypeError, binascii.Error):
+        return jsonify({"status" : "Incomplete or incorrect data."}), 400
+
+    try:
+        conn = LOG_POOL.get()
+    except Exception as e:
+        return jsonify({"status" : f"{str(e)}"}), 500
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+    except Exception as e:
+        LOG_POOL.discard(conn)
+        return jsonify({"status" : f"{str(e)}"}), 500
+
+    # one record per line; a full page ends with a line holding the cursor (`after`) of the next page
+    def records():
+        count, last, complete = 0, None, False
+        try:
+            for row in cursor:
+                last = log_row(row)
+                count += 1
+                yield json.dumps(last) + "\n"
+            if count == limit:
+                yield json.dumps({"next" : encode_cursor(last)}) + "\n"
+            complete = True
+        except Exception as e:
+            yield json.dumps({"status" : f"{str(e)}", "received" : count}) + "\n"
         finally:
-            lock.release()
-    
-if __name__ == "__main__":
-    parser = ArgumentParser(description='HTTP server for AiFace device.')
-    parser.add_argument("--env", type=str, default="../.env", help="Config stored in an environment file.")
-    args = parser.parse_args()
+            if complete:
+                LOG_POOL.put(conn)
+            else: # results left unread on the connection
+                LOG_POOL.discard(conn)
+
+    return Response(stream_with_context(records()), mimetype="application/x-ndjson")
+
+@app.route("/admin/devices", methods=["GET"])
+def devices():
+    if not authorized():
+        return jsonify({"status" : "Incorrect authorization."}), 401
+
+    r = redis.Redis(connection_pool=REDIS_POOL)
+    sns = sorted(sn.decode() for sn in r.zrangebyscore(KEYS.devices(), time.time() - PRESENCE_TTL, "+inf"))
+    pipe = r.pipeline(transaction=False)
+    for sn in sns:
+        pipe.hgetall(KEYS.presence(sn))
+    listing = []
+    for info in pipe.execute():
+        if len(info) > 0: # expired since the listing was read
+            listing.append({k.decode() : v.decode() for k, v in info.items()})
+
+    return jsonify({"count" : len(listing), "devices" : listing}), 200
+
+# read the configuration from the environment (also used by `gateway.py`)
+def configure():
+    global FLASK_IP, FLASK_PORT, REDIS_IP, REDIS_PORT, REDIS_DB_PREFIX, REDIS_OUTGOING_KEY, REDIS_INCOMING_KEY, KEYS
+    global AUTHORIZATION_KEY, WAIT_RESPONSE_TIMEOUT, PRESENCE_TTL, PRESENCE_QUEUE_TTL, REDIS_POOL, ENQUEUE, CACHE
+    global OUTGOING_MAX_DEPTH, OUTGOING_MAX_BULK_DEPTH
+    global SITE_ID, EVENTS_KEEPALIVE, MSSQL_TABLE, LOG_POOL, LOGS_PAGE_SIZE, LOGS_MAX_PAGE_SIZE
 
     FLASK_IP = os.getenv("FLASK_IP")
     FLASK_PORT = int(os.getenv("FLASK_PORT"))
@@ -80,8 +366,29 @@ if __name__ == "__main__":
     REDIS_DB_PREFIX = os.getenv("REDIS_DB_PREFIX")
     REDIS_OUTGOING_KEY = os.getenv("REDIS_OUT_KEY")
     REDIS_INCOMING_KEY = os.getenv("REDIS_IN_KEY")
+    KEYS = RedisKeys(REDIS_DB_PREFIX, REDIS_OUTGOING_KEY, REDIS_INCOMING_KEY)
     AUTHORIZATION_KEY = os.getenv("FLASK_AUTHORIZATION_KEY")
-    LOCK_TIMEOUT = int(os.getenv("TIMEOUT_HTTP_LOCK"))
     WAIT_RESPONSE_TIMEOUT = int(os.getenv("TIMEOUT_HTTP_WAIT_RESPONSE"))
+    PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "90"))
+    PRESENCE_QUEUE_TTL = int(os.getenv("PRESENCE_QUEUE_TTL", "300"))
+    OUTGOING_MAX_DEPTH = int(os.getenv("OUTGOING_MAX_DEPTH", "100"))
+    OUTGOING_MAX_BULK_DEPTH = int(os.getenv("OUTGOING_MAX_BULK_DEPTH", "10000"))
+    SITE_ID = os.getenv("SITE_ID", "default")
+    EVENTS_KEEPALIVE = int(os.getenv("EVENTS_KEEPALIVE", "15"))
+    MSSQL_TABLE = os.getenv("MSSQL_TABL")
+    LOG_POOL = None
+    if os.getenv("MSSQL_HOST"):
+        LOG_POOL = ConnectionPool(os.getenv("MSSQL_HOST"), os.getenv("MSSQL_USER"), os.getenv("MSSQL_PASS"), os.getenv("MSSQL_DATA"))
+    LOGS_PAGE_SIZE = int(os.getenv("LOGS_PAGE_SIZE", "1000"))
+    LOGS_MAX_PAGE_SIZE = int(os.getenv("LOGS_MAX_PAGE_SIZE", "10000"))
+    REDIS_POOL = redis.ConnectionPool(host=REDIS_IP, port=REDIS_PORT, db=0)
+    ENQUEUE = redis.Redis(connection_pool=REDIS_POOL).register_script(ENQUEUE_SCRIPT)
+    CACHE = ResponseCache(KEYS)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='HTTP server for AiFace device.')
+    parser.add_argument("--env", type=str, default="../.env", help="Config stored in an environment file.")
+    args = parser.parse_args()
 
+    configure()
     app.run(host=FLASK_IP, port=FLASK_PORT, debug=True)
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+FILE: cache.py
+
+DESCRIPTION: Cache in Redis of the replies to read-only device commands, shared by all HTTP workers.
+
+NOTES:
+- Replies are stored per device in a hash (`<prefix>_CACHE_<sn>`) under the command and a digest of its arguments,
+  together with the time they expire (`READ_TTLS`, in seconds). Only successful replies are cached.
+- Sending a mutating command (`MUTATING`) to a device deletes its hash and bumps its generation, so that a read
+  started before the mutation cannot store its (stale) reply afterwards.
+- Concurrent identical reads are coalesced: the first caller sends the command and hands its reply to the others,
+  which wait on their own reply keys (or, in the asynchronous gateway, on the gateway's reply channel).
+- `AsyncResponseCache` is the same cache for `redis.asyncio` clients (see `gateway.py`).
+"""
+
+import json
+import hashlib
+import time
+
+# paged commands (`getuserlist`, `getalluser`, ...) are not cached: a page depends on the device's paging position (`stn`)
+READ_TTLS = {
+    "getdevinfo" : 60,
+    "getdevlock" : 60,
+    "getuserinfo" : 60,
+    "getusername" : 300,
+    "getuserlock" : 60
+}
+
+MUTATING = {
+    "setuserinfo", "setusername", "enableuser", "deleteuser", "setuserlock",
+    "setdevinfo", "setdevlock", "cleanlog", "cleanuser", "cleanadmin", "initsys"
+}
+
+# keys that control the HTTP call and are not part of the command
+CONTROL_KEYS = {"sn", "cmd", "cache", "queue", "expires", "bulk"}
+
+# take the lock of a read, or register as a waiter (reply key, optionally followed by a channel) for the reply of the caller holding it
+LEAD_SCRIPT = """
+if redis.call('SET', KEYS[1], '1', 'NX', 'PX', ARGV[1]) then
+    return {1, redis.call('GET', KEYS[3]) or '0'}
+end
+redis.call('RPUSH', KEYS[2], ARGV[2])
+redis.call('PEXPIRE', KEYS[2], ARGV[1])
+return {0, ''}
+"""
+
+# store the reply (unless the device was modified meanwhile), hand it to the waiters and release the lock
+RELEASE_SCRIPT = """
+if ARGV[3] ~= '' and (redis.call('GET', KEYS[3]) or '0') == ARGV[1] then
+    redis.call('HSET', KEYS[4], ARGV[2], ARGV[3])
+    redis.call('EXPIRE', KEYS[4], ARGV[4])
+end
+local waiters = redis.call('LRANGE', KEYS[2], 0, -1)
+for _, waiter in ipairs(waiters) do
+    local key, channel = string.match(waiter, '^(%S+) ?(%S*)$')
+    if channel ~= '' then
+        redis.call('PUBLISH', channel, key .. '\n' .. ARGV[5])
+    else
+        redis.call('RPUSH', key, ARGV[5])
+        redis.call('EXPIRE', key, ARGV[6])
+    end
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+return #waiters
+"""
+
+class ResponseCache:
+    def __init__(self, keys, ttls=READ_TTLS, mutating=MUTATING):
+        self.keys = keys
+        self.ttls = ttls
+        self.mutating = mutating
+        self.max_ttl = max(ttls.values())
+        self.lead_script = None
+        self.release_script = None
+
+    def cacheable(self, data):
+        return data['cmd'] in self.ttls
+
+    def mutates(self, data):
+        return data['cmd'] in self.mutating
+
+    def field(self, data):
+        args = {k : v for k, v in data.items() if k not in CONTROL_KEYS}
+        digest = hashlib.sha1(json.dumps(args, sort_keys=True).encode()).hexdigest()
+        return f"{data['cmd']}:{digest}"
+
+    def generation_key(self, sn):
+        return f"{self.keys.cache(sn)}_GEN"
+
+    def unpack(self, entry):
+        if entry is not None:
+            entry = json.loads(entry)
+            if entry['expires'] > time.time():
+                return entry['response']
+        return None
+
+    def lead_call(self, data, reply_key, timeout, channel=None):
+        prefix = f"{self.keys.cache(data['sn'])}_{self.field(data)}"
+        return {
+            "keys" : [f"{prefix}_LOCK", f"{prefix}_WAIT", self.generation_key(data['sn'])],
+            "args" : [int(timeout * 1000) + 1000, reply_key if channel is None else f"{reply_key} {channel}"]
+        }
+
+    def release_call(self, data, generation, response, timeout):
+        entry = ""
+        if response is not None and response.get("result", False) is True:
+            entry = json.dumps({"expires" : time.time() + self.ttls[data['cmd']], "response" : response})
+        prefix = f"{self.keys.cache(data['sn'])}_{self.field(data)}"
+        return {
+            "keys" : [f"{prefix}_LOCK", f"{prefix}_WAIT", self.generation_key(data['sn']), self.keys.cache(data['sn'])],
+            "args" : [generation, self.field(data), entry, self.max_ttl, json.dumps(response), max(1, int(timeout))]
+        }
+
+    def get(self, r, data):
+        return self.unpack(r.hget(self.keys.cache(data['sn']), self.field(data)))
+
+    def invalidate(self, r, sns):
+        pipe = r.pipeline(transaction=True)
+        for sn in sns:
+            pipe.delete(self.keys.cache(sn))
+            pipe.incr(self.generation_key(sn))
+        pipe.execute()
+
+    # returns (True, generation) for the caller that must send the command, (False, None) for a waiter
+    def lead(self, r, data, reply_key, timeout):
+        if self.lead_script is None:
+            self.lead_script = r.register_script(LEAD_SCRIPT)
+        leader, generation = self.lead_script(**self.lead_call(data, reply_key, timeout))
+        return leader == 1, generation
+
+    # called by the leader with the device's reply (None if it did not answer)
+    def release(self, r, data, generation, response, timeout):
+        if self.release_script is None:
+            self.release_script = r.register_script(RELEASE_SCRIPT)
+        self.release_script(**self.release_call(data, generation, response, timeout))
+
+class AsyncResponseCache(ResponseCache):
+    async def get(self, r, data):
+        return self.unpack(await r.hget(self.keys.cache(data['sn']), self.field(data)))
+
+    async def invalidate(self, r, sns):
+        async with r.pipeline(transaction=True) as pipe:
+            for sn in sns:
+                pipe.delete(self.keys.cache(sn))
+                pipe.incr(self.generation_key(sn))
+            await pipe.execute()
+
+    # waiters are told on `channel` instead of their reply key
+    async def lead(self, r, data, reply_key, timeout, channel=None):
+        if self.lead_script is None:
+            self.lead_script = r.register_script(LEAD_SCRIPT)
+        leader, generation = await self.lead_script(**self.lead_call(data, reply_key, timeout, channel))
+        return leader == 1, generation
+
+    async def release(self, r, data, generation, response, timeout):
+        if self.release_script is None:
+            self.release_script = r.register_script(RELEASE_SCRIPT)
+        await self.release_script(**self.release_call(data, generation, response, timeout))
@@ -0,0 +1,325 @@
+"""
+FILE: gateway.py
+
+DESCRIPTION: Asynchronous (ASGI) gateway for the HTTP server; waiting `/admin/push` calls are futures instead of threads.
+
+NOTES:
+- `/admin/push` follows the same rules as `app_http.py` (validation, control keys, status codes and cache behaviour,
+  see `push.py`) and the same authorization.
+  `/admin/events` (Server-Sent Events) is also served asynchronously, so live dashboards do not hold threads either.
+  All other routes are served by the Flask app, which runs in a thread pool behind the gateway.
+- Each gateway process subscribes once to its own reply channel. Commands carry the channel in their envelope, and the
+  WebSocket app publishes the device's reply on it; a single listener resolves the future of the waiting call.
+  Thousands of calls can therefore wait on devices at the same time without holding threads or Redis connections.
+- Replies published while the listener is reconnecting to Redis are lost; those calls time out.
+- Configuration is read from the same environment variables as `app_http.py`; `HTTP_WORKERS` sets the number of processes.
+- Metrics are per process. With `HTTP_WORKERS` > 1, each worker serves `/metrics` on the first free port from
+  `HTTP_METRICS_PORT` to `HTTP_METRICS_PORT + HTTP_WORKERS - 1` (by default from `FLASK_PORT` + 1), and `/metrics` on the
+  shared port answers 404, since a scrape there would reach a random worker.
+- Usage: `python gateway.py` (or `uvicorn gateway:app --host 0.0.0.0 --port 5000`).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import socket
+import time
+from urllib.parse import parse_qs
+
+import redis.asyncio as aioredis
+import uvicorn
+from a2wsgi import WSGIMiddleware
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app_http
+from app_http import DEVICE_TIMEOUTS
+from common.metrics import REGISTRY
+from common.protocol import new_command_id, pack_command, unpack_reply
+from common.queues import enqueue_command, withdraw_command, ENQUEUE_SCRIPT, QueueFull
+from common.events import stream_frames
+from cache import AsyncResponseCache
+from push import run_push_async
+
+LOG = logging.getLogger("uvicorn.error") # uvicorn's server log, written to stderr
+
+# futures of the calls waiting for a reply, resolved by a single subscriber to the gateway's reply channel
+class ReplyListener:
+    def __init__(self, r_db, channel, retry_interval=1.0):
+        self.r_db = r_db
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self.futures = {}
+        self.pubsub = None
+        self.task = None
+
+    def expect(self, reply_key):
+        future = asyncio.get_running_loop().create_future()
+        self.futures[reply_key] = future
+        return future
+
+    def discard(self, reply_key):
+        self.futures.pop(reply_key, None)
+
+    async def subscribe(self):
+        self.pubsub = self.r_db.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(self.channel)
+
+    async def start(self):
+        await self.subscribe()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.pubsub is not None:
+            await self.pubsub.close()
+
+    async def listen(self):
+        while True:
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None:
+                continue
+            reply_key, response = unpack_reply(message['data'])
+            future = self.futures.pop(reply_key, None)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+    async def run(self):
+        while True:
+            try:
+                await self.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                LOG.error(f"Reply listener lost connection to Redis. {e}.")
+                await asyncio.sleep(self.retry_interval)
+                try:
+                    await self.pubsub.close()
+                    await self.subscribe()
+                except Exception:
+                    pass
+
+class Gateway:
+    def __init__(self, wsgi_app, keys, redis_ip, redis_port, wait_timeout, queue_ttl, authorization_key, site="default", keepalive=15, max_depths=(0, 0), metrics=None):
+        self.wsgi = WSGIMiddleware(wsgi_app)
+        self.keys = keys
+        self.redis_ip = redis_ip
+        self.redis_port = redis_port
+        self.wait_timeout = wait_timeout
+        self.queue_ttl = queue_ttl
+        self.authorization_key = authorization_key
+        self.site = site
+        self.keepalive = keepalive
+        self.max_depths = max_depths # (interactive, bulk)
+        self.metrics = metrics # (ip, first port, workers) to serve metrics per worker, None to serve them on `/metrics`
+        self.metrics_server = None
+        self.channel = None
+        self.cache = AsyncResponseCache(keys)
+        self.r_db = None
+        self.enqueue = None
+        self.listener = None
+        self.push_steps = {
+            "online" : lambda sn: self.r_db.exists(self.keys.presence(sn)),
+            "invalidate" : lambda sn: self.cache.invalidate(self.r_db, [sn]),
+            "dispatch" : lambda data, expires, bulk: self.dispatch(data, expires=expires, bulk=bulk),
+            "request" : self.request_device,
+            "request_cached" : self.request_cached
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope['type'] == "http" and scope['path'] == "/admin/push" and scope['method'] == "POST":
+            status, body, headers = await self.push(scope, receive)
+            await self.respond(send, status, body, headers)
+        elif scope['type'] == "http" and scope['path'] == "/admin/events" and scope['method'] == "GET":
+            await self.events(scope, receive, send)
+        elif scope['type'] == "http" and scope['path'] == "/metrics" and self.metrics is not None:
+            _, port, workers = self.metrics
+            await self.respond(send, 404, {"status" : f"Metrics are served per worker, on ports {port} to {port + workers - 1}."})
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == "lifespan.startup":
+                self.channel = self.keys.gateway(f"{socket.gethostname()}:{os.getpid()}")
+                self.r_db = aioredis.Redis(host=self.redis_ip, port=self.redis_port, db=0)
+                self.enqueue = self.r_db.register_script(ENQUEUE_SCRIPT)
+                self.listener = ReplyListener(self.r_db, self.channel)
+                await self.listener.start()
+                if self.metrics is not None:
+                    self.metrics_server = await self.serve_metrics()
+                await send({"type" : "lifespan.startup.complete"})
+            elif message['type'] == "lifespan.shutdown":
+                if self.metrics_server is not None:
+                    self.metrics_server.close()
+                await self.listener.stop()
+                await self.r_db.close()
+                await send({"type" : "lifespan.shutdown.complete"})
+                return
+
+    # this worker's `/metrics`, on the first port of the range no other worker holds
+    async def serve_metrics(self):
+        ip, first_port, workers = self.metrics
+        for port in range(first_port, first_port + workers):
+            try:
+                server = await asyncio.start_server(self.metrics_client, ip, port)
+            except OSError:
+                continue
+            LOG.info(f"Serving metrics on port {port}.")
+            return server
+        LOG.error(f"No free port from {first_port} to {first_port + workers - 1}; metrics of this worker are not served.")
+        return None
+
+    async def metrics_client(self, reader, writer):
+        try:
+            request_line = (await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)).split(b"\r\n", 1)[0].split()
+            if len(request_line) >= 2 and request_line[1].split(b"?", 1)[0] == b"/metrics":
+                status, body = b"200 OK", REGISTRY.render().encode()
+            else:
+                status, body = b"404 Not Found", b"Not found.\n"
+            writer.write(
+                b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " +
+                str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, send, status, body, headers=None):
+        await send({
+            "type" : "http.response.start",
+            "status" : status,
+            "headers" : [(b"content-type", b"application/json")] + [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+        })
+        await send({"type" : "http.response.body", "body" : json.dumps(body).encode()})
+
+    def authorized(self, scope):
+        header = dict(scope['headers']).get(b"authorization", b"").decode().split()
+        return len(header) == 2 and header[1] == self.authorization_key
+
+    async def read_json(self, receive):
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+    async def wait_disconnect(self, receive):
+        while (await receive())['type'] != "http.disconnect":
+            pass
+
+    # same as `app_http.events`, without holding a thread per client
+    async def events(self, scope, receive, send):
+        if not self.authorized(scope):
+            await self.respond(send, 401, {"status" : "Incorrect authorization."})
+            return
+
+        query = parse_qs(scope['query_string'].decode())
+        stream = self.keys.events(query.get("site", [self.site])[0])
+        sns = set(query.get("sn", []))
+        position = dict(scope['headers']).get(b"last-event-id", b"").decode() or query.get("last_id", [""])[0]
+        if not position:
+            entries = await self.r_db.xrevrange(stream, count=1)
+            position = entries[0][0].decode() if len(entries) > 0 else "0-0"
+
+        await send({
+            "type" : "http.response.start",
+            "status" : 200,
+            "headers" : [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]
+        })
+        disconnected = asyncio.create_task(self.wait_disconnect(receive))
+        try:
+            while not disconnected.done():
+                entries = await self.r_db.xread({stream : position}, count=100, block=self.keepalive * 1000)
+                position, text = stream_frames(entries, position, sns)
+                if text:
+                    await send({"type" : "http.response.body", "body" : text.encode(), "more_body" : True})
+        finally:
+            disconnected.cancel()
+
+    # queue one command; returns its payload, or raises `QueueFull` if its lane is full
+    async def dispatch(self, data, command_id=None, expires=None, channel=None, bulk=False):
+        command_id = command_id if command_id is not None else new_command_id()
+        expires = expires if expires is not None else time.time() + self.wait_timeout
+        payload = pack_command(data, command_id, self.keys.reply(command_id), self.wait_timeout, expires, channel)
+        if await self.enqueue(**enqueue_command(self.keys, data['sn'], payload, bulk, self.max_depths[bool(bulk)])) != 1:
+            raise QueueFull("Device queue full.")
+        return payload
+
+    # send one command and wait for its reply (None on timeout)
+    async def request_device(self, data, bulk=False):
+        command_id = new_command_id()
+        reply_key = self.keys.reply(command_id)
+        future = self.listener.expect(reply_key) # before sending, so that an early reply is not missed
+        try:
+            payload = await self.dispatch(data, command_id, channel=self.channel, bulk=bulk)
+            try:
+                return await asyncio.wait_for(future, self.wait_timeout)
+            except asyncio.TimeoutError:
+                async with self.r_db.pipeline(transaction=False) as pipe: # withdraw the command if it was never sent
+                    withdraw_command(pipe, self.keys, data['sn'], payload)
+                    await pipe.execute()
+                DEVICE_TIMEOUTS.labels(data['sn']).inc()
+                return None
+        finally:
+            self.listener.discard(reply_key)
+
+    # returns (response, cache status); identical reads in flight share a single device round trip
+    async def request_cached(self, data):
+        response = await self.cache.get(self.r_db, data)
+        if response is not None:
+            return response, "HIT"
+
+        reply_key = self.keys.reply(new_command_id())
+        future = self.listener.expect(reply_key)
+        try:
+            leader, generation = await self.cache.lead(self.r_db, data, reply_key, self.wait_timeout, self.channel)
+            if not leader:
+                response = await self.cache.get(self.r_db, data) # the leader may have finished before this call was registered
+                if response is not None:
+                    return response, "HIT"
+                try:
+                    return await asyncio.wait_for(future, self.wait_timeout), "COALESCED"
+                except asyncio.TimeoutError:
+                    return None, "COALESCED"
+        finally:
+            self.listener.discard(reply_key)
+
+        response = None
+        try:
+            response = await self.request_device(data)
+        finally:
+            await self.cache.release(self.r_db, data, generation, response, self.wait_timeout)
+        return response, "MISS"
+
+    # returns (status, body, headers), with the rules of `app_http.push`
+    async def push(self, scope, receive):
+        if not self.authorized(scope):
+            return 401, {"status" : "Incorrect authorization."}, None
+        return await run_push_async(await self.read_json(receive), self.cache, self.queue_ttl, self.push_steps)
+
+app_http.configure()
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", "1"))
+HTTP_METRICS_PORT = int(os.getenv("HTTP_METRICS_PORT", app_http.FLASK_PORT + 1))
+app = Gateway(
+    app_http.app, app_http.KEYS, app_http.REDIS_IP, app_http.REDIS_PORT,
+    app_http.WAIT_RESPONSE_TIMEOUT, app_http.PRESENCE_QUEUE_TTL, app_http.AUTHORIZATION_KEY,
+    app_http.SITE_ID, app_http.EVENTS_KEEPALIVE, (app_http.OUTGOING_MAX_DEPTH, app_http.OUTGOING_MAX_BULK_DEPTH),
+    (app_http.FLASK_IP, HTTP_METRICS_PORT, HTTP_WORKERS) if HTTP_WORKERS > 1 else None
+)
+
+if __name__ == "__main__":
+    uvicorn.run("gateway:app", host=app_http.FLASK_IP, port=app_http.FLASK_PORT, workers=HTTP_WORKERS)
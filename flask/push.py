@@ -0,0 +1,99 @@
+"""
+FILE: push.py
+
+DESCRIPTION: Rules of `/admin/push`, shared by the Flask app (`app_http.py`) and the asynchronous gateway (`gateway.py`).
+
+NOTES:
+- `handle_push` validates the command, removes the control keys (`queue`, `expires`, `cache`, `bulk`) and chooses between
+  failing fast, queueing for an offline device, sending without waiting (`reboot`), the cache and a mutation. It yields
+  each step that needs Redis or the device as `(name, *args)` and is sent its result, so it does no I/O itself.
+- `run_push` and `run_push_async` drive it with the step functions of their caller (by name):
+  `online(sn)`, `invalidate(sn)`, `dispatch(data, expires, bulk)`, `request(data, bulk)` and `request_cached(data)`.
+  An exception raised by a step is thrown back into `handle_push`, which turns it into a status code.
+- Both return `(status, body, headers)`.
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.protocol import COMMANDS
+from common.queues import QueueFull
+from common.metrics import Histogram
+
+CACHE_STATUSES = ("HIT", "COALESCED", "MISS", "NONE")
+PUSH_LATENCY = Histogram("face_http_push_seconds", "Time to answer `/admin/push` calls, by command and cache status.", ["cmd", "cache"])
+PUSH_LATENCIES = {(cmd, status) : PUSH_LATENCY.labels(cmd, status) for cmd in COMMANDS + ("other",) for status in CACHE_STATUSES}
+
+def handle_push(data, cache, queue_ttl):
+    if not isinstance(data, dict) or data == {} or not "sn" in data.keys() or not "cmd" in data.keys():
+        return 400, {"status" : "Incomplete or incorrect data."}, None
+
+    start_time = time.monotonic()
+    try:
+        # offline devices fail fast, unless the caller asks to queue the command until it expires
+        queue_offline = data.pop("queue", False)
+        expires = time.time() + float(data.pop("expires", queue_ttl))
+        use_cache = data.pop("cache", True)
+        bulk = data.pop("bulk", False)
+        if not (yield "online", data['sn']):
+            if not queue_offline:
+                return 404, {"status" : "Device offline."}, None
+            if cache.mutates(data): # the device cannot be read while offline, so nothing is cached again before delivery
+                yield "invalidate", data['sn']
+            yield "dispatch", data, expires, bulk
+            return 202, {"status" : "Device offline. Command queued.", "expires" : int(expires)}, None
+
+        headers = {}
+        if data['cmd'] == 'reboot':
+            yield "dispatch", data, None, bulk
+            return 200, {"status" : "No response."}, None
+        elif use_cache and cache.cacheable(data):
+            response, headers['X-Cache'] = yield "request_cached", data
+        elif cache.mutates(data):
+            yield "invalidate", data['sn']
+            try:
+                response = yield "request", data, bulk
+            finally:
+                yield "invalidate", data['sn']
+        else:
+            response = yield "request", data, bulk
+
+        if response is not None:
+            cmd = data['cmd'] if data['cmd'] in COMMANDS else "other"
+            PUSH_LATENCIES[(cmd, headers.get('X-Cache', "NONE"))].observe(time.monotonic() - start_time)
+            return 200, response, headers
+        raise Exception("No response.")
+    except QueueFull as e:
+        return 429, {"status" : f"{str(e)}"}, None
+    except Exception as e:
+        return 500, {"status" : f"{str(e)}"}, None
+
+def run_push(data, cache, queue_ttl, steps):
+    handler = handle_push(data, cache, queue_ttl)
+    try:
+        step = next(handler)
+        while True:
+            try:
+                result = steps[step[0]](*step[1:])
+            except BaseException as e:
+                step = handler.throw(e)
+            else:
+                step = handler.send(result)
+    except StopIteration as e:
+        return e.value
+
+async def run_push_async(data, cache, queue_ttl, steps):
+    handler = handle_push(data, cache, queue_ttl)
+    try:
+        step = next(handler)
+        while True:
+            try:
+                result = await steps[step[0]](*step[1:])
+            except BaseException as e:
+                step = handler.throw(e)
+            else:
+                step = handler.send(result)
+    except StopIteration as e:
+        return e.value
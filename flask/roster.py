@@ -0,0 +1,287 @@
+"""
+FILE: roster.py
+
+DESCRIPTION: Synchronisation of the users enrolled on many devices with one roster, sending only what changed.
+
+NOTES:
+- The roster (`<prefix>_ROSTER`) is a Redis hash of users by `enrollid`: `name`, `admin`, `enabled` and `credentials`
+  (`backupnum` -> `record`: face template, fingerprint, password or card). It is loaded from a JSON file (a list of
+  users) or pulled from a reference device.
+- `<prefix>_ROSTER_<sn>` holds, for each user written to the device, a digest of each credential and its `enabled` flag.
+  The delta of a device is computed from these digests alone: `setuserinfo` for new or changed credentials, `deleteuser`
+  for credentials and users no longer in the roster, `enableuser` for changed flags. Unchanged users cost nothing.
+- A user's entry is updated after each command the device accepts, so an interrupted sync resumes where it stopped.
+- `--verify` first reads the device's user list (`getuserlist`): credentials deleted on the device are sent again and
+  users that are not in the roster are deleted.
+- Devices are synchronised concurrently (`--devices`), each with the commands of up to `--parallel` users in flight.
+  Commands go to the bulk lane of the devices (see `common/queues.py`), behind any interactive command.
+  A device that does not answer in time is left for the next run.
+- Usage: `python roster.py load users.json`, `python roster.py pull --sn <sn>`, `python roster.py sync --sn all [--dry-run]`.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import redis.asyncio as aioredis
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.protocol import RedisKeys, new_command_id, pack_command
+from common.queues import enqueue_command, withdraw_command, ENQUEUE_SCRIPT, QueueFull
+from cache import AsyncResponseCache
+
+ALL_BACKUPS = 13 # `backupnum` of `deleteuser` removing every credential of a user
+
+# digest of what `setuserinfo` writes for one credential
+def credential_digest(user, backupnum):
+    content = [user.get('name', ""), user.get('admin', 0), int(backupnum), user['credentials'][backupnum]]
+    return hashlib.sha1(json.dumps(content).encode()).hexdigest()
+
+# the entry of `<prefix>_ROSTER_<sn>` for a user once it is fully written
+def user_state(user):
+    return {"credentials" : {b : credential_digest(user, b) for b in user['credentials']}, "enabled" : user.get('enabled', True)}
+
+def normalize_user(user):
+    return {
+        "enrollid" : int(user['enrollid']),
+        "name" : user.get('name', ""),
+        "admin" : int(user.get('admin', 0)),
+        "enabled" : bool(user.get('enabled', True)),
+        "credentials" : {str(int(b)) : record for b, record in user.get('credentials', {}).items()}
+    }
+
+# commands bringing each user of a device from `state` to `roster` (both by `enrollid`): {enrollid : [command]}
+def roster_delta(roster, state):
+    delta = {}
+    for enrollid, user in roster.items():
+        current = state.get(enrollid, {"credentials" : {}, "enabled" : True})
+        target = user_state(user)
+        commands = []
+        for backupnum in current['credentials']:
+            if backupnum not in target['credentials']:
+                commands.append({"cmd" : "deleteuser", "enrollid" : int(enrollid), "backupnum" : int(backupnum)})
+        for backupnum, digest in target['credentials'].items():
+            if current['credentials'].get(backupnum) != digest:
+                commands.append({
+                    "cmd" : "setuserinfo", "enrollid" : int(enrollid), "name" : user['name'], "admin" : user['admin'],
+                    "backupnum" : int(backupnum), "record" : user['credentials'][backupnum]
+                })
+        if current['enabled'] != target['enabled']:
+            commands.append({"cmd" : "enableuser", "enrollid" : int(enrollid), "enflag" : int(target['enabled'])})
+        if len(commands) > 0:
+            delta[enrollid] = commands
+    for enrollid in state:
+        if enrollid not in roster:
+            delta[enrollid] = [{"cmd" : "deleteuser", "enrollid" : int(enrollid), "backupnum" : ALL_BACKUPS}]
+    return delta
+
+# the entry of a user after the device accepted `command` (None once the user is deleted)
+def apply_command(current, command, roster):
+    if command['cmd'] == "deleteuser" and command['backupnum'] == ALL_BACKUPS:
+        return None
+    current = current if current is not None else {"credentials" : {}, "enabled" : True}
+    credentials = dict(current['credentials'])
+    backupnum = str(command.get('backupnum'))
+    if command['cmd'] == "deleteuser":
+        credentials.pop(backupnum, None)
+    elif command['cmd'] == "setuserinfo":
+        credentials[backupnum] = credential_digest(roster[str(command['enrollid'])], backupnum)
+    elif command['cmd'] == "enableuser":
+        return {"credentials" : credentials, "enabled" : bool(command['enflag'])}
+    return {"credentials" : credentials, "enabled" : current['enabled']}
+
+class DeviceTimeout(Exception):
+    pass
+
+class RosterSync:
+    def __init__(self, r_db, keys, timeout=10, devices=20, parallel=4, max_depth=0):
+        self.r_db = r_db
+        self.keys = keys
+        self.timeout = timeout
+        self.devices = asyncio.Semaphore(devices)
+        self.parallel = parallel
+        self.max_depth = max_depth
+        self.enqueue = r_db.register_script(ENQUEUE_SCRIPT)
+        self.cache = AsyncResponseCache(keys)
+
+    # send one command and wait for its reply; raises `DeviceTimeout` if the device does not answer in time
+    async def request(self, sn, data):
+        command_id = new_command_id()
+        reply_key = self.keys.reply(command_id)
+        payload = pack_command(dict(data, sn=sn), command_id, reply_key, self.timeout, time.time() + self.timeout)
+        if await self.enqueue(**enqueue_command(self.keys, sn, payload, True, self.max_depth)) != 1:
+            raise QueueFull("Device queue full.")
+        popped = await self.r_db.blpop(reply_key, timeout=self.timeout)
+        if popped is None:
+            async with self.r_db.pipeline(transaction=False) as pipe: # withdraw the command if it was never sent
+                withdraw_command(pipe, self.keys, sn, payload)
+                await pipe.execute()
+            raise DeviceTimeout(f"No response to {data['cmd']}.")
+        return json.loads(popped[1])
+
+    # (enrollid, backupnum) of every credential on the device
+    async def user_list(self, sn):
+        listing, first = [], True
+        while True:
+            page = await self.request(sn, {"cmd" : "getuserlist", "stn" : first})
+            if page.get("result", False) is not True:
+                raise Exception(f"Device error. {page}")
+            records = page.get("record", [])
+            listing.extend((str(record['enrollid']), str(record['backupnum'])) for record in records)
+            if len(records) == 0 or page.get("to", 0) >= page.get("count", 0):
+                return listing
+            first = False
+
+    async def load_roster(self):
+        return {k.decode() : json.loads(v) for k, v in (await self.r_db.hgetall(self.keys.roster())).items()}
+
+    async def store_roster(self, users):
+        async with self.r_db.pipeline(transaction=True) as pipe:
+            pipe.delete(self.keys.roster())
+            if len(users) > 0:
+                pipe.hset(self.keys.roster(), mapping={str(user['enrollid']) : json.dumps(user) for user in users})
+            await pipe.execute()
+
+    async def load_state(self, sn):
+        return {k.decode() : json.loads(v) for k, v in (await self.r_db.hgetall(self.keys.roster_device(sn))).items()}
+
+    async def save_user(self, sn, enrollid, entry):
+        if entry is None:
+            await self.r_db.hdel(self.keys.roster_device(sn), enrollid)
+        else:
+            await self.r_db.hset(self.keys.roster_device(sn), enrollid, json.dumps(entry))
+
+    # forget the credentials missing on the device; users on the device but not in `state` are added to it for deletion
+    async def verify(self, sn, state, roster):
+        on_device = {}
+        for enrollid, backupnum in await self.user_list(sn):
+            on_device.setdefault(enrollid, set()).add(backupnum)
+        for enrollid, entry in list(state.items()):
+            credentials = {b : d for b, d in entry['credentials'].items() if b in on_device.get(enrollid, set())}
+            if credentials != entry['credentials']:
+                state[enrollid] = dict(entry, credentials=credentials)
+                await self.save_user(sn, enrollid, state[enrollid])
+        for enrollid in on_device:
+            if enrollid not in roster and enrollid not in state:
+                state[enrollid] = {"credentials" : {}, "enabled" : True}
+
+    # send the commands of one user in order; returns the number sent, stopping at the first one the device rejects
+    async def sync_user(self, sn, enrollid, commands, state, roster, limit):
+        async with limit:
+            sent = 0
+            for command in commands:
+                response = await self.request(sn, command)
+                if response.get("result", False) is not True:
+                    return sent, False
+                state[enrollid] = apply_command(state.get(enrollid), command, roster)
+                await self.save_user(sn, enrollid, state[enrollid])
+                sent += 1
+            return sent, True
+
+    # returns a summary of the device's delta and of the commands it accepted
+    async def sync_device(self, sn, roster, verify=False, dry_run=False):
+        async with self.devices:
+            start_time = time.monotonic()
+            summary = {"sn" : sn, "status" : "ok", "users" : 0, "commands" : 0, "sent" : 0, "failed" : 0}
+            try:
+                state = await self.load_state(sn)
+                if verify:
+                    await self.verify(sn, state, roster)
+                delta = roster_delta(roster, state)
+                summary['users'] = len(delta)
+                summary['commands'] = sum(len(commands) for commands in delta.values())
+                if dry_run or len(delta) == 0:
+                    return summary
+
+                await self.cache.invalidate(self.r_db, [sn])
+                limit = asyncio.Semaphore(self.parallel)
+                results = await asyncio.gather(*[
+                    self.sync_user(sn, enrollid, commands, state, roster, limit) for enrollid, commands in delta.items()
+                ], return_exceptions=True)
+                await self.cache.invalidate(self.r_db, [sn])
+                for result in results:
+                    if isinstance(result, Exception):
+                        summary['status'] = f"{str(result)}"
+                        summary['failed'] += 1
+                    else:
+                        summary['sent'] += result[0]
+                        summary['failed'] += 0 if result[1] else 1
+            except Exception as e:
+                summary['status'] = f"{str(e)}"
+            finally:
+                summary['latency'] = round((time.monotonic() - start_time) * 1000, 1)
+            return summary
+
+    # yields the summary of each device as soon as it is done
+    async def sync(self, sns, verify=False, dry_run=False):
+        roster = await self.load_roster()
+        for done in asyncio.as_completed([self.sync_device(sn, roster, verify, dry_run) for sn in sns]):
+            yield await done
+
+    # the users of a reference device, with all their credentials
+    async def pull(self, sn):
+        users = {}
+        limit = asyncio.Semaphore(self.parallel)
+
+        async def fetch(enrollid, backupnum):
+            async with limit:
+                info = await self.request(sn, {"cmd" : "getuserinfo", "enrollid" : int(enrollid), "backupnum" : int(backupnum)})
+            if info.get("result", False) is not True:
+                return
+            user = users.setdefault(enrollid, {"enrollid" : int(enrollid), "name" : "", "admin" : 0, "enabled" : True, "credentials" : {}})
+            user['name'] = info.get('name', user['name'])
+            user['admin'] = int(info.get('admin', user['admin']))
+            user['credentials'][backupnum] = info.get('record')
+
+        await asyncio.gather(*[fetch(enrollid, backupnum) for enrollid, backupnum in await self.user_list(sn)])
+        return [users[enrollid] for enrollid in sorted(users, key=int)]
+
+async def main(args, keys):
+    r_db = aioredis.Redis(host=os.getenv("REDIS_IP"), port=int(os.getenv("REDIS_PORT")), db=0)
+    engine = RosterSync(
+        r_db, keys, timeout=args.timeout, devices=args.devices, parallel=args.parallel,
+        max_depth=int(os.getenv("OUTGOING_MAX_BULK_DEPTH", "10000"))
+    )
+    try:
+        if args.action == "load":
+            with open(args.file, "r", encoding="utf-8") as f:
+                users = [normalize_user(user) for user in json.load(f)]
+            await engine.store_roster(users)
+            print(json.dumps({"status" : "ok", "users" : len(users)}))
+        elif args.action == "pull":
+            users = await engine.pull(args.sn[0])
+            await engine.store_roster(users)
+            print(json.dumps({"status" : "ok", "sn" : args.sn[0], "users" : len(users)}))
+        else:
+            if args.sn == ["all"]:
+                presence_ttl = int(os.getenv("PRESENCE_TTL", "90"))
+                sns = sorted(sn.decode() for sn in await r_db.zrangebyscore(keys.devices(), time.time() - presence_ttl, "+inf"))
+            else:
+                sns = list(dict.fromkeys(args.sn))
+            async for summary in engine.sync(sns, args.verify, args.dry_run):
+                print(json.dumps(summary), flush=True)
+    finally:
+        await r_db.close()
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Synchronise the users of AiFace devices with a roster.')
+    parser.add_argument("action", choices=["load", "pull", "sync"], help="Load the roster from a file, pull it from a device, or sync devices.")
+    parser.add_argument("file", nargs="?", default=None, help="JSON file of users (`load`).")
+    parser.add_argument("--sn", type=str, nargs="+", default=["all"], help="Serial numbers (`all` = every connected device).")
+    parser.add_argument("--verify", action="store_true", help="Check the user list of each device before syncing it.")
+    parser.add_argument("--dry-run", action="store_true", help="Report the delta of each device without sending it.")
+    parser.add_argument("--devices", type=int, default=20, help="Devices synchronised at the same time.")
+    parser.add_argument("--parallel", type=int, default=4, help="Users with commands in flight per device.")
+    parser.add_argument("--timeout", type=int, default=int(os.getenv("TIMEOUT_HTTP_WAIT_RESPONSE", "10")), help="Seconds to wait for each reply.")
+    args = parser.parse_args()
+    if args.action == "load" and args.file is None:
+        parser.error("`load` needs a file.")
+    if args.action == "pull" and args.sn == ["all"]:
+        parser.error("`pull` needs the serial number of one device.")
+
+    keys = RedisKeys(os.getenv("REDIS_DB_PREFIX"), os.getenv("REDIS_OUT_KEY"), os.getenv("REDIS_IN_KEY"))
+    asyncio.run(main(args, keys))
@@ -6,264 +6,422 @@ DESCRIPTION: Websocket server for AiFace device.
 NOTES:
 - Ensure that the AiFace device is connected to the same network as the server and points to the server's IP address.
 - MySQL database should contain two tables for `reg` and `sendlog` commands (WIP).
+- `sendlog` records are inserted by a background writer (see `writer.py`) so that acknowledgements never wait for the database.
+  If `PATH_WS_SPOOL` is set, records are first written to a disk spool and survive database outages and restarts.
+  Records the database rejects are set aside in `PATH_WS_QUARANTINE` (or only logged if it is not set).
 - Redis database should contain two keys for `OUT` (sending to device) and `IN` (receiving from device).
+  Replies that no caller waits for go to `IN`, which keeps the last `INCOMING_MAX_LENGTH` for `INCOMING_TTL` seconds.
+- Outgoing commands are delivered as soon as they are published (see `dispatcher.py`); `TIMEOUT_WS_NEW_MESSAGE` is the interval of the fallback sweep.
+- `TIMEOUT_WS_MAX_WAIT` is the number of seconds a device may stay silent before it is disconnected.
+- Connected devices are listed in Redis (see `presence.py`) so that the HTTP app can reject commands to offline devices.
+- `--workers N` runs N server processes on the same port (see `supervisor.py`). Each worker owns the devices connected
+  to it and only receives the commands for those devices; logs, archive and spool are kept per worker. The first
+  process (worker 0, or the only one) also replays the spools left by a different number of workers.
+- `sendlog` batches a device sends again are acknowledged but not stored twice (see `logindex.py`).
+- With `EVENTS_MAXLEN` > 0, `reg` and `sendlog` records are also appended to the site's Redis stream (see `common/events.py`).
+- Frames are decoded, validated and acknowledged by `codec.py`; invalid frames are logged and skipped
+  (an invalid `sendlog` is answered with a failure). Each device command has a handler (`COMMAND_HANDLERS`) that
+  acknowledges it and applies its side effects (presence, duplicate check, writer, event stream).
+- Metrics (connected devices, messages per command, queue depths, database inserts, event loop lag) are served
+  in the Prometheus text format at `GET /metrics` on the WebSocket port, or with `--workers`, on port
+  `WS_METRICS_PORT` + index of each worker.
 """
 
 import asyncio
 import websockets
-import json
-import datetime
-from copy import deepcopy
-import pymssql
 import argparse
-import redis
+import redis.asyncio as aioredis
 import os
-
-def dtnow():
-    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-REGISTER_SUCCESS_RESPONSE = {
-    "ret" : "reg",
-    "result" : True,
-    "cloudtime" : dtnow(),
-    "nosenduser" : True
-}
-
-SENDLOG_SUCCESS_RESPONSE = {
-    "ret" : "sendlog",
-    "result" : True,
-    "count" : 999,
-    "logindex" : 999,
-    "cloudtime" : dtnow(),
-    "access" : 1
-}
-
-SENDLOG_FAIL_RESPONSE = {
-    "ret" : "sendlog",
-    "result" : False,
-    "reason" : "1"
-}
-
-# class to store logs in text file
-class LogRecord:
-    def __init__(self, path):
-        self.path = path
-        self.file = None
-
-    def open(self):
-        if not os.path.exists(self.path):
-            os.makedirs(self.path)
-        self.file = open(os.path.join(self.path, 'log.txt'), 'a')
-
-    def close(self):
-        if self.file is not None:
-            self.file.close()
-
-    def write(self, message):
-        if self.file is not None:
-            self.file.write(f"{message}\n")
-
-def show_dict(d, keys):
-    return ', '.join(f'{k}={d[k]}' for k in keys)
-
-def get_response(message):
-    result = None
-    if message['cmd'] == 'reg':
-        result = deepcopy(REGISTER_SUCCESS_RESPONSE)
-        result['cloudtime'] = dtnow()
-
-        print(f"[{dtnow()}] [{CLIENT_LOG_PREFIX}] Register request received by {message['sn']}. Device info: {show_dict(message['devinfo'], ['modelname', 'netinuse', 'fpalgo', 'firmware', 'time', 'mac'])}.")
-        LOG_FILE.write(f"[{dtnow()}] [{CLIENT_LOG_PREFIX}] Register request received by {message['sn']}. Device info: {show_dict(message['devinfo'], ['modelname', 'netinuse', 'fpalgo', 'firmware', 'time', 'mac'])}.")
-    elif message['cmd'] == 'sendlog':
-        result = deepcopy(SENDLOG_SUCCESS_RESPONSE)
-        result['cloudtime'] = dtnow()
-        result['count'] = message['count']
-        result['logindex'] = message['logindex']
-
-        for i in range(message['count']):
-            print(f"[{dtnow()}] [{CLIENT_LOG_PREFIX}] Record from {message['sn']}: {show_dict(message['record'][i], ['enrollid', 'aliasid', 'name', 'time', 'mode', 'inout', 'event'])}.")
-            LOG_FILE.write(f"[{dtnow()}] [{CLIENT_LOG_PREFIX}] Record from {message['sn']}: {show_dict(message['record'][i], ['enrollid', 'aliasid', 'name', 'time', 'mode', 'inout', 'event'])}.")
-
-    return result
-
+import sys
+import socket
+import http
+import signal
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.protocol import RedisKeys
+from common.protocol import unpack_command, pack_reply, COMMANDS
+from common.metrics import REGISTRY, Counter, Gauge, Histogram
+from common.events import publish_events
+from common.queues import lane_keys
+import codec
+from codec import AckFrames, MessageError, SENDLOG_FAIL_FRAME
+from dispatcher import OutgoingDispatcher, PendingCommands
+from logindex import LogIndexTracker
+from archive import MessageArchive
+from logger import EventLog, LEVELS, DEBUG
+from presence import PresenceRegistry
+from spool import Spool, orphaned_spools
+from supervisor import Supervisor
+from writer import RecordWriter
+
+ACKS = AckFrames()
+
+REGISTER_LOG_KEYS = ['modelname', 'netinuse', 'fpalgo', 'firmware', 'time', 'mac']
+RECORD_LOG_KEYS = ['enrollid', 'aliasid', 'name', 'time', 'mode', 'inout', 'event']
+
+CONNECTED_DEVICES = Gauge("face_ws_connected_devices", "Devices connected to this server.")
+MESSAGES = Counter("face_ws_messages_total", "Messages received from devices, by `cmd` or `ret`.", ["message"])
+MESSAGE_COUNTERS = {name : MESSAGES.labels(name) for name in COMMANDS}
+OTHER_MESSAGES = MESSAGES.labels("other")
+QUEUE_DEPTH = Gauge("face_redis_queue_depth", "Messages waiting in the Redis lists of connected devices.", ["sn", "queue"])
+DUPLICATE_BATCHES = Counter("face_ws_duplicate_batches_total", "`sendlog` batches received again and not stored.")
+DUPLICATE_RECORDS = Counter("face_ws_duplicate_records_total", "Records in `sendlog` batches received again and not stored.")
+WRITER_QUEUE_DEPTH = Gauge("face_mssql_queue_depth", "Record batches waiting for the database writer threads.")
+SPOOL_BACKLOG = Gauge("face_spool_backlog_bytes", "Bytes of spooled records not inserted yet, including the spools adopted from other processes.")
+LOOP_LAG = Histogram("face_ws_event_loop_lag_seconds", "Delay of the event loop in running a scheduled callback.", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+def pick(d, keys):
+    return {k : d[k] for k in keys if k in d}
+
+# what the handlers of device commands act on; each is None when the server runs without it
+class Services:
+    def __init__(self, presence=None, writer=None, events=None, tracker=None):
+        self.presence = presence
+        self.writer = writer
+        self.events = events
+        self.tracker = tracker
+
+# `message` is an encoded frame or a dictionary
 async def send_response(websocket, message):
-    if message is not None:
-        if "ret" in message.keys():
-            if message['ret'] == 'reg':
-                print(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Register success on {message['cloudtime']}.")
-                LOG_FILE.write(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Register success on {message['cloudtime']}.")
-            elif message['ret'] == 'sendlog':
-                pass
-        await websocket.send(json.dumps(message))
-    else:
+    if message is None:
         raise Exception("Undefined message received.")
+    await websocket.send(message if isinstance(message, str) else codec.dumps(message))
 
-async def connect_mssql(sql_host, sql_user, sql_pass, sql_db):
-    try:
-        db = pymssql.connect(sql_host, sql_user, sql_pass, sql_db)
-
-        return db
-    except Exception as e:
-        print(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Error: Could not connect to MSSQL database. {e}.")
-        LOG_FILE.write(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Error: Could not connect to MSSQL database. {e}.")
-        return None
+async def publish_device_events(services, message):
+    if services.events is not None:
+        try:
+            await publish_events(services.events, EVENTS_STREAM, message, EVENTS_MAXLEN)
+        except Exception as e:
+            SERVER_LOG.error(f"Could not publish device events. {e}.", sn=message['sn'])
+
+async def reg_command(websocket, services, message):
+    CLIENT_LOG.info("Register request received.", sn=message['sn'], devinfo=pick(message['devinfo'], REGISTER_LOG_KEYS))
+    if services.presence is not None:
+        await services.presence.register(message['sn'], message['devinfo'])
+    await send_response(websocket, ACKS.reg())
+    SERVER_LOG.info("Register success.", cloudtime=ACKS.cloudtime)
+    await publish_device_events(services, message)
+
+async def sendlog_command(websocket, services, message):
+    CLIENT_LOG.info("Records received.", sn=message['sn'], count=message['count'], logindex=message['logindex'])
+    if CLIENT_LOG.enabled(DEBUG): # one line per record is only built when asked for
+        for i in range(message['count']):
+            CLIENT_LOG.debug("Record received.", sn=message['sn'], record=pick(message['record'][i], RECORD_LOG_KEYS))
+    tracker = services.tracker
+    if tracker is not None and await tracker.duplicate(message['sn'], message['logindex'], message['count']):
+        DUPLICATE_BATCHES.inc()
+        DUPLICATE_RECORDS.inc(message['count'])
+        CLIENT_LOG.warning("Batch sent again not stored.", sn=message['sn'], count=message['count'], logindex=message['logindex'])
+        await send_response(websocket, ACKS.sendlog(message['count'], message['logindex']))
+        return
+    if services.writer is not None:
+        services.writer.submit(message)
+    if tracker is not None: # only once the batch is stored, so a failed batch is taken again
+        await tracker.commit(message['sn'], message['logindex'], message['count'])
+    await send_response(websocket, ACKS.sendlog(message['count'], message['logindex']))
+    await publish_device_events(services, message)
+
+# handler of each device command (validated by `codec.decode`): acknowledges it and applies its side effects
+COMMAND_HANDLERS = {"reg" : reg_command, "sendlog" : sendlog_command}
+
+# hand a reply to the HTTP call waiting for it
+async def route_reply(r_db, pending, device_sn, message, raw):
+    reply = pending.match(message['ret'])
+    if reply is not None and reply[2] is not None: # the HTTP gateway listens on a channel
+        await r_db.publish(reply[2], pack_reply(reply[0], raw))
+    elif reply is not None: # route to the HTTP call waiting for this command
+        async with r_db.pipeline(transaction=False) as pipe:
+            pipe.rpush(reply[0], raw)
+            pipe.expire(reply[0], max(1, int(reply[1])))
+            await pipe.execute()
+    else: # late reply or reply to a bare command: only the latest ones are kept, for a while
+        async with r_db.pipeline(transaction=False) as pipe:
+            pipe.rpush(KEYS.incoming(device_sn), raw)
+            pipe.ltrim(KEYS.incoming(device_sn), -INCOMING_MAX_LENGTH, -1)
+            pipe.expire(KEYS.incoming(device_sn), INCOMING_TTL)
+            await pipe.execute()
+    SERVER_LOG.info("Incoming message received.", sn=device_sn, ret=message['ret'])
+
+async def receive_messages(websocket, registered, pending, r_db, services, receive=False, token=None):
+    # the idle deadline is pushed back on every message; the device is dropped once it passes
+    device_sn = None
+    while True:
+        try:
+            message = await asyncio.wait_for(websocket.recv(), timeout=MAX_MESSAGE_TIMEOUT)
+        except asyncio.TimeoutError:
+            SERVER_LOG.info("Idle timeout exceeded. Bye bye!", sn=device_sn)
+            return
 
-async def insert_record(message, db, sql_table):
-    if message['cmd'] == 'sendlog':
-        cursor = db.cursor()
-
-        # create table if not exist
-        _script_create_table = f"""
-        IF OBJECT_ID('{sql_table}', 'U') IS NULL
-            CREATE TABLE {sql_table} (
-                cmd VARCHAR(255),
-                sn VARCHAR(255),
-                enrollid INT,
-                aliasid INT,
-                name VARCHAR(255),
-                time VARCHAR(255),
-                mode INT,
-                inout INT,
-                event INT
-            )
-        """
-        cursor.execute(_script_create_table)
-        db.commit()
-
-        sql = f"""
-        INSERT INTO {sql_table} (cmd, sn, enrollid, aliasid, name, time, mode, inout, event) VALUES (%s, %s, %d, %d, %s, %s, %d, %d, %d)
-        """
-        val = [(
-            message['cmd'],
-            message['sn'],
-            message['record'][i]['enrollid'],
-            message['record'][i]['aliasid'],
-            message['record'][i]['name'],
-            message['record'][i]['time'],
-            message['record'][i]['mode'],
-            message['record'][i]['inout'],
-            message['record'][i]['event']
-        ) for i in range(message['count'])]
-        cursor.executemany(sql, val)
-        db.commit()
-
-        print(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Inserted {message['count']} records from {message['sn']} to {sql_table}.")
-        LOG_FILE.write(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Inserted {message['count']} records from {message['sn']} to {sql_table}.")
-
-def save_file(message, path):
-    filename = None
-    if "cmd" in message.keys():
-        filename = message['cmd']
-    elif "ret" in message.keys():
-        filename = message['ret']
-
-    if not os.path.exists(path):
-        os.makedirs(path)
-    if filename is not None:
-        with open(os.path.join(path, filename + '.json'), 'w') as f:
-            json.dump(message, f, indent=4)
+        raw = message
+        try:
+            message = codec.decode(raw)
+        except MessageError as e:
+            SERVER_LOG.warning(f"Invalid message received. {e}", sn=device_sn)
+            if e.message is not None and e.message.get('cmd') == 'sendlog':
+                await send_response(websocket, SENDLOG_FAIL_FRAME)
+            continue
+        cmd = message.get('cmd')
+        if device_sn is None and "sn" in message:
+            device_sn = message['sn']
+            registered.set_result(device_sn)
+            CONNECTED_DEVICES.inc()
+            if services.tracker is not None:
+                services.tracker.forget(device_sn)
+            if services.presence is not None:
+                await services.presence.connect(device_sn, token)
+        elif services.presence is not None and device_sn is not None:
+            services.presence.seen(device_sn)
+        ARCHIVE.capture(message)
+        MESSAGE_COUNTERS.get(cmd or message['ret'], OTHER_MESSAGES).inc()
+
+        if cmd is not None:
+            handler = COMMAND_HANDLERS.get(cmd)
+            if handler is None:
+                raise Exception("Undefined message received.")
+            await handler(websocket, services, message)
+        elif receive and device_sn is not None:
+            await route_reply(r_db, pending, device_sn, message, raw)
+
+async def send_messages(websocket, registered, pending, dispatcher, tracker=None):
+    # commands are pushed to the device as soon as the dispatcher is told about them, interactive ones first
+    device_sn = await registered
+    queue = await dispatcher.register(device_sn, lambda: websocket.close(1000, "Connected elsewhere."))
+    try:
+        while True:
+            raw = await queue.get()
+            if raw is None: # the device reconnected elsewhere
+                return
+            envelope, outgoing = unpack_command(raw)
+            if envelope is not None and envelope.get('reply') is not None:
+                pending.add(outgoing['cmd'], envelope['reply'], envelope.get('timeout') or MAX_MESSAGE_TIMEOUT, envelope.get('channel'))
+            await send_response(websocket, outgoing)
+            ARCHIVE.capture(outgoing, "out")
+            SERVER_LOG.info("Outgoing message sent.", sn=device_sn, cmd=outgoing['cmd'])
+            if tracker is not None and outgoing['cmd'] in ('cleanlog', 'initsys'):
+                await tracker.reset(device_sn)
+            if outgoing['cmd'] == 'reboot':
+                SERVER_LOG.info("Rebooting. Bye bye!", sn=device_sn)
+                return
+    finally:
+        await dispatcher.unregister(device_sn, queue)
 
 # this function is called for each client connecting (after 'reg' handshake)
 # this function will not be called if the client does not connect
-async def handle(websocket, path, r_ip, r_port, sql_host, sql_user, sql_pass, sql_db, sql_table, insert=False, receive=False):
-    # connect to databases
-    device_sn = None
-    if insert:
-        sql_db = await connect_mssql(sql_host, sql_user, sql_pass, sql_db)
+async def handle(websocket, path, dispatcher, services, receive=False):
+    # reading from and writing to the device run as separate tasks; the connection ends when either one does
+    registered = asyncio.get_running_loop().create_future()
+    pending = PendingCommands()
+    token = uuid.uuid4().hex # identifies this connection in the device's presence
+    tasks = [asyncio.create_task(receive_messages(
+        websocket, registered, pending, dispatcher.r_db if receive else None, services, receive, token
+    ))]
     if receive:
-        r_db = redis.Redis(host=r_ip, port=r_port, db=0)
+        tasks.append(asyncio.create_task(send_messages(websocket, registered, pending, dispatcher, services.tracker)))
+
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+    except Exception as e:
+        SERVER_LOG.error(f"{e}.")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if registered.done():
+            CONNECTED_DEVICES.dec()
+        if services.presence is not None and registered.done():
+            try:
+                await services.presence.disconnect(registered.result(), token)
+            except Exception as e:
+                SERVER_LOG.error(f"Could not remove device presence. {e}.")
 
-    no_message_counter = 0
+# how late the event loop wakes up from a sleep; anything blocking the loop shows up here
+async def monitor_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
     while True:
+        start_time = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - start_time - interval))
+
+# gauges read from Redis and the writer when metrics are scraped rather than on every message
+async def collect_metrics(dispatcher, writer):
+    if dispatcher is not None:
+        sns = list(dispatcher.queues.keys())
+        async with dispatcher.r_db.pipeline(transaction=False) as pipe:
+            for sn in sns:
+                for key in lane_keys(KEYS, sn):
+                    pipe.llen(key)
+                pipe.llen(KEYS.incoming(sn))
+            depths = await pipe.execute()
+        QUEUE_DEPTH.clear()
+        for i, sn in enumerate(sns):
+            QUEUE_DEPTH.labels(sn, "out").set(depths[3 * i])
+            QUEUE_DEPTH.labels(sn, "bulk").set(depths[3 * i + 1])
+            QUEUE_DEPTH.labels(sn, "in").set(depths[3 * i + 2])
+    if writer is not None:
+        WRITER_QUEUE_DEPTH.set(writer.queue.qsize())
+        SPOOL_BACKLOG.set(writer.backlog())
+
+# answers plain HTTP requests for `/metrics` before the WebSocket handshake; other paths are upgraded as usual,
+# or refused on a port that only serves metrics (`metrics_only`)
+def metrics_endpoint(dispatcher, writer, metrics_only=False):
+    async def process_request(path, request_headers):
+        if path != "/metrics":
+            return (http.HTTPStatus.NOT_FOUND, [], b"Not found.\n") if metrics_only else None
         try:
-            # read message from client
-            try:
-                message = await asyncio.wait_for(websocket.recv(), timeout=NEW_MESSAGE_TIMEOUT)
-                no_message_counter = 0
-            except asyncio.TimeoutError:
-                message = None
-
-            if message is not None:
-                message = json.loads(message)
-                if device_sn is None and "sn" in message.keys():
-                    device_sn = message['sn']
-                save_file(message, RESPONSES_PATH)
-
-                # get response
-                if "cmd" in message.keys():
-                    response = get_response(message)
-                    if insert and sql_db is not None:
-                        await insert_record(message, sql_db, sql_table)
-                    await send_response(websocket, response)
-                elif "ret" in message.keys():
-                    if receive and device_sn is not None:
-                        r_db.rpush(f"{REDIS_DB_PREFIX}_{device_sn}_{REDIS_INCOMING_KEY}", json.dumps(message))
-                        print(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Incoming message ({message['ret']}) received from {device_sn}.")
-                        LOG_FILE.write(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Incoming message ({message['ret']}) received from {device_sn}.")
-            else:
-                no_message_counter += 1
-                if no_message_counter >= MAX_MESSAGE_TIMEOUT: # if no message received for a long time (default: ~ 5 min.), break
-                    print(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Idle timeout for device {device_sn} exceeded. Bye bye!")
-                    LOG_FILE.write(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Idle timeout for device {device_sn} exceeded.")
-                    break
-
-            # send message to client
-            if device_sn is not None:
-                if receive:
-                    outgoing = r_db.lpop(f"{REDIS_DB_PREFIX}_{device_sn}_{REDIS_OUTGOING_KEY}")
-                    if outgoing is not None:
-                        outgoing = json.loads(outgoing.decode())
-                        await send_response(websocket, outgoing)
-                        print(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Outgoing message sent to {device_sn}.")
-                        LOG_FILE.write(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Outgoing message sent to {device_sn}.")
-                        if outgoing['cmd'] == 'reboot':
-                            print(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Rebooting {device_sn}. Bye bye!")
-                            LOG_FILE.write(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Rebooting {device_sn}.")
-                            break
+            await collect_metrics(dispatcher, writer)
         except Exception as e:
-            print(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Error: {e}.")
-            LOG_FILE.write(f"[{dtnow()}] [{SERVER_LOG_PREFIX}] Error: {e}.")
-            break
-        finally:
-            pass
+            SERVER_LOG.error(f"Could not collect metrics. {e}.")
+        return http.HTTPStatus.OK, [("Content-Type", "text/plain; version=0.0.4")], REGISTRY.render().encode()
+    return process_request
+
+# on the port shared by the workers, a scrape would reach a random worker
+async def worker_metrics_notice(path, request_headers):
+    if path != "/metrics":
+        return None
+    return http.HTTPStatus.NOT_FOUND, [], f"Metrics are served per worker, on ports {METRICS_PORT} to {METRICS_PORT + WORKERS - 1}.\n".encode()
 
 async def main(ws_ip, ws_port, r_ip, r_port, sql_host, sql_user, sql_pass, sql_db, sql_table, insert, receive):
-    async with websockets.serve(lambda websocket, path: handle(
-        websocket, path, r_ip, r_port, sql_host, sql_user, sql_pass, sql_db, sql_table, insert, receive
-    ), ws_ip, ws_port, ping_timeout=None, ping_interval=None):
-        await asyncio.Future()
+    # SIGTERM (from the supervisor or `docker stop`) stops the server like Ctrl+C: the writer, archive and log are closed
+    main_task = asyncio.current_task()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(signum, main_task.cancel)
+
+    dispatcher = None
+    presence = None
+    r_db = None
+    tracker = None
+    if receive or insert or EVENTS_MAXLEN > 0:
+        r_db = aioredis.Redis(host=r_ip, port=r_port, db=0)
+        tracker = LogIndexTracker(r_db, KEYS, log=SERVER_LOG)
+    if receive:
+        dispatcher = OutgoingDispatcher(r_db, KEYS, NEW_MESSAGE_TIMEOUT, instance=INSTANCE_ID, log=SERVER_LOG)
+        presence = PresenceRegistry(r_db, KEYS, INSTANCE_ID, ttl=PRESENCE_TTL, heartbeat_interval=PRESENCE_HEARTBEAT, log=SERVER_LOG)
+        background_tasks = [asyncio.create_task(dispatcher.run()), asyncio.create_task(presence.run())]
+    lag_monitor = asyncio.create_task(monitor_loop_lag())
+
+    # records are written to the database in the background, batched across devices
+    writer = None
+    if insert:
+        spool = None
+        if SPOOL_PATH:
+            spool = Spool(SPOOL_PATH, segment_bytes=SPOOL_SEGMENT_BYTES, fsync_interval=SPOOL_FSYNC_INTERVAL, log=SERVER_LOG)
+        writer = RecordWriter(
+            sql_host, sql_user, sql_pass, sql_db, sql_table,
+            workers=MSSQL_WRITER_THREADS, batch_size=MSSQL_BATCH_SIZE, flush_interval=MSSQL_FLUSH_INTERVAL, spool=spool,
+            partition_months=MSSQL_PARTITION_MONTHS, quarantine=QUARANTINE_PATH, log=SERVER_LOG
+        )
+        writer.start()
+        if SPOOL_ROOT and WORKER in (None, 0): # the first process replays the spools no running process owns
+            owned = [SPOOL_PATH] if WORKER is None else [os.path.join(SPOOL_ROOT, f"worker-{i}") for i in range(WORKERS)]
+            writer.adopt(orphaned_spools(SPOOL_ROOT, owned))
+
+    # each worker serves its metrics on its own port, since the shared port reaches a random worker
+    metrics_server = None
+    if WORKER is not None:
+        metrics_server = await websockets.serve(
+            lambda websocket, path: websocket.close(), ws_ip, METRICS_PORT + WORKER,
+            process_request=metrics_endpoint(dispatcher, writer, metrics_only=True)
+        )
+
+    services = Services(presence, writer, r_db if EVENTS_MAXLEN > 0 else None, tracker)
+    try:
+        async with websockets.serve(lambda websocket, path: handle(
+            websocket, path, dispatcher, services, receive
+        ), ws_ip, ws_port, ping_timeout=None, ping_interval=None,
+            process_request=metrics_endpoint(dispatcher, writer) if WORKER is None else worker_metrics_notice,
+            reuse_port=WORKER is not None):
+            await asyncio.Future()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        if writer is not None:
+            writer.stop()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Websocket server for AiFace device.')
     parser.add_argument("--env", type=str, default="../.env", help="Config stored in an environment file.")
     parser.add_argument("--insert", action="store_true", help="Insert data to Microsoft SQL database.")
     parser.add_argument("--receive", action="store_true", help="Receive data from Redis database.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of server processes sharing the port.")
+    parser.add_argument("--worker", type=int, default=None, help=argparse.SUPPRESS)
     parser.set_defaults(insert=False, receive=False)
     args = parser.parse_args()
-    
+
+    if args.workers > 1 and args.worker is None:
+        sys.exit(Supervisor(sys.argv, args.workers).run())
+
+    # workers keep their files apart (one writer per spool, log and archive directory)
+    WORKER = args.worker
+    WORKERS = args.workers
+    def worker_path(path):
+        return os.path.join(path, f"worker-{WORKER}") if path and WORKER is not None else path
+
     SERVER_LOG_PREFIX = os.getenv("LOG_SERVER_PREFIX")
     CLIENT_LOG_PREFIX = os.getenv("LOG_CLIENT_PREFIX")
     REDIS_DB_PREFIX = os.getenv("REDIS_DB_PREFIX")
     REDIS_OUTGOING_KEY = os.getenv("REDIS_OUT_KEY")
     REDIS_INCOMING_KEY = os.getenv("REDIS_IN_KEY")
-    RESPONSES_PATH = os.getenv("PATH_WS_RESPONSES")
+    KEYS = RedisKeys(REDIS_DB_PREFIX, REDIS_OUTGOING_KEY, REDIS_INCOMING_KEY)
     NEW_MESSAGE_TIMEOUT = int(os.getenv("TIMEOUT_WS_NEW_MESSAGE"))
     MAX_MESSAGE_TIMEOUT = int(os.getenv("TIMEOUT_WS_MAX_WAIT"))
-    LOG_FILE = LogRecord(os.getenv("PATH_WS_LOG"))
-    LOG_FILE.open()
-
-    asyncio.run(main(
-        os.getenv("WEBSOCKET_IP"),
-        int(os.getenv("WEBSOCKET_PORT")),
-        os.getenv("REDIS_IP"),
-        int(os.getenv("REDIS_PORT")),
-        os.getenv("MSSQL_HOST"),
-        os.getenv("MSSQL_USER"),
-        os.getenv("MSSQL_PASS"),
-        os.getenv("MSSQL_DATA"),
-        os.getenv("MSSQL_TABL"),
-        args.insert,
-        args.receive
-    ))
-
-    LOG_FILE.close()
\ No newline at end of file
+    INCOMING_MAX_LENGTH = int(os.getenv("INCOMING_MAX_LENGTH", "100"))
+    INCOMING_TTL = int(os.getenv("INCOMING_TTL", "3600"))
+    INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+    METRICS_PORT = int(os.getenv("WS_METRICS_PORT", str(int(os.getenv("WEBSOCKET_PORT")) + 1)))
+    EVENTS_STREAM = KEYS.events(os.getenv("SITE_ID", "default"))
+    EVENTS_MAXLEN = int(os.getenv("EVENTS_MAXLEN", "0"))
+    codec.use_backend(os.getenv("WS_JSON_BACKEND", "auto"))
+    PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "90"))
+    PRESENCE_HEARTBEAT = int(os.getenv("PRESENCE_HEARTBEAT", "30"))
+    MSSQL_WRITER_THREADS = int(os.getenv("MSSQL_WRITER_THREADS", "2"))
+    MSSQL_BATCH_SIZE = int(os.getenv("MSSQL_BATCH_SIZE", "500"))
+    MSSQL_FLUSH_INTERVAL = float(os.getenv("MSSQL_FLUSH_INTERVAL", "1"))
+    MSSQL_PARTITION_MONTHS = int(os.getenv("MSSQL_PARTITION_MONTHS", "0"))
+    SPOOL_ROOT = os.getenv("PATH_WS_SPOOL")
+    SPOOL_PATH = worker_path(SPOOL_ROOT)
+    QUARANTINE_PATH = worker_path(os.getenv("PATH_WS_QUARANTINE"))
+    SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+    SPOOL_FSYNC_INTERVAL = float(os.getenv("SPOOL_FSYNC_INTERVAL", "0.2"))
+    EVENT_LOG = EventLog(
+        worker_path(os.getenv("PATH_WS_LOG")),
+        level=LEVELS[os.getenv("LOG_LEVEL", "INFO").upper()],
+        console=os.getenv("LOG_CONSOLE", "1") == "1",
+        max_bytes=int(os.getenv("LOG_ROTATE_BYTES", str(10 * 1024 * 1024))),
+        max_age=int(os.getenv("LOG_ROTATE_SECONDS", "86400"))
+    )
+    EVENT_LOG.open()
+    SERVER_LOG = EVENT_LOG.bind(SERVER_LOG_PREFIX)
+    CLIENT_LOG = EVENT_LOG.bind(CLIENT_LOG_PREFIX)
+    ARCHIVE = MessageArchive(
+        worker_path(os.getenv("PATH_WS_ARCHIVE")),
+        mode=os.getenv("ARCHIVE_MODE", "off"),
+        sample=int(os.getenv("ARCHIVE_SAMPLE", "1")),
+        cmds=[cmd.strip() for cmd in os.getenv("ARCHIVE_CMDS", "").split(",") if cmd.strip()],
+        max_age=int(os.getenv("ARCHIVE_ROTATE_SECONDS", "3600")),
+        log=SERVER_LOG
+    )
+    ARCHIVE.open()
+
+    try:
+        asyncio.run(main(
+            os.getenv("WEBSOCKET_IP"),
+            int(os.getenv("WEBSOCKET_PORT")),
+            os.getenv("REDIS_IP"),
+            int(os.getenv("REDIS_PORT")),
+            os.getenv("MSSQL_HOST"),
+            os.getenv("MSSQL_USER"),
+            os.getenv("MSSQL_PASS"),
+            os.getenv("MSSQL_DATA"),
+            os.getenv("MSSQL_TABL"),
+            args.insert,
+            args.receive
+        ))
+    except asyncio.CancelledError: # stopped by SIGTERM or SIGINT
+        SERVER_LOG.info("Server stopped.")
+
+    ARCHIVE.close()
+    EVENT_LOG.close()
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""
+FILE: archive.py
+
+DESCRIPTION: Rolling archive of messages exchanged with AiFace devices, and a small tool to search and replay it.
+
+NOTES:
+- Mode `off` captures nothing, `sample` captures one in every `sample` messages of each `cmd`/`ret`, and `full` captures everything.
+  If `cmds` is given, only those commands are captured.
+- Messages are written as compact NDJSON lines (`{"t": ..., "dir": "in" | "out", "msg": {...}}`) by a background thread
+  into files rotated every `max_age` seconds and gzip-compressed.
+- Usage: `python archive.py ../archive --sn ZXRB22001001 --cmd sendlog` prints matching lines,
+  `--replay ws://localhost:7788` sends the matching device messages to a WebSocket server again.
+"""
+
+import os
+import gzip
+import json
+import time
+import queue
+import asyncio
+import threading
+from argparse import ArgumentParser
+
+from logger import ConsoleLog, RotatingFile, drain
+
+MODES = ("off", "sample", "full")
+
+class MessageArchive:
+    def __init__(self, path, mode="off", sample=1, cmds=None, max_age=3600, max_bytes=256 * 1024 * 1024, log=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown archive mode {mode}.")
+        self.mode = mode
+        self.sample = max(1, sample)
+        self.cmds = set(cmds) if cmds else None
+        self.log = log if log is not None else ConsoleLog()
+
+        self.file = RotatingFile(path, "messages", ".ndjson", max_bytes, max_age)
+        self.queue = queue.SimpleQueue()
+        self.counters = {}
+        self.thread = None
+
+    def open(self):
+        if self.mode == "off":
+            return
+        self.file.open()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.file.close()
+
+    def capture(self, message, direction="in"):
+        if self.mode == "off":
+            return
+        name = message.get('cmd') or message.get('ret')
+        if self.cmds is not None and name not in self.cmds:
+            return
+        if self.mode == "sample":
+            count = self.counters.get(name, 0)
+            self.counters[name] = count + 1
+            if count % self.sample != 0:
+                return
+        self.queue.put((time.time(), direction, message))
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            items, stopping = drain(self.queue)
+            if len(items) == 0:
+                continue
+            data = "".join(
+                json.dumps({"t" : round(t, 3), "dir" : direction, "msg" : message}, separators=(",", ":"), ensure_ascii=False) + "\n"
+                for t, direction, message in items
+            )
+            try:
+                self.file.write(data)
+            except Exception as e:
+                self.log.error(f"Could not write message archive. {e}.")
+
+# archived lines in chronological order (rotated files first, the current file last)
+def read_archive(path):
+    names = sorted(name for name in os.listdir(path) if name.startswith("messages-"))
+    if os.path.exists(os.path.join(path, "messages.ndjson")):
+        names.append("messages.ndjson")
+    for name in names:
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(os.path.join(path, name), 'rt', encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield line
+
+def select(lines, sn=None, cmd=None, direction=None, pattern=None):
+    for line in lines:
+        if pattern is not None and pattern not in line:
+            continue
+        entry = json.loads(line)
+        message = entry['msg']
+        if sn is not None and message.get('sn') != sn:
+            continue
+        if cmd is not None and cmd not in (message.get('cmd'), message.get('ret')):
+            continue
+        if direction is not None and entry['dir'] != direction:
+            continue
+        yield entry
+
+# replay the device side of the archive, one connection per device, keeping the original gaps scaled by `speed`
+async def replay(entries, url, speed=0.0):
+    import websockets
+
+    devices = {}
+    for entry in entries:
+        if entry['dir'] == "in" and "cmd" in entry['msg']:
+            devices.setdefault(entry['msg'].get('sn'), []).append(entry)
+
+    async def replay_device(sn, entries):
+        async with websockets.connect(url) as websocket:
+            previous = None
+            for entry in entries:
+                if speed > 0 and previous is not None:
+                    await asyncio.sleep((entry['t'] - previous) / speed)
+                previous = entry['t']
+                await websocket.send(json.dumps(entry['msg']))
+                print(f"[{sn}] > {entry['msg']['cmd']} < {await websocket.recv()}")
+
+    await asyncio.gather(*[replay_device(sn, entries) for sn, entries in devices.items()])
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Search and replay the message archive of the WebSocket server.')
+    parser.add_argument("path", type=str, help="Archive directory (PATH_WS_ARCHIVE).")
+    parser.add_argument("--sn", type=str, default=None, help="Only messages from/to this device.")
+    parser.add_argument("--cmd", type=str, default=None, help="Only messages with this `cmd` or `ret`.")
+    parser.add_argument("--dir", type=str, default=None, choices=["in", "out"], help="Only incoming or outgoing messages.")
+    parser.add_argument("--grep", type=str, default=None, help="Only lines containing this text.")
+    parser.add_argument("--replay", type=str, default=None, help="Send the matching device messages to this WebSocket URL.")
+    parser.add_argument("--speed", type=float, default=0.0, help="Replay speed relative to the original timing (0 = as fast as possible).")
+    args = parser.parse_args()
+
+    entries = select(read_archive(args.path), args.sn, args.cmd, args.dir, args.grep)
+    if args.replay is not None:
+        asyncio.run(replay(list(entries), args.replay, args.speed))
+    else:
+        for entry in entries:
+            print(json.dumps(entry, ensure_ascii=False))
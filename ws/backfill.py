@@ -0,0 +1,324 @@
+"""
+FILE: backfill.py
+
+DESCRIPTION: Bulk load of captured `sendlog` records (message archives, JSON files) into the MSSQL database.
+
+NOTES:
+- Inputs are files or directories (walked recursively): `.json` files holding a message or a list of messages,
+  and `.ndjson`/`.jsonl` files (optionally `.gz`), one message or one archive line (see `archive.py`) per line.
+  Records are taken from `sendlog` messages and from `getalllog`/`getnewlog` replies.
+- Files are parsed in a process pool; rows are inserted in large batches over a few parallel connections.
+  The fastest path available is used: TDS bulk copy (`bulk_copy`, pymssql 2.2.8+), otherwise multi-row inserts.
+- Records already in the table are skipped by its unique index (schema version 3, see `common/database.py`); records
+  repeated within a file are dropped before they are sent. Duplicates are only counted on the insert path.
+- Records whose time cannot be parsed get the time they were archived, or are skipped if there is none.
+- A batch the database rejects because of its values (see `data_error` in `common/database.py`) is not retried: it is
+  halved until the rejected records are found, which are set aside in `<quarantine>/quarantine.ndjson` (the format of
+  the writer's quarantine, see `writer.py`), and the rest is loaded. Only connection errors are retried.
+- Completed files are recorded in a checkpoint file, so a run that is stopped resumes with the files it had not finished.
+  A file that changed since (size or modification time) is loaded again.
+- Usage: `python backfill.py ../archive backups/ --env ../.env --connections 4 --workers 8 --quarantine ../quarantine`
+"""
+
+import datetime
+import gzip
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.database import ConnectionPool, migrate, data_error, LOG_COLUMNS, TIME_FORMAT
+from logger import ConsoleLog
+from writer import insert_rows, Quarantine, COLUMNS
+
+SUFFIXES = (".json", ".ndjson", ".jsonl", ".json.gz", ".ndjson.gz", ".jsonl.gz")
+LOG_REPLIES = ("getalllog", "getnewlog")
+COLUMN_IDS = [LOG_COLUMNS.index(column) + 1 for column in COLUMNS] # ordinals of the columns for `bulk_copy`
+
+def optional_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# typed rows of the records of a message (in `COLUMNS` order); `received` (UNIX time) replaces unreadable record times
+def message_rows(message, received=None):
+    rows, invalid = [], 0
+    fallback = datetime.datetime.fromtimestamp(received).replace(microsecond=0) if received is not None else None
+    records = message.get('record', [])
+    if message.get('cmd') == 'sendlog':
+        records = records[:message.get('count', len(records))]
+    for record in records:
+        try:
+            record_time = datetime.datetime.strptime(record['time'], TIME_FORMAT)
+        except (KeyError, TypeError, ValueError):
+            record_time = fallback
+        enrollid = optional_int(record.get('enrollid'))
+        if record_time is None or enrollid is None or not message.get('sn'):
+            invalid += 1
+            continue
+        rows.append((
+            str(message['sn']), enrollid, optional_int(record.get('aliasid')), record.get('name'), record_time,
+            optional_int(record.get('mode')), optional_int(record.get('inout')), optional_int(record.get('event'))
+        ))
+    return rows, invalid
+
+# (message, UNIX time archived or None) of every item of a file
+def read_messages(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt', encoding="utf-8") as f:
+        if path.endswith((".json", ".json.gz")):
+            items = json.load(f)
+            items = items if isinstance(items, list) else [items]
+        else:
+            items = (json.loads(line) for line in f if line.strip())
+        for item in items:
+            if isinstance(item, dict) and "msg" in item and "dir" in item: # archive line
+                if item['dir'] == "in":
+                    yield item['msg'], item.get('t')
+            elif isinstance(item, dict):
+                yield item, None
+
+# runs in the process pool: returns (path, rows without repeats, records skipped, error)
+def parse_file(path):
+    rows, seen, invalid = [], set(), 0
+    try:
+        for message, received in read_messages(path):
+            if message.get('cmd') != 'sendlog' and message.get('ret') not in LOG_REPLIES:
+                continue
+            records, skipped = message_rows(message, received)
+            invalid += skipped
+            for row in records:
+                key = (row[0], row[1], row[4], row[5], row[6], row[7]) # columns of the table's unique index
+                if key not in seen:
+                    seen.add(key)
+                    rows.append(row)
+    except (OSError, ValueError) as e:
+        return path, [], invalid, f"{e}"
+    return path, rows, invalid, None
+
+def input_files(paths, exclude=()):
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(os.path.abspath(path))
+            continue
+        for root, _, names in os.walk(path):
+            files.extend(os.path.abspath(os.path.join(root, name)) for name in names if name.endswith(SUFFIXES))
+    return sorted(set(files) - set(exclude))
+
+# files already loaded, by absolute path, with the size and modification time they had
+class Checkpoint:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                self.files = json.load(f)['files']
+        except (OSError, ValueError, KeyError):
+            self.files = {}
+
+    def done(self, path):
+        entry = self.files.get(path)
+        stat = os.stat(path)
+        return entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+    def complete(self, path, rows):
+        stat = os.stat(path)
+        with self.lock:
+            self.files[path] = {"size" : stat.st_size, "mtime" : stat.st_mtime, "rows" : rows}
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w') as f:
+                json.dump({"files" : self.files}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+
+class Backfill:
+    def __init__(self, host, user, password, database, table, connections=4, batch_size=10000, method="auto", retries=3, quarantine=None, log=None):
+        self.pool = ConnectionPool(host, user, password, database)
+        self.table = table
+        self.connections = connections
+        self.batch_size = batch_size
+        self.method = method
+        self.retries = retries
+        self.log = log if log is not None else ConsoleLog()
+        self.quarantine = Quarantine(quarantine, self.log)
+
+        self.queue = queue.Queue(maxsize=connections * 4)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.remaining = {} # batches of each file not written yet
+        self.failed = set()
+        self.checkpoint = None
+        self.stats = {"files" : 0, "rows" : 0, "inserted" : 0, "duplicates" : 0, "invalid" : 0, "quarantined" : 0, "failed_batches" : 0}
+
+    def prepare(self):
+        conn = self.pool.get()
+        version = migrate(conn, self.table)
+        if self.method == "auto":
+            self.method = "bulk" if hasattr(conn, "bulk_copy") else "insert"
+        self.pool.put(conn)
+        self.log.info(f"Table {self.table} is at schema version {version}. Loading with {self.method}.")
+
+    def start(self, checkpoint):
+        self.checkpoint = checkpoint
+        for _ in range(self.connections):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.pool.close()
+
+    # split the rows of a parsed file into batches for the writer threads (blocks while they are busy)
+    def submit(self, path, rows, invalid):
+        batches = [rows[i:i + self.batch_size] for i in range(0, len(rows), self.batch_size)]
+        with self.lock:
+            self.stats['invalid'] += invalid
+            self.remaining[path] = [len(batches), len(rows)]
+        if len(batches) == 0:
+            self.finish(path)
+        for batch in batches:
+            self.queue.put((path, batch))
+
+    def finish(self, path):
+        with self.lock:
+            _, rows = self.remaining.pop(path)
+            failed = path in self.failed
+            self.stats['files'] += 0 if failed else 1
+        if not failed:
+            self.checkpoint.complete(path, rows)
+
+    # returns the number of rows skipped as duplicates (0 on the bulk path, where they cannot be counted)
+    def write(self, conn, batch):
+        if self.method == "bulk":
+            conn.bulk_copy(self.table, batch, column_ids=COLUMN_IDS, batch_size=len(batch))
+            conn.commit()
+            return 0
+        return insert_rows(conn, self.table, batch)
+
+    # returns (duplicates, rows quarantined); a batch the database rejects is halved until the rejected rows are found
+    def store(self, conn, batch):
+        try:
+            return self.write(conn, batch), 0
+        except Exception as e:
+            if not data_error(e):
+                raise
+            conn.rollback()
+            if len(batch) == 1:
+                self.quarantine.add(batch, e)
+                return 0, 1
+            middle = len(batch) // 2
+            first, second = self.store(conn, batch[:middle]), self.store(conn, batch[middle:])
+            return first[0] + second[0], first[1] + second[1]
+
+    def run(self):
+        conn = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, batch = item
+            duplicates = quarantined = None
+            for attempt in range(self.retries + 1): # only connection errors reach this loop
+                try:
+                    conn = conn if conn is not None else self.pool.get()
+                    duplicates, quarantined = self.store(conn, batch)
+                    break
+                except Exception as e:
+                    if conn is not None:
+                        self.pool.discard(conn)
+                        conn = None
+                    if attempt == self.retries:
+                        self.log.error(f"Could not load {len(batch)} records from {path}. {e}.")
+                    else:
+                        time.sleep(2 ** attempt)
+            with self.lock:
+                if duplicates is None:
+                    self.failed.add(path)
+                    self.stats['failed_batches'] += 1
+                else:
+                    self.stats['rows'] += len(batch)
+                    self.stats['inserted'] += len(batch) - duplicates - quarantined
+                    self.stats['duplicates'] += duplicates
+                    self.stats['quarantined'] += quarantined
+                self.remaining[path][0] -= 1
+                done = self.remaining[path][0] == 0
+            if done:
+                self.finish(path)
+        if conn is not None:
+            self.pool.put(conn)
+
+    def report(self, start_time, total):
+        with self.lock:
+            stats = dict(self.stats)
+        elapsed = max(time.monotonic() - start_time, 1e-9)
+        self.log.info(
+            f"{stats['files']}/{total} files, {stats['rows']} records ({stats['rows'] / elapsed:.0f} records/s), "
+            f"{stats['duplicates']} duplicates, {stats['invalid']} invalid, {stats['quarantined']} quarantined, {stats['failed_batches']} failed batches."
+        )
+        return stats
+
+def run_backfill(backfill, files, checkpoint, workers, report_interval):
+    backfill.prepare()
+    backfill.start(checkpoint)
+    start_time = last_report = time.monotonic()
+    total = len(files)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending, files = set(), list(files)
+            while len(files) > 0 or len(pending) > 0:
+                while len(files) > 0 and len(pending) < workers * 2: # bounds the parsed rows held in memory
+                    pending.add(executor.submit(parse_file, files.pop(0)))
+                done, pending = wait(pending, timeout=report_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, rows, invalid, error = future.result()
+                    if error is not None:
+                        backfill.log.error(f"Could not read {path}. {error}.")
+                        continue
+                    backfill.submit(path, rows, invalid)
+                if time.monotonic() - last_report >= report_interval:
+                    backfill.report(start_time, total)
+                    last_report = time.monotonic()
+    finally:
+        backfill.stop()
+    return backfill.report(start_time, total)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Load archived `sendlog` records into the MSSQL database.')
+    parser.add_argument("paths", type=str, nargs="+", help="Files or directories to load.")
+    parser.add_argument("--env", type=str, default="../.env", help="Config stored in an environment file.")
+    parser.add_argument("--checkpoint", type=str, default="backfill.checkpoint.json", help="File recording the files already loaded.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes parsing files.")
+    parser.add_argument("--connections", type=int, default=4, help="Parallel database connections.")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Records per batch.")
+    parser.add_argument("--method", type=str, default="auto", choices=["auto", "bulk", "insert"], help="Bulk copy or multi-row inserts (auto = bulk copy if available).")
+    parser.add_argument("--quarantine", type=str, default="backfill-quarantine", help="Directory of the records the database rejects.")
+    parser.add_argument("--report", type=float, default=5.0, help="Seconds between progress reports.")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint)
+    checkpoint.load()
+    quarantine_file = os.path.abspath(os.path.join(args.quarantine, "quarantine.ndjson")) # written during this run
+    files = [path for path in input_files(args.paths, exclude=(checkpoint.path, quarantine_file)) if not checkpoint.done(path)]
+    print(f"{len(files)} files to load ({len(checkpoint.files)} loaded before).")
+
+    backfill = Backfill(
+        os.getenv("MSSQL_HOST"), os.getenv("MSSQL_USER"), os.getenv("MSSQL_PASS"), os.getenv("MSSQL_DATA"), os.getenv("MSSQL_TABL"),
+        connections=args.connections, batch_size=args.batch_size, method=args.method, quarantine=args.quarantine
+    )
+    stats = run_backfill(backfill, files, checkpoint, args.workers, args.report)
+    sys.exit(0 if stats['failed_batches'] == 0 else 1)
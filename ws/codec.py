@@ -0,0 +1,163 @@
+"""
+FILE: codec.py
+
+DESCRIPTION: Decoding, validation and encoding of the JSON frames exchanged with AiFace devices.
+
+NOTES:
+- The JSON backend is `orjson` when it is installed and `json` otherwise; `use_backend()` (`WS_JSON_BACKEND`) picks one.
+- Frames are checked against the shape of their `cmd` (`reg`, `sendlog`, including every record it carries) or of a
+  reply (`ret`; successful replies also against the shape of their command, see `responses/`) with validators compiled
+  once at import. A frame that fails raises `MessageError`, which carries the decoded message if any.
+- Acknowledgements are built from frames prepared once per second (`cloudtime` has a one-second resolution), so
+  acknowledging a `sendlog` batch costs one string formatting instead of a copy and an encoding of a dictionary.
+"""
+
+import json
+import time
+from operator import itemgetter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class MessageError(ValueError):
+    def __init__(self, reason, message=None):
+        super().__init__(reason)
+        self.message = message
+
+def json_dumps(message):
+    return json.dumps(message, separators=(",", ":"))
+
+def orjson_dumps(message):
+    return orjson.dumps(message).decode()
+
+BACKENDS = {"json" : (json.loads, json_dumps)}
+if orjson is not None:
+    BACKENDS['orjson'] = (orjson.loads, orjson_dumps)
+
+# `auto` is the fastest backend installed; returns the name of the backend in use
+def use_backend(name="auto"):
+    global loads, dumps, BACKEND
+    if name == "auto":
+        name = "orjson" if "orjson" in BACKENDS else "json"
+    if name not in BACKENDS:
+        raise ValueError(f"JSON backend {name} is not available.")
+    loads, dumps = BACKENDS[name]
+    BACKEND = name
+    return name
+
+use_backend()
+
+# returns a function giving the reason a message does not have the given fields (None if it does);
+# `fields` maps a key to the exact types its value may have, `check` adds a test of the whole message
+def compile_schema(fields, check=None):
+    items = tuple((key, types, f"`{key}` is missing or not {' or '.join(t.__name__ for t in types)}.") for key, types in fields.items())
+
+    def validate(message):
+        for key, types, reason in items:
+            if type(message.get(key)) not in types:
+                return reason
+        return check(message) if check is not None else None
+
+    return validate
+
+# returns a check that the first `count` items (all without `count_key`) of `record` are objects holding `keys`
+def compile_records(keys, count_key=None):
+    reason = f"Every record needs {', '.join(f'`{key}`' for key in keys)}."
+    get = itemgetter(*keys) # raises KeyError if a key is missing
+
+    def check(message):
+        records = message['record'] if count_key is None else message['record'][:message[count_key]]
+        try:
+            for record in records:
+                if type(record) is not dict:
+                    return reason
+                get(record)
+        except KeyError:
+            return reason
+        return None
+
+    return check
+
+RECORD_KEYS = ("enrollid", "aliasid", "name", "time", "mode", "inout", "event") # read by `writer.record_rows`
+check_sendlog_records = compile_records(RECORD_KEYS, "count")
+
+def check_sendlog(message):
+    if message['count'] < 0 or len(message['record']) < message['count']:
+        return "`count` does not match `record`."
+    return check_sendlog_records(message)
+
+COMMAND_SCHEMAS = {
+    "reg" : compile_schema({"sn" : (str,), "devinfo" : (dict,)}),
+    "sendlog" : compile_schema({"sn" : (str,), "count" : (int,), "logindex" : (int,), "record" : (list,)}, check_sendlog)
+}
+
+# every reply; a successful one is also checked against the shape of its `ret` (see `responses/`), limited to the
+# fields the servers and tools read
+REPLY_SCHEMA = compile_schema({"ret" : (str,), "result" : (bool,)})
+PAGE_FIELDS = {"count" : (int,), "to" : (int,), "record" : (list,)}
+REPLY_SCHEMAS = {
+    "getuserlist" : compile_schema(PAGE_FIELDS, compile_records(("enrollid", "backupnum"))),
+    "getalllog" : compile_schema(PAGE_FIELDS, compile_records(("enrollid", "time"))),
+    "getnewlog" : compile_schema(PAGE_FIELDS, compile_records(("enrollid", "time"))),
+    "getuserinfo" : compile_schema({"enrollid" : (int,), "backupnum" : (int,)}),
+    "setuserinfo" : compile_schema({"enrollid" : (int,), "backupnum" : (int,)}),
+    "enableuser" : compile_schema({"enrollid" : (int,)}),
+    "getuserlock" : compile_schema({"enrollid" : (int,)})
+}
+
+def check_reply(message):
+    reason = REPLY_SCHEMA(message)
+    if reason is None and message['result'] is True:
+        validate = REPLY_SCHEMAS.get(message['ret'])
+        reason = validate(message) if validate is not None else None
+    return reason
+
+# decoded and validated message; commands without a schema are only required to be named
+def decode(raw):
+    try:
+        message = loads(raw)
+    except ValueError as e:
+        raise MessageError(f"Invalid JSON. {e}.")
+    if type(message) is not dict:
+        raise MessageError("Not a JSON object.")
+    cmd = message.get('cmd')
+    if cmd is not None:
+        validate = COMMAND_SCHEMAS.get(cmd)
+        reason = validate(message) if validate is not None else None
+    elif "ret" in message:
+        reason = check_reply(message)
+    else:
+        reason = "Neither `cmd` nor `ret`."
+    if reason is not None:
+        raise MessageError(reason, message)
+    return message
+
+# acknowledgement frames, prepared again when the second of `cloudtime` changes
+class AckFrames:
+    def __init__(self):
+        self.second = None
+        self.cloudtime = None
+        self.reg_frame = None
+        self.sendlog_template = None
+
+    def refresh(self):
+        second = int(time.time())
+        if second != self.second:
+            self.second = second
+            self.cloudtime = time.strftime(TIME_FORMAT, time.localtime(second))
+            self.reg_frame = '{"ret":"reg","result":true,"cloudtime":"' + self.cloudtime + '","nosenduser":true}'
+            self.sendlog_template = '{"ret":"sendlog","result":true,"count":%d,"logindex":%d,"cloudtime":"' + self.cloudtime + '","access":1}'
+
+    def reg(self):
+        self.refresh()
+        return self.reg_frame
+
+    def sendlog(self, count, logindex):
+        self.refresh()
+        return self.sendlog_template % (count, logindex)
+
+SENDLOG_FAIL_FRAME = '{"ret":"sendlog","result":false,"reason":"1"}'
@@ -0,0 +1,180 @@
+"""
+FILE: dispatcher.py
+
+DESCRIPTION: Event-driven delivery of outgoing commands from Redis to connected AiFace devices.
+
+NOTES:
+- Pushers queue a command in one of the device's lanes and `PUBLISH` the device's serial number on the inbox channel
+  of the instance owning the device, or on the shared notify channel (see `common/queues.py`).
+- A single subscriber per process wakes the connections of the notified devices. Each connection then takes its
+  commands from Redis one at a time (`DEQUEUE_SCRIPT`), so commands stay in Redis until they are sent, interactive
+  commands overtake bulk ones, and expired commands are dropped instead of being sent.
+- When a device reconnects, the previous connection (on this or another instance) is closed; the commands it had not
+  taken yet are sent on the new connection.
+- Lanes filled without a notification (e.g., manual scripts) are picked up by a periodic sweep of all connected devices.
+- Replies (`ret`) are routed back to the reply key of the oldest pending command of the same name.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+from common.metrics import Counter
+from common.queues import lane_keys, dequeue_command, DEQUEUE_SCRIPT
+from logger import ConsoleLog
+
+EXPIRED_COMMANDS = Counter("face_ws_expired_commands_total", "Outgoing commands dropped because they expired before being sent.")
+
+# the commands of one connection; `get` waits until the device has a command or the connection is replaced
+class DeviceQueue:
+    def __init__(self, dispatcher, sn):
+        self.dispatcher = dispatcher
+        self.sn = sn
+        self.ready = asyncio.Event()
+        self.ready.set() # commands may have been queued while the device was offline
+        self.closed = False
+
+    def wake(self):
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    # returns the next command (raw), or None once the connection is replaced
+    async def get(self):
+        while not self.closed:
+            self.ready.clear() # before reading, so that a notification arriving meanwhile is not missed
+            raw = await self.dispatcher.dequeue(self.sn)
+            if raw is not None:
+                return raw
+            await self.ready.wait()
+        return None
+
+class OutgoingDispatcher:
+    def __init__(self, r_db, keys, sweep_interval, instance="", log=None):
+        self.r_db = r_db
+        self.keys = keys
+        self.sweep_interval = sweep_interval
+        self.instance = instance
+        self.log = log if log is not None else ConsoleLog()
+        self.queues = {}
+        self.closers = {}
+        self.closing = set()
+        self.dequeue_script = r_db.register_script(DEQUEUE_SCRIPT)
+
+    # called once the serial number of a connection is known; `close` closes the connection if the device reconnects
+    async def register(self, sn, close=None):
+        queue = DeviceQueue(self, sn)
+        previous = self.queues.get(sn)
+        self.queues[sn] = queue
+        if previous is not None:
+            previous.close()
+            self.close(self.closers.pop(sn, None))
+        if close is not None:
+            self.closers[sn] = close
+
+        return queue
+
+    async def unregister(self, sn, queue):
+        queue.close()
+        if self.queues.get(sn) is queue:
+            del self.queues[sn]
+            self.closers.pop(sn, None)
+
+    # the next command that has not expired (raw), or None if the device has none
+    async def dequeue(self, sn):
+        dropped, *command = await self.dequeue_script(**dequeue_command(self.keys, sn, time.time()))
+        if dropped > 0:
+            EXPIRED_COMMANDS.inc(dropped)
+            self.log.info(f"Dropped {dropped} expired outgoing messages.", sn=sn)
+        return command[0] if len(command) > 0 else None
+
+    def close(self, close):
+        if close is not None:
+            task = asyncio.create_task(close())
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+
+    # the device reconnected to another instance: stop delivering to it and close the stale connection
+    async def release(self, sn):
+        if sn not in self.queues:
+            return
+        owner = await self.r_db.hget(self.keys.presence(sn), "instance")
+        if owner is not None and owner.decode() == self.instance: # reconnected here again since
+            return
+        queue = self.queues.pop(sn, None)
+        if queue is not None:
+            queue.close()
+            self.log.info("Device reconnected to another server.", sn=sn)
+            self.close(self.closers.pop(sn, None))
+
+    def wake(self, sns):
+        for sn in sns:
+            queue = self.queues.get(sn)
+            if queue is not None:
+                queue.wake()
+
+    async def sweep(self):
+        sns = list(self.queues.keys())
+        if len(sns) == 0:
+            return
+        async with self.r_db.pipeline(transaction=False) as pipe:
+            for sn in sns:
+                for key in lane_keys(self.keys, sn):
+                    pipe.llen(key)
+            lengths = await pipe.execute()
+        self.wake([sn for i, sn in enumerate(sns) if lengths[2 * i] + lengths[2 * i + 1] > 0])
+
+    async def listen(self):
+        loop = asyncio.get_running_loop()
+        pubsub = self.r_db.pubsub(ignore_subscribe_messages=True)
+        takeover = self.keys.takeover(self.instance).encode()
+        await pubsub.subscribe(self.keys.notify(), self.keys.inbox(self.instance), takeover)
+        try:
+            next_sweep = loop.time() + self.sweep_interval
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=max(0.0, next_sweep - loop.time()))
+                while message is not None:
+                    sn = message['data'].decode()
+                    if message['channel'] == takeover:
+                        await self.release(sn)
+                    else:
+                        self.wake([sn])
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.0)
+
+                if loop.time() >= next_sweep:
+                    await self.sweep()
+                    next_sweep = loop.time() + self.sweep_interval
+        finally:
+            await pubsub.close()
+
+    # runs for the lifetime of the server; reconnects to Redis on failure
+    async def run(self):
+        while True:
+            try:
+                await self.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log.error(f"Outgoing dispatcher lost connection to Redis. {e}.")
+                await asyncio.sleep(self.sweep_interval)
+
+# commands sent to a single device that are still waiting for a reply
+class PendingCommands:
+    def __init__(self):
+        self.commands = deque()
+
+    def add(self, cmd, reply, timeout, channel=None):
+        self.commands.append((cmd, reply, timeout, time.monotonic() + timeout, channel))
+
+    # returns (reply key, timeout, channel) of the oldest command named `ret`, or None if nobody is waiting for it
+    def match(self, ret):
+        now = time.monotonic()
+        while len(self.commands) > 0 and self.commands[0][3] < now:
+            self.commands.popleft()
+        for command in self.commands:
+            if command[0] == ret and command[3] >= now:
+                self.commands.remove(command)
+                return command[1], command[2], command[4]
+        return None
@@ -0,0 +1,201 @@
+"""
+FILE: logger.py
+
+DESCRIPTION: Non-blocking structured logging for the WebSocket server.
+
+NOTES:
+- Events are queued by the caller and formatted once, as JSON lines, by a background thread that writes them in
+  batches to the console and to a log file.
+- Events below the configured level (`DEBUG`, `INFO`, `WARNING`, `ERROR`) are discarded before they are queued;
+  per-record lines are logged at `DEBUG`.
+- The log file is rotated once it exceeds `max_bytes` or is older than `max_age` seconds; rotated files are gzip-compressed.
+"""
+
+import os
+import sys
+import gzip
+import json
+import queue
+import shutil
+import threading
+import time
+import datetime
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG : "DEBUG", INFO : "INFO", WARNING : "WARNING", ERROR : "ERROR"}
+LEVELS = {name : level for level, name in LEVEL_NAMES.items()}
+
+# file rotated by size or age; rotated files are compressed in the background
+class RotatingFile:
+    def __init__(self, path, basename, suffix, max_bytes=10 * 1024 * 1024, max_age=86400):
+        self.path = path
+        self.basename = basename
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.file = None
+        self.size = 0
+        self.opened_at = 0.0
+
+    def current_path(self):
+        return os.path.join(self.path, f"{self.basename}{self.suffix}")
+
+    def open(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.file = open(self.current_path(), 'a', encoding="utf-8")
+        self.size = self.file.tell()
+        self.opened_at = time.time()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, data):
+        if self.file is None:
+            return
+        if self.size > 0 and (self.size + len(data) > self.max_bytes or time.time() - self.opened_at >= self.max_age):
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        self.close()
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        rotated = os.path.join(self.path, f"{self.basename}-{stamp}{self.suffix}")
+        os.replace(self.current_path(), rotated)
+        threading.Thread(target=compress, args=(rotated,), daemon=True).start()
+        self.open()
+
+# take everything already queued (up to `limit` items); a `None` item asks the consumer to stop
+def drain(items, limit=1000):
+    batch = []
+    item = items.get()
+    while item is not None:
+        batch.append(item)
+        if len(batch) >= limit:
+            break
+        try:
+            item = items.get_nowait()
+        except queue.Empty:
+            break
+    return batch, item is None
+
+def compress(path):
+    with open(path, 'rb') as source, gzip.open(path + ".gz", 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.remove(path)
+
+class EventLog:
+    def __init__(self, path=None, level=INFO, console=True, max_bytes=10 * 1024 * 1024, max_age=86400, basename="log"):
+        self.level = level
+        self.console = console
+        self.file = RotatingFile(path, basename, ".jsonl", max_bytes, max_age) if path is not None else None
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.times = (0, "") # cache of the last formatted second
+
+    def open(self):
+        if self.file is not None:
+            self.file.open()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.file is not None:
+            self.file.close()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, source, message, fields=None):
+        if level >= self.level:
+            self.queue.put((time.time(), level, source, message, fields))
+
+    def debug(self, source, message, **fields):
+        self.log(DEBUG, source, message, fields)
+
+    def info(self, source, message, **fields):
+        self.log(INFO, source, message, fields)
+
+    def warning(self, source, message, **fields):
+        self.log(WARNING, source, message, fields)
+
+    def error(self, source, message, **fields):
+        self.log(ERROR, source, message, fields)
+
+    # logger with a fixed source, handed to the other modules
+    def bind(self, source):
+        return SourceLog(self, source)
+
+    def format(self, event):
+        timestamp, level, source, message, fields = event
+        second = int(timestamp)
+        if self.times[0] != second:
+            self.times = (second, datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S"))
+        line = {"time" : self.times[1], "level" : LEVEL_NAMES[level], "source" : source, "message" : message}
+        if fields:
+            line.update(fields)
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            events, stopping = drain(self.queue)
+            if len(events) == 0:
+                continue
+
+            data = "".join(self.format(event) + "\n" for event in events)
+            try:
+                if self.console:
+                    sys.stdout.write(data)
+                    sys.stdout.flush()
+                if self.file is not None:
+                    self.file.write(data)
+            except Exception as e:
+                sys.stderr.write(f"Could not write log. {e}.\n")
+
+class SourceLog:
+    def __init__(self, event_log, source):
+        self.event_log = event_log
+        self.source = source
+
+    def enabled(self, level):
+        return self.event_log.enabled(level)
+
+    def debug(self, message, **fields):
+        self.event_log.log(DEBUG, self.source, message, fields)
+
+    def info(self, message, **fields):
+        self.event_log.log(INFO, self.source, message, fields)
+
+    def warning(self, message, **fields):
+        self.event_log.log(WARNING, self.source, message, fields)
+
+    def error(self, message, **fields):
+        self.event_log.log(ERROR, self.source, message, fields)
+
+# synchronous stand-in used when no event log is supplied (e.g., in manual scripts)
+class ConsoleLog:
+    def enabled(self, level):
+        return True
+
+    def debug(self, message, **fields):
+        if fields:
+            print(message, json.dumps(fields, default=str))
+        else:
+            print(message)
+
+    info = debug
+    warning = debug
+    error = debug
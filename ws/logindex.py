@@ -0,0 +1,79 @@
+"""
+FILE: logindex.py
+
+DESCRIPTION: Detection of `sendlog` batches a device sends again (e.g., after a lost acknowledgement or a reconnect).
+
+NOTES:
+- The `logindex` and `count` of the last batch stored from each device are kept in a Redis hash (`<prefix>_LOGINDEX`,
+  `<logindex>:<count>`), shared by all WebSocket servers, with an in-process LRU cache in front of it.
+- Only an exact resend of that batch (same `logindex` and `count`) is a duplicate: it is acknowledged, but not written
+  to the database or the event stream. Any other batch is taken, even if its `logindex` is lower (the device's log was
+  cleared from its menu, or a replacement unit kept the serial number); the unique index of the records table
+  (see `common/database.py`) drops the records that are already stored.
+- The cached mark of a device is dropped when it connects, since it may have sent batches to another server meanwhile.
+- Checking a batch (`duplicate`) does not move the mark; it is set (`commit`) only once the batch is stored, so a
+  batch that failed to be stored is taken again when the device resends it.
+"""
+
+from collections import OrderedDict
+
+from logger import ConsoleLog
+
+NO_MARK = (None, None) # mark of a device that never sent a batch
+
+def parse_mark(stored):
+    index, _, count = stored.decode().partition(":")
+    return int(index), int(count) if count else None
+
+class LogIndexTracker:
+    def __init__(self, r_db, keys, capacity=100000, log=None):
+        self.r_db = r_db
+        self.key = keys.logindex()
+        self.capacity = capacity
+        self.log = log if log is not None else ConsoleLog()
+        self.marks = OrderedDict()
+
+    def remember(self, sn, mark):
+        self.marks[sn] = mark
+        self.marks.move_to_end(sn)
+        if len(self.marks) > self.capacity:
+            self.marks.popitem(last=False)
+
+    def forget(self, sn):
+        self.marks.pop(sn, None)
+
+    # True if the batch is the last one stored, sent again; errors count as new batches (the database drops duplicates)
+    async def duplicate(self, sn, index, count):
+        if not isinstance(index, int):
+            return False
+        mark = self.marks.get(sn)
+        if mark is None:
+            try:
+                stored = await self.r_db.hget(self.key, sn)
+                mark = parse_mark(stored) if stored is not None else NO_MARK
+            except Exception as e:
+                self.log.error(f"Could not check logindex. {e}.", sn=sn)
+                return False
+            self.remember(sn, mark)
+        else:
+            self.marks.move_to_end(sn)
+        return mark == (index, count)
+
+    # the batch checked with `duplicate` is stored: it becomes the device's mark
+    async def commit(self, sn, index, count):
+        if not isinstance(index, int):
+            return
+        try:
+            await self.r_db.hset(self.key, sn, f"{index}:{count}")
+        except Exception as e:
+            self.log.error(f"Could not store logindex. {e}.", sn=sn)
+            return
+        self.remember(sn, (index, count))
+
+    # the device's log was cleared; its numbering starts again
+    async def reset(self, sn):
+        self.forget(sn)
+        try:
+            await self.r_db.hdel(self.key, sn)
+        except Exception as e:
+            self.log.error(f"Could not reset logindex. {e}.", sn=sn)
@@ -0,0 +1,91 @@
+"""
+FILE: presence.py
+
+DESCRIPTION: Registry in Redis of the devices connected to this WebSocket server.
+
+NOTES:
+- Each device has a hash (`<prefix>_DEVICE_<sn>`) with the owning server instance, connection and `reg` time,
+  last message time and the device info sent with `reg`. It expires `ttl` seconds after the last heartbeat.
+- All devices are also listed in a sorted set (`<prefix>_DEVICES`) scored by their last heartbeat.
+- Messages only update the last-seen time in memory; a heartbeat task writes it to Redis for all devices at once.
+- The `instance` field names the owner of the device. A device connecting to a new instance takes it over, and
+  the previous owner is told on its takeover channel so it can close the stale connection.
+- The `token` field identifies the connection. A closing connection only removes the device if the token is still its
+  own, so the cleanup of a connection replaced by a reconnect (to the same instance or another) leaves the new one listed.
+"""
+
+import asyncio
+import time
+
+from logger import ConsoleLog
+
+DEVINFO_FIELDS = ['modelname', 'firmware', 'fpalgo', 'mac', 'netinuse', 'usersize', 'useduser', 'logsize', 'usedlog']
+
+# remove the device only if the closing connection is still the current one (it may have reconnected meanwhile)
+DISCONNECT_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'token') == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+class PresenceRegistry:
+    def __init__(self, r_db, keys, instance, ttl=90, heartbeat_interval=30, log=None):
+        self.r_db = r_db
+        self.keys = keys
+        self.instance = instance
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.log = log if log is not None else ConsoleLog()
+        self.last_seen = {}
+        self.tokens = {} # token of the current connection of each device
+        self.disconnect_script = r_db.register_script(DISCONNECT_SCRIPT)
+
+    # `token` identifies this connection of the device (see `disconnect`)
+    async def connect(self, sn, token):
+        now = time.time()
+        self.last_seen[sn] = now
+        self.tokens[sn] = token
+        async with self.r_db.pipeline(transaction=True) as pipe:
+            pipe.hget(self.keys.presence(sn), "instance")
+            pipe.delete(self.keys.presence(sn))
+            pipe.hset(self.keys.presence(sn), mapping={"sn" : sn, "instance" : self.instance, "token" : token, "connected" : int(now), "last_seen" : int(now)})
+            pipe.expire(self.keys.presence(sn), self.ttl)
+            pipe.zadd(self.keys.devices(), {sn : now})
+            previous = (await pipe.execute())[0]
+        if previous is not None and previous.decode() != self.instance:
+            await self.r_db.publish(self.keys.takeover(previous.decode()), sn)
+
+    async def register(self, sn, devinfo):
+        fields = {k : str(devinfo[k]) for k in DEVINFO_FIELDS if k in devinfo}
+        fields['reg'] = int(time.time())
+        await self.r_db.hset(self.keys.presence(sn), mapping=fields)
+
+    def seen(self, sn):
+        self.last_seen[sn] = time.time()
+
+    async def disconnect(self, sn, token):
+        if self.tokens.get(sn) == token:
+            self.tokens.pop(sn)
+            self.last_seen.pop(sn, None)
+        await self.disconnect_script(keys=[self.keys.presence(sn), self.keys.devices()], args=[token, sn])
+
+    async def heartbeat(self):
+        now = time.time()
+        async with self.r_db.pipeline(transaction=False) as pipe:
+            for sn, last_seen in self.last_seen.items():
+                pipe.hset(self.keys.presence(sn), "last_seen", int(last_seen))
+                pipe.expire(self.keys.presence(sn), self.ttl)
+                pipe.zadd(self.keys.devices(), {sn : now})
+            pipe.zremrangebyscore(self.keys.devices(), "-inf", now - self.ttl) # devices of instances that stopped
+            await pipe.execute()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                self.log.error(f"Could not refresh device presence. {e}.")
@@ -0,0 +1,257 @@
+"""
+FILE: spool.py
+
+DESCRIPTION: Disk-backed spool for `sendlog` records waiting to be inserted into the MSSQL database.
+
+NOTES:
+- Records are appended to numbered segment files as length-prefixed JSON frames; a new segment is started once
+  the current one exceeds `segment_bytes` (and on every start, so a torn tail is never appended to).
+- Appending is a single unbuffered `write`; `fsync` is batched by a background thread every `fsync_interval` seconds.
+- The replayer drains segments in order into the database and stores its position in a checkpoint file,
+  so a restart resumes where it left off. Records inserted just before a crash may be replayed once more.
+- A spool no process appends to any more (the directory of a worker that is no longer started, see `orphaned_spools`)
+  is sealed and drained by a replayer in `drain` mode, which removes its files once every segment is replayed.
+- Records the database rejects are quarantined by the writer (see `writer.py`) and the replayer moves on; any other
+  error is retried with a growing interval, since the database is assumed to be unavailable.
+"""
+
+import os
+import json
+import struct
+import threading
+
+from logger import ConsoleLog
+
+FRAME_HEADER = struct.Struct(">I")
+SEGMENT_SUFFIX = ".seg"
+
+def segment_name(segment_id):
+    return f"{segment_id:012d}{SEGMENT_SUFFIX}"
+
+def has_segments(path):
+    return os.path.isdir(path) and any(name.endswith(SEGMENT_SUFFIX) for name in os.listdir(path))
+
+# spool directories under `root` (`root` itself and its `worker-<index>` subdirectories) holding segments that none
+# of the `owned` directories' processes will replay, e.g., after a change of the number of workers
+def orphaned_spools(root, owned):
+    if not os.path.isdir(root):
+        return []
+    candidates = [root] + sorted(os.path.join(root, name) for name in os.listdir(root) if name.startswith("worker-"))
+    owned = {os.path.abspath(path) for path in owned}
+    return [path for path in candidates if os.path.abspath(path) not in owned and has_segments(path)]
+
+class Spool:
+    def __init__(self, path, segment_bytes=64 * 1024 * 1024, fsync_interval=0.2, log=None):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.log = log if log is not None else ConsoleLog()
+
+        self.lock = threading.Lock()
+        self.appended = threading.Event()
+        self.stopping = threading.Event()
+        self.file = None
+        self.segment_id = 0
+        self.segment_size = 0
+        self.dirty = False
+        self.unsynced = [] # descriptors of rotated segments that still need an fsync
+        self.thread = None
+
+    def segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX))
+
+    def segment_path(self, segment_id):
+        return os.path.join(self.path, segment_name(segment_id))
+
+    # take over the segments of a spool no process appends to any more; no segment is started, so it can only be drained
+    def seal(self):
+        existing = self.segments()
+        self.segment_id = existing[-1] + 1 if len(existing) > 0 else 0
+
+    def open(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        existing = self.segments()
+        self.segment_id = existing[-1] + 1 if len(existing) > 0 else 0
+        self.file = open(self.segment_path(self.segment_id), 'ab', buffering=0)
+        self.segment_size = 0
+
+        self.thread = threading.Thread(target=self.sync, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+    def append(self, rows):
+        payload = json.dumps(rows, separators=(",", ":")).encode()
+        with self.lock:
+            self.file.write(FRAME_HEADER.pack(len(payload)) + payload)
+            self.segment_size += FRAME_HEADER.size + len(payload)
+            self.dirty = True
+            if self.segment_size >= self.segment_bytes:
+                self.rotate()
+        self.appended.set()
+
+    # called with the lock held
+    def rotate(self):
+        self.unsynced.append(os.dup(self.file.fileno()))
+        self.file.close()
+        self.segment_id += 1
+        self.file = open(self.segment_path(self.segment_id), 'ab', buffering=0)
+        self.segment_size = 0
+
+    # fsync outside the lock so appends never wait for the disk
+    def sync(self):
+        while not self.stopping.wait(self.fsync_interval):
+            with self.lock:
+                descriptors = self.unsynced
+                self.unsynced = []
+                if self.dirty:
+                    descriptors.append(os.dup(self.file.fileno()))
+                    self.dirty = False
+            for fd in descriptors:
+                try:
+                    os.fsync(fd)
+                except OSError as e:
+                    self.log.error(f"Could not sync spool. {e}.")
+                finally:
+                    os.close(fd)
+
+class SpoolReplayer:
+    # with `drain`, the spool is sealed: the replayer stops once every segment is replayed and removes the checkpoint
+    def __init__(self, spool, writer, batch_size=5000, retry_interval=1.0, max_retry_interval=60.0, drain=False, log=None):
+        self.spool = spool
+        self.drain = drain
+        self.writer = writer
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.log = log if log is not None else ConsoleLog()
+
+        self.checkpoint_path = os.path.join(spool.path, "checkpoint")
+        self.position = None # (segment, offset) of the next record to replay, once started
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.spool.appended.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def load_checkpoint(self):
+        segments = self.spool.segments()
+        first = segments[0] if len(segments) > 0 else self.spool.segment_id
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                segment_id, offset = (int(value) for value in f.read().split())
+            if segment_id >= first:
+                return segment_id, offset
+        except (OSError, ValueError):
+            pass
+        return first, 0
+
+    def save_checkpoint(self, segment_id, offset):
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write(f"{segment_id} {offset}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.checkpoint_path)
+        self.position = (segment_id, offset)
+
+    # bytes of the spool not replayed yet
+    def backlog(self):
+        segment_id, offset = self.position if self.position is not None else (0, 0)
+        try:
+            segments = self.spool.segments()
+        except OSError: # drained and removed
+            return 0
+        total = 0
+        for segment in segments:
+            if segment < segment_id:
+                continue
+            try:
+                total += os.path.getsize(self.spool.segment_path(segment)) - (offset if segment == segment_id else 0)
+            except FileNotFoundError:
+                pass
+        return max(total, 0)
+
+    # read complete frames starting at `offset` until `batch_size` rows are collected
+    def read(self, segment_id, offset):
+        rows = []
+        try:
+            with open(self.spool.segment_path(segment_id), 'rb') as f:
+                f.seek(offset)
+                while len(rows) < self.batch_size:
+                    header = f.read(FRAME_HEADER.size)
+                    if len(header) < FRAME_HEADER.size:
+                        break
+                    (length,) = FRAME_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length: # frame is still being written (or was torn by a crash)
+                        break
+                    rows.extend(tuple(row) for row in json.loads(payload))
+                    offset += FRAME_HEADER.size + length
+        except FileNotFoundError:
+            pass
+        return rows, offset
+
+    def run(self):
+        segment_id, offset = self.position = self.load_checkpoint()
+        retry_interval = self.retry_interval
+        while not self.stopping.is_set():
+            self.spool.appended.clear()
+            with self.spool.lock: # read before `read()`: a segment rotated away by then gets no more frames
+                current = self.spool.segment_id
+            rows, next_offset = self.read(segment_id, offset)
+            if len(rows) == 0:
+                if segment_id < current and len(self.read(segment_id, offset)[0]) == 0: # rotated away and fully drained
+                    try:
+                        os.remove(self.spool.segment_path(segment_id))
+                    except FileNotFoundError:
+                        pass
+                    segment_id, offset = segment_id + 1, 0
+                    self.save_checkpoint(segment_id, offset)
+                    continue
+                if self.drain:
+                    self.finish()
+                    return
+                self.spool.appended.wait(self.retry_interval)
+                continue
+
+            try:
+                self.writer.store(rows)
+            except Exception as e:
+                self.log.error(f"Could not replay {len(rows)} spooled records. Retrying in {retry_interval:.0f} s. {e}.")
+                self.stopping.wait(retry_interval)
+                retry_interval = min(retry_interval * 2, self.max_retry_interval)
+                continue
+
+            retry_interval = self.retry_interval
+            offset = next_offset
+            self.save_checkpoint(segment_id, offset)
+
+    # a drained spool: only its (empty) directory is left
+    def finish(self):
+        for path in (self.checkpoint_path, self.checkpoint_path + ".tmp"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(self.spool.path)
+        except OSError:
+            pass
+        self.log.info(f"Spool {self.spool.path} drained.")
@@ -0,0 +1,64 @@
+"""
+FILE: supervisor.py
+
+DESCRIPTION: Runs several WebSocket server processes on one port.
+
+NOTES:
+- Each worker is the WebSocket app started again with `--worker <index>`; workers listen with `SO_REUSEPORT`,
+  so the kernel spreads new connections across them.
+- Every worker is a separate instance with its own inbox channel, so commands reach the worker that owns the device.
+- A worker that exits is restarted after `restart_delay` seconds. SIGTERM or SIGINT stops all workers: each one is sent
+  SIGTERM, on which it closes its writer, archive and log (see `main` in `app_ws.py`), and is killed after 10 seconds.
+"""
+
+import signal
+import subprocess
+import sys
+import time
+
+from logger import ConsoleLog
+
+class Supervisor:
+    def __init__(self, argv, workers, restart_delay=1.0, log=None):
+        self.argv = argv
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.log = log if log is not None else ConsoleLog()
+        self.processes = {}
+        self.stopping = False
+
+    def start_worker(self, index):
+        self.processes[index] = subprocess.Popen([sys.executable, "-u"] + self.argv + ["--worker", str(index)])
+        self.log.info("Worker started.", worker=index, pid=self.processes[index].pid)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self.start_worker(index)
+
+        restarts = {}
+        while not self.stopping:
+            time.sleep(0.2)
+            for index, process in list(self.processes.items()):
+                if process.poll() is None or self.stopping:
+                    continue
+                if index not in restarts:
+                    self.log.error("Worker exited.", worker=index, code=process.returncode)
+                    restarts[index] = time.monotonic() + self.restart_delay
+                elif time.monotonic() >= restarts[index]:
+                    del restarts[index]
+                    self.start_worker(index)
+
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        return 0
@@ -0,0 +1,323 @@
+"""
+FILE: writer.py
+
+DESCRIPTION: Write-behind pipeline inserting `sendlog` records into the MSSQL database.
+
+NOTES:
+- Records are enqueued by the WebSocket handler; acknowledging the device never waits for the database.
+- Worker threads share a connection pool and coalesce records from all devices into multi-row inserts,
+  flushed once `batch_size` rows are collected or `flush_interval` seconds have passed.
+- The table is created or migrated to the current schema (see `common/database.py`) once, on the first connection,
+  which is made on a background thread: the WebSocket server accepts devices during a database outage or a migration.
+- With a spool (see `spool.py`), records are appended to disk instead of the in-memory queue and replayed into the
+  database by a single thread, so nothing is lost while the database is slow or unreachable.
+  The worker threads, `batch_size` and `flush_interval` are then unused.
+- Records already in the table (same device, person, time, mode, in/out and event) are skipped by the database's unique
+  index and counted as duplicates.
+- Connection and server errors are retried (forever with a spool, `retries` times otherwise). A batch the database rejects
+  because of its values (see `data_error` in `common/database.py`) is halved until the rejected records are found; they are
+  set aside in a quarantine file and the rest is inserted. Without a spool, a batch that still fails is quarantined too.
+- The quarantine file (`quarantine.ndjson`) has the format of the message archive (see `archive.py`), one `sendlog`
+  message per record plus the `error`, so it can be fixed and loaded with `backfill.py`.
+- Batch sizes, insert latencies, failed inserts and skipped duplicates are exported as metrics (see `common/metrics.py`).
+"""
+
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+from common.database import ConnectionPool, migrate, data_error, LOG_COLUMNS, TIME_FORMAT
+from common.metrics import Counter, Histogram
+from logger import ConsoleLog
+from spool import Spool, SpoolReplayer
+
+INSERT_ROWS = Histogram("face_mssql_insert_rows", "Records per insert batch.", buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+INSERT_SECONDS = Histogram("face_mssql_insert_seconds", "Time to insert and commit a batch of records.")
+INSERT_ERRORS = Counter("face_mssql_insert_errors_total", "Failed attempts to insert a batch of records.")
+DUPLICATE_ROWS = Counter("face_mssql_duplicate_rows_total", "Records skipped because they were already in the table.")
+QUARANTINED_ROWS = Counter("face_mssql_quarantined_rows_total", "Records set aside because the database rejected them.")
+
+COLUMNS = LOG_COLUMNS[1:] # `id` is generated by the database
+ROWS_PER_INSERT = 1000 # maximum number of rows in a single INSERT ... VALUES statement
+
+# the device's time if it can be parsed (the `time` column is a DATETIME2), otherwise the time it was received
+def record_time(value):
+    try:
+        return datetime.datetime.strptime(value, TIME_FORMAT).strftime(TIME_FORMAT)
+    except (TypeError, ValueError):
+        return datetime.datetime.now().strftime(TIME_FORMAT)
+
+def record_rows(message):
+    return [(
+        message['sn'],
+        message['record'][i]['enrollid'],
+        message['record'][i]['aliasid'],
+        message['record'][i]['name'],
+        record_time(message['record'][i]['time']),
+        message['record'][i]['mode'],
+        message['record'][i]['inout'],
+        message['record'][i]['event']
+    ) for i in range(message['count'])]
+
+# multi-row inserts of rows in `COLUMNS` order, committed together; returns the number of rows skipped as duplicates
+def insert_rows(conn, table, rows):
+    cursor = conn.cursor()
+    duplicates = 0
+    for i in range(0, len(rows), ROWS_PER_INSERT):
+        chunk = rows[i:i + ROWS_PER_INSERT]
+        placeholders = ", ".join(["(" + ", ".join(["%s"] * len(COLUMNS)) + ")"] * len(chunk))
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(COLUMNS)}) VALUES {placeholders}",
+            tuple(value for row in chunk for value in row)
+        )
+        if cursor.rowcount >= 0:
+            duplicates += len(chunk) - cursor.rowcount
+    conn.commit()
+    return duplicates
+
+# the database refused the values of a batch (not its connection); retrying the same rows cannot succeed
+class RowsRejected(Exception):
+    pass
+
+# records that could not be inserted, appended as archive lines to `<path>/quarantine.ndjson` (only logged without a path)
+class Quarantine:
+    def __init__(self, path=None, log=None):
+        self.path = path
+        self.log = log if log is not None else ConsoleLog()
+        self.lock = threading.Lock()
+
+    def add(self, rows, error):
+        QUARANTINED_ROWS.inc(len(rows))
+        lines = []
+        for row in rows:
+            row = row[-len(COLUMNS):]
+            message = {"cmd" : "sendlog", "sn" : row[0], "count" : 1, "record" : [dict(zip(COLUMNS[1:], row[1:]))]}
+            lines.append(json.dumps({"t" : round(time.time(), 3), "dir" : "in", "msg" : message, "error" : f"{error}"}, separators=(",", ":"), default=str, ensure_ascii=False) + "\n")
+        if self.path is None:
+            for line in lines:
+                self.log.error(f"Record not inserted. {line.strip()}")
+            return
+        try:
+            with self.lock:
+                os.makedirs(self.path, exist_ok=True)
+                with open(os.path.join(self.path, "quarantine.ndjson"), 'a', encoding="utf-8") as f:
+                    f.writelines(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+        except OSError as e:
+            self.log.error(f"Could not write {len(rows)} records to the quarantine. {e}.")
+            for line in lines:
+                self.log.error(f"Record not inserted. {line.strip()}")
+            return
+        self.log.error(f"Quarantined {len(rows)} records that could not be inserted. {error}.")
+
+class RecordWriter:
+    def __init__(self, host, user, password, database, table, workers=2, batch_size=500, flush_interval=1.0, stats_interval=60.0, spool=None, partition_months=0, quarantine=None, retries=5, retry_interval=1.0, log=None):
+        self.pool = ConnectionPool(host, user, password, database)
+        self.table = table
+        self.partition_months = partition_months
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats_interval = stats_interval
+        self.spool = spool
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.log = log if log is not None else ConsoleLog()
+        self.quarantine = Quarantine(quarantine, self.log)
+
+        self.queue = queue.Queue()
+        self.stopping = threading.Event()
+        self.replayer = None
+        self.orphans = [] # replayers of spools left by other processes
+        self.threads = []
+        self.table_ready = False
+        self.table_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.last_stats_time = time.monotonic()
+
+    # create or migrate the table up front so the first flush does not pay for it; a failure is retried by the first write
+    def prepare(self):
+        conn = None
+        try:
+            conn = self.pool.get()
+            self.ensure_table(conn)
+            self.pool.put(conn)
+        except Exception as e:
+            if conn is not None:
+                self.pool.discard(conn)
+            self.log.error(f"Could not prepare table {self.table}. {e}.")
+
+    # never blocks on the database: connecting and migrating happen on background threads
+    def start(self):
+        threading.Thread(target=self.prepare, daemon=True).start()
+
+        if self.spool is not None:
+            self.spool.open()
+            self.replayer = SpoolReplayer(self.spool, self, log=self.log)
+            self.replayer.start()
+            return
+
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # replay the spools at `paths`, which no process appends to any more (see `orphaned_spools` in `spool.py`)
+    def adopt(self, paths):
+        for path in paths:
+            spool = Spool(path, log=self.log)
+            spool.seal()
+            replayer = SpoolReplayer(spool, self, drain=True, log=self.log)
+            replayer.start()
+            self.orphans.append(replayer)
+            self.log.info(f"Replaying spool {path} left by another process.")
+
+    def stop(self):
+        self.stopping.set()
+        for replayer in self.orphans:
+            replayer.stop()
+        if self.replayer is not None:
+            self.replayer.stop()
+            self.spool.close()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.pool.close()
+
+    def submit(self, message):
+        if message['count'] > 0:
+            if self.spool is not None:
+                self.spool.append(record_rows(message))
+            else:
+                self.queue.put(record_rows(message))
+
+    # bytes spooled but not inserted yet, including the spools adopted from other processes (0 without a spool)
+    def backlog(self):
+        replayers = ([self.replayer] if self.replayer is not None else []) + self.orphans
+        return sum(replayer.backlog() for replayer in replayers)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "queue_depth" : self.queue.qsize(),
+                "flushes" : self.flushes,
+                "flushed_rows" : self.flushed_rows,
+                "last_flush_latency" : self.last_flush_latency,
+                "max_flush_latency" : self.max_flush_latency
+            }
+
+    def ensure_table(self, conn):
+        if self.table_ready:
+            return
+        with self.table_lock:
+            if self.table_ready:
+                return
+            version = migrate(conn, self.table, self.partition_months)
+            self.log.info(f"Table {self.table} is at schema version {version}.")
+            self.table_ready = True
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            rows = self.queue.get()
+            if rows is None:
+                break
+
+            # keep collecting until the batch is full or the flush interval has passed
+            batch = list(rows)
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    rows = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if rows is None:
+                    stopping = True
+                    break
+                batch.extend(rows)
+
+            self.flush(batch)
+
+    # without a spool, a batch the database cannot take after `retries` attempts (or by the time the writer stops) is quarantined
+    def flush(self, batch):
+        retry_interval = self.retry_interval
+        for attempt in range(self.retries + 1):
+            try:
+                self.store(batch)
+                return
+            except Exception as e:
+                if attempt == self.retries or self.stopping.is_set():
+                    self.log.error(f"Could not insert {len(batch)} records to {self.table}. {e}.")
+                    self.quarantine.add(batch, e)
+                    return
+                self.log.warning(f"Could not insert {len(batch)} records to {self.table}. Retrying in {retry_interval:.0f} s. {e}.")
+                self.stopping.wait(retry_interval)
+                retry_interval *= 2
+
+    # insert a batch, quarantining the rows the database rejects; raises if the database is unavailable
+    def store(self, batch):
+        try:
+            self.write(batch)
+        except RowsRejected as e:
+            if len(batch) == 1:
+                self.quarantine.add(batch, e)
+                return
+            middle = len(batch) // 2
+            self.store(batch[:middle])
+            self.store(batch[middle:])
+
+    # insert a batch of rows on a pooled connection; raises `RowsRejected` if the rows are refused, another error if the
+    # database is unavailable (nothing of the batch is committed either way)
+    def write(self, batch):
+        start_time = time.monotonic()
+        conn = None
+        try:
+            conn = self.pool.get()
+            self.ensure_table(conn)
+            try:
+                duplicates = self.insert(conn, batch)
+            except Exception as e:
+                if data_error(e):
+                    raise RowsRejected(f"{e}") from e
+                raise
+        except Exception:
+            if conn is not None:
+                self.pool.discard(conn)
+            INSERT_ERRORS.inc()
+            raise
+        self.pool.put(conn)
+        latency = time.monotonic() - start_time
+        INSERT_ROWS.observe(len(batch))
+        INSERT_SECONDS.observe(latency)
+        if duplicates > 0:
+            DUPLICATE_ROWS.inc(duplicates)
+
+        with self.stats_lock:
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            report = time.monotonic() - self.last_stats_time >= self.stats_interval
+            if report:
+                self.last_stats_time = time.monotonic()
+        self.log.info(f"Inserted {len(batch) - duplicates} records to {self.table} ({duplicates} duplicates) in {latency * 1000:.1f} ms.")
+        if report:
+            stats = self.stats()
+            self.log.info(f"Writer stats: queue depth {stats['queue_depth']}, {stats['flushed_rows']} records in {stats['flushes']} flushes, max flush latency {stats['max_flush_latency'] * 1000:.1f} ms.")
+
+    # returns the number of rows skipped as duplicates
+    def insert(self, conn, rows):
+        rows = [row[-len(COLUMNS):] for row in rows] # rows spooled before the migration still start with `cmd`
+        return insert_rows(conn, self.table, rows)